@@ -20,613 +20,7306 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 """
-Call tracing for single functions and methods or complete classes. The only public interface
+Call tracing for single functions and methods or complete classes. The main public interface
 is the @trace decorator.
+
+By default traces are printed synchronously by the thread making the traced call. Call
+start_async_output() to hand them to a background writer thread instead, so the traced code does
+not pay for the terminal I/O. In that mode traced calls only capture raw records; converting
+arguments and return values to text is done by the writer thread.
+
+Traces go to sinks, which receive structured records. By default traces are printed as text.
+set_sink() and add_sink() can select other sinks: LoggingSink, JsonLinesSink, RingBufferSink,
+FlightRecorder, CallTreeSink, BinarySink, ShardSink, StreamSink or CaptureSink, or your own subclass
+of Sink.
+CallTreeSink rebuilds the call trees with inclusive and exclusive time per function, as indented
+text or as collapsed stacks for flame graphs. BinarySink writes a compact binary file, convert it
+back to text using:
+
+    python -m calltrace decode <file>
+
+StreamSink publishes traces on a local socket, so they can be watched live from another terminal,
+filtered at the source:
+
+    python -m calltrace tail <socket path or host:port> --function 'Class.*'
+
+For forked worker processes ShardSink writes a file per process, merge them into a single stream
+ordered by time using:
+
+    python -m calltrace merge <directory>
+
+Tracing can also measure the duration of calls, using @trace(timing=True) or set_timing(). The
+collected latency statistics are available from stats() and report(). To find candidates for
+caching, @trace(memoization=True) or set_memoization_analysis() estimate how often functions are
+called again with the same arguments, see memoization_report(). To tell instances apart over long
+runs, set_instance_registry() numbers them in order of appearance and counts the calls per
+instance, see instance_stats(). set_instance_filter() traces a single instance.
+
+CaptureSink records the calls of selected functions with their pickled arguments and results, to
+replay them later as a benchmark that also checks the results:
+
+    python -m calltrace replay <corpus> --function 'Class.*'
+
+Whole modules can be traced with trace_module(), and all modules of a package with trace_package(),
+selecting functions and methods with glob or regular expression patterns.
+
+Tracing can be switched off and on at runtime with disable() and enable(), globally or per traced
+function or class. Disabled tracers cost only a flag check per call. Use set_sampling() to trace
+only a fraction of the calls. To remove tracing completely use untrace().
+
+Arguments are formatted like str() would, but cut off at a maximum length, number of items and
+nesting depth, see set_format_limits(). Custom formatters for types can be added with
+register_formatter(). How much of return values and exceptions is captured can be chosen per
+tracer. Identical tracebacks are rate limited, see set_traceback_limit().
+
+Coroutine functions, generators and asynchronous generators are traced until they finish, not
+until they return the coroutine or generator object. Calls made from an asyncio task also show
+the id of the task.
 """
 from __future__ import print_function
 
 __author__ = 'Silvester747@gmail.com'
 
+import argparse
+import atexit
+import collections
+import errno
+import fnmatch
+import functools
+import gc
+import heapq
+import importlib
 import inspect
+import io
+import itertools
+import json
+import linecache
+import logging
+import math
+import os
+import pickle
+import random
+import re
+import struct
+import sys
 import threading
+import time
 import traceback
+import types
 import unittest
+import weakref
 
-# TODO: Show defaults too
-# TODO: Handle properties (maybe use class_attrs for everything?)
 # TODO: Improve tracing subclasses: use setattr on the proper class objects
 
 
-def trace(obj):
+def trace(obj=None, **options):
     """
     Trace all calls to a function, method or all methods in a class. Simply annotate any of them
     with @trace. Prints traces to stdout.
 
+    Options can be passed using @trace(option=value):
+    - timing: Measure the duration of each call, see stats(). By default follows set_timing().
+    - enabled: Start with tracing enabled. Defaults to True, see enable() and disable().
+    - sample_every: Only trace 1 in every N calls.
+    - sample_rate: Only trace calls with this probability (0.0 - 1.0).
+    - aggregate_only: Do not write traces, only count the calls and measure their duration for
+      stats().
+    - returns: What to capture of return values: CAPTURE_OFF, CAPTURE_TYPE, CAPTURE_TRUNCATED
+      (the default, formatted within the format limits) or CAPTURE_FULL.
+    - exceptions: What to capture of exceptions: CAPTURE_OFF, CAPTURE_TYPE, CAPTURE_TRUNCATED (type
+      and message) or CAPTURE_FULL (the default, including the traceback, see
+      set_traceback_limit()).
+    - memoization: Estimate how many calls repeat earlier arguments, see memoization_stats(). By
+      default follows set_memoization_analysis().
+    - slow_threshold: Only write the traces of calls taking at least this many seconds or raising
+      an exception, 0 to write all calls. By default follows set_slow_threshold().
+    - show_defaults: Also show the arguments left at their default value, which are left out by
+      default.
+    - properties: For classes, also trace the getters, setters and deleters of properties and
+      other descriptors. Either True to use the same options as for methods, or a dict of options
+      for the accessors only, like {'aggregate_only': True} or {'sample_every': 100}, as
+      attributes tend to be accessed far more often than methods are called.
+
     Tries do prepare as much as possible at the time of class definition and limit the cycles wasted
     during each traced call.
     """
-    if inspect.isclass(obj):
-        return _trace_class(obj)
+    if obj is None:
+        return functools.partial(trace, **options)
+    elif inspect.isclass(obj):
+        return _trace_class(obj, **options)
     elif inspect.ismethod(obj) or inspect.isfunction(obj):
-        return _trace_method(obj)
+        return _trace_method(obj, **options)
     else:
         raise TypeError('Cannot trace this object.')
 
 
-def _trace_class(c):
-    class_attrs = inspect.classify_class_attrs(c)
-    methods = inspect.getmembers(c, lambda obj: inspect.ismethod(obj) or inspect.isfunction(obj))
-    for name, method in methods:
+def untrace(obj):
+    """
+    Remove tracing from a class traced with @trace or a module traced with trace_module(). The
+    original functions, static methods and class methods are restored, and methods added to trace
+    inherited methods are removed again. Methods traced individually in the class body are replaced
+    by their original function.
 
-        if hasattr(method, 'tracer'):
-            # Method is already being traced
-            continue
+    A traced function cannot be replaced everywhere it is referenced, so its tracer is disabled and
+    the original function is returned.
 
-        for attr_name, attr_kind, _, _ in class_attrs:
-            if attr_name == name:
-                kind = attr_kind
-                break
-        else:
-            continue
+    :return: The class, module or the original function.
+    """
+    if inspect.ismethod(obj):
+        obj = obj.__func__
 
-        if kind == 'method':
-            decorator = lambda f: f
-        elif kind == 'static method':
-            decorator = staticmethod
-        elif kind == 'class method':
-            decorator = classmethod
-            # To relay calls to the class method, we need to use the underlying function
-            method = method.__func__
-        else:
+    if inspect.ismodule(obj):
+        for name, original in _originals.pop(obj, {}).items():
+            _disable_tracer(_attribute_tracer(getattr(obj, name, None)))
+            setattr(obj, name, original)
+        for value in list(vars(obj).values()):
+            if inspect.isclass(value) and value.__module__ == obj.__name__ and value in _originals:
+                untrace(value)
+        return obj
+
+    if inspect.isclass(obj):
+        for name, original in _originals.pop(obj, {}).items():
+            _disable_tracer(_attribute_tracer(obj.__dict__.get(name)))
+            if original is _NOT_DEFINED:
+                # Inherited
+                delattr(obj, name)
+            else:
+                setattr(obj, name, original)
+
+        # Methods traced individually in the class body
+        for name, value in list(vars(obj).items()):
+            tracer = _attribute_tracer(value)
+            if tracer is not None:
+                _disable_tracer(tracer)
+                if isinstance(value, (staticmethod, classmethod)):
+                    setattr(obj, name, type(value)(tracer.original))
+                else:
+                    setattr(obj, name, tracer.original)
+        return obj
+
+    tracers = _tracers_of(obj)
+    for tracer in tracers:
+        _disable_tracer(tracer)
+    return tracers[0].original
+
+
+def _disable_tracer(tracer):
+    if tracer is not None:
+        tracer.enabled = False
+        tracer.update_active()
+
+
+# Original class attributes replaced by _trace_class
+_originals = weakref.WeakKeyDictionary()
+_NOT_DEFINED = object()
+
+
+def _trace_class(c, select=None, properties=False, **options):
+    """
+    Trace the methods, static methods and class methods of a class, including those it inherits.
+    Makes a single pass over the dicts of the classes in the MRO, the first definition of a name
+    wins. Methods inherited from untraced base classes get a tracer per traced subclass, so they can
+    be switched per class. Their signatures are inspected only once, see _get_argspec(), and the
+    tracers share the compiled wrapper code, see _generate_wrapper().
+
+    :param select: Optional function called with the name of each method, returning whether to
+                   trace it.
+    :param properties: Also trace properties and other descriptors, see trace().
+    """
+    originals = _originals.setdefault(c, {})
+    accessor_options = dict(options)
+    if isinstance(properties, dict):
+        accessor_options.update(properties)
+    seen = set()
+    for defining_class in inspect.getmro(c):
+        if not _is_python_class(defining_class):
+            # Like object and dict, their methods and attributes are implemented in C
             continue
+        for name, value in list(vars(defining_class).items()):
+            if name in seen:
+                continue
+            seen.add(name)
 
-        setattr(c, name, decorator(_trace_method(method, c.__name__)))
+            if (isinstance(value, (staticmethod, classmethod)) and
+                    inspect.isfunction(value.__func__)):
+                # To relay calls, we need to use the underlying function
+                decorator = type(value)
+                func = value.__func__
+            elif inspect.isfunction(value):
+                decorator = None
+                func = value
+            elif properties and _is_descriptor(name, value):
+                decorator = None
+                func = None
+            else:
+                continue
+
+            if func is not None and _attribute_tracer(func) is not None:
+                # Method is already being traced
+                continue
+            if select is not None and not select(name):
+                continue
+
+            if func is None:
+                wrapped = _trace_descriptor(value, defining_class.__name__, name,
+                                            accessor_options)
+            else:
+                # Traces show the class defining the method
+                wrapped = _trace_method(func, defining_class.__name__, **options)
+                if decorator is not None:
+                    wrapped = decorator(wrapped)
+
+            if name not in originals:
+                originals[name] = c.__dict__.get(name, _NOT_DEFINED)
+            setattr(c, name, wrapped)
 
     return c
 
 
-def _trace_method(func, class_name=None):
+def _trace_method(func, class_name=None, **options):
     assert inspect.ismethod(func) or inspect.isfunction(func)
-    return _FunctionTracer(func, class_name).wrapped_function()
+    return _FunctionTracer(func, class_name, **options).wrapped_function()
+
 
+# Py_TPFLAGS_HEAPTYPE, set for classes created by class statements and type()
+_HEAP_TYPE = 1 << 9
 
-_threads_in_safe_str = set()
 
+def _is_python_class(cls):
+    return bool(getattr(cls, '__flags__', _HEAP_TYPE) & _HEAP_TYPE)
 
-def _safe_str(obj):
+
+# Descriptors of methods and attributes implemented in C, including those of __slots__
+_builtin_descriptors = tuple(getattr(types, name) for name in (
+    'MethodDescriptorType', 'WrapperDescriptorType', 'ClassMethodDescriptorType',
+    'GetSetDescriptorType', 'MemberDescriptorType') if hasattr(types, name))
+
+
+def _is_descriptor(name, value):
+    if name.startswith('__') and name.endswith('__'):
+        # Like __dict__ and __weakref__
+        return False
+    return (hasattr(type(value), '__get__') and not inspect.isclass(value) and
+            not isinstance(value, (_TracedProperty, _TracedDescriptor) + _builtin_descriptors))
+
+
+def _trace_descriptor(descriptor, class_name, name, options):
     """
-    Get string representations for objects without causing recursions in traced objects. Goes
-    together with _check_recursion_loop().
+    Trace the accessors of a property or another descriptor. Tracers are named after the attribute
+    and the descriptor method, like Class.name.__get__.
     """
-    current_thread = id(threading.current_thread())
-    try:
-        _threads_in_safe_str.add(current_thread)
-        return str(obj)
-    except RuntimeError:
-        # Infinite recursion should no longer happen, but let's be safe
-        return str(id(obj))
-    finally:
-        _threads_in_safe_str.remove(current_thread)
+    def trace_accessor(func, method):
+        if func is None or _attribute_tracer(func) is not None:
+            return func
+        return _trace_method(func, class_name, name='{}.{}'.format(name, method), **options)
 
+    if type(descriptor) is property:
+        return _TracedProperty(trace_accessor(descriptor.fget, '__get__'),
+                               trace_accessor(descriptor.fset, '__set__'),
+                               trace_accessor(descriptor.fdel, '__delete__'),
+                               descriptor.__doc__)
 
-def _check_recursion_loop():
+    # Named self, so the traces show the instance like they do for methods
+    def getter(self):
+        return descriptor.__get__(self, type(self))
+
+    if not (hasattr(type(descriptor), '__set__') or hasattr(type(descriptor), '__delete__')):
+        return _TracedDescriptor(descriptor, trace_accessor(getter, '__get__'))
+
+    def setter(self, value):
+        descriptor.__set__(self, value)
+
+    def deleter(self):
+        descriptor.__delete__(self)
+
+    return _TracedDataDescriptor(descriptor, trace_accessor(getter, '__get__'),
+                                 trace_accessor(setter, '__set__'),
+                                 trace_accessor(deleter, '__delete__'))
+
+
+class _TracedProperty(property):
     """
-    Check that we are causing an infinite loop. This happens when str() uses __str__() which
-    calls another traced method.
+    Property with traced accessors. Remembers their tracers, so they can be found from the class.
+    """
+    def __init__(self, fget=None, fset=None, fdel=None, doc=None):
+        super(_TracedProperty, self).__init__(fget, fset, fdel, doc)
+        tracers = [_attribute_tracer(func) for func in (fget, fset, fdel) if func is not None]
+        self.tracers = [tracer for tracer in tracers if tracer is not None]
 
-    This only works if this module consistently uses _safe_str() instead of str()
 
-    :return: True if we are looping.
+class _TracedDescriptor(object):
+    """
+    Traces getting a non-data descriptor from an instance. Getting it from the class is not traced.
+    Other attributes are taken from the wrapped descriptor.
     """
-    return id(threading.current_thread()) in _threads_in_safe_str
+    def __init__(self, descriptor, getter):
+        self._descriptor = descriptor
+        self._getter = getter
+        self.tracers = [getter.tracer]
 
+    def __get__(self, instance, owner=None):
+        if instance is None:
+            return self._descriptor.__get__(None, owner)
+        return self._getter(instance)
 
-def _output(msg):
-    print('CallTracing:', msg)
+    def __getattr__(self, name):
+        return getattr(self._descriptor, name)
 
 
-class _FunctionTracer(object):
-    def __init__(self, func, class_name=None):
-        self._func = func
-        self._get_details()
+class _TracedDataDescriptor(_TracedDescriptor):
+    """
+    Traces getting, setting and deleting a data descriptor on an instance.
+    """
+    def __init__(self, descriptor, getter, setter, deleter):
+        super(_TracedDataDescriptor, self).__init__(descriptor, getter)
+        self._setter = setter
+        self._deleter = deleter
+        self.tracers += [setter.tracer, deleter.tracer]
 
-        # Static/class methods do not have the class associated, so allow passing a fallback
-        if class_name and not self._class_name:
-            self._class_name = class_name
+    def __set__(self, instance, value):
+        self._setter(instance, value)
 
-        self._select_call_format()
-        self._select_handle_self()
+    def __delete__(self, instance):
+        self._deleter(instance)
 
-    def _get_details(self):
-        self._name = self._func.__name__
 
-        self._class_name = None
-        if inspect.ismethod(self._func):
-            if self._func.im_class:
-                self._class_name = self._func.im_class.__name__
-            real_func = self._func.__func__
-        else:
-            real_func = self._func
+def trace_module(module, include=None, exclude=None, **options):
+    """
+    Trace all functions and classes defined in a module. Names imported from other modules are left
+    alone. Only the attributes of the module are replaced, references taken before, for example by
+    'from module import function', keep calling the untraced function.
 
-        self._arg_names = inspect.getargspec(real_func).args
+    Patterns select what to trace by its full name, like 'package.module.function' or
+    'package.module.Class.method'. A method also matches patterns for the full name of its class.
+    Patterns are either glob strings, like 'package.module.Class.*', or compiled regular
+    expressions, which are searched anywhere in the name.
 
-        self._is_init = self._name == '__init__'
-        self._has_self = 'self' in self._arg_names
+    :param module: Module object or name of an imported module.
+    :param include: Pattern or list of patterns to trace, by default everything is traced.
+    :param exclude: Pattern or list of patterns not to trace, even when included.
+    :param options: Options as for trace().
+    :return: The module.
+    """
+    if isinstance(module, str):
+        module = sys.modules[module]
+    _trace_module(module, _NameFilter(include, exclude), options)
+    return module
 
-    def _select_call_format(self):
-        if self._class_name and self._has_self:
-            self._name_format = '{class_name}[{instance_id}].{func_name}'
-        elif self._class_name and not self._has_self:
-            self._name_format = '{class_name}.{func_name}'
-        elif not self._class_name and self._has_self:
-            self._name_format = '[{instance_id}].{func_name}'
-        else:
-            self._name_format = '{func_name}'
 
-        self._name_format = self._name_format.format(class_name=self._class_name,
-                                                     func_name=self._name,
-                                                     instance_id='{instance_id}')
-        thread_format = 'Thread{{{thread}}}:'
+def _trace_module(module, name_filter, options):
+    module_name = module.__name__
+    originals = _originals.setdefault(module, {})
+    function_options = dict((key, value) for key, value in options.items() if key != 'properties')
+    for name, value in list(vars(module).items()):
+        if getattr(value, '__module__', None) != module_name:
+            continue
 
-        self._call_format = thread_format + self._name_format + '({pargs}{comma}{kwargs})'
-        self._return_format = thread_format + self._name_format + ' returned {return_value}'
-        self._exception_format = thread_format + self._name_format + ' raised an exception'
+        full_name = module_name + '.' + name
+        if inspect.isclass(value):
+            _trace_class(value, lambda method_name: name_filter.selects(
+                full_name, full_name + '.' + method_name), **options)
+        elif (inspect.isfunction(value) and _attribute_tracer(value) is None and
+              name_filter.selects(full_name)):
+            originals.setdefault(name, value)
+            setattr(module, name, _trace_method(value, **function_options))
 
-    def _select_handle_self(self):
-        if self._has_self and self._is_init:
-            # Need to ignore self
-            self._arg_names = self._arg_names[1:]
-            self._handle_self = self._handle_self_remove_self
-        elif self._has_self:
-            self._handle_self = self._handle_self_use_self
-        else:
-            self._handle_self = self._handle_self_no_self
 
-    @staticmethod
-    def _handle_self_remove_self(pargs, kwargs):
-        if 'self' in kwargs:
-            instance = id(kwargs['self'])
-            kwargs = {k: v for k, v in kwargs.items() if k != 'self'}
-        elif len(pargs) > 0:
-            instance = id(pargs[0])
-            pargs = pargs[1:]
-        else:
-            instance = None
-        return pargs, kwargs, instance
+class _NameFilter(object):
+    """
+    Select names using include and exclude patterns. The glob patterns of a kind are combined
+    into a single regular expression, compiled regular expressions are used as they are, with
+    their flags. Glob patterns match whole names, regular expressions are searched anywhere in the
+    name.
+    """
+    def __init__(self, include, exclude):
+        self._include = self._compile(include)
+        self._exclude = self._compile(exclude)
 
     @staticmethod
-    def _handle_self_use_self(pargs, kwargs):
-        if 'self' in kwargs:
-            instance = id(kwargs['self'])
-        elif len(pargs) > 0:
-            instance = id(pargs[0])
-        else:
-            instance = None
-        return pargs, kwargs, instance
+    def _compile(patterns):
+        if patterns is None:
+            return None
+        if isinstance(patterns, str) or hasattr(patterns, 'search'):
+            patterns = [patterns]
+        expressions = [pattern for pattern in patterns if hasattr(pattern, 'search')]
+        # fnmatch.translate() only anchors at the end
+        globs = ['(?:^{})'.format(fnmatch.translate(pattern)) for pattern in patterns
+                 if not hasattr(pattern, 'search')]
+        if globs:
+            expressions.insert(0, re.compile('|'.join(globs)))
+        return expressions
 
     @staticmethod
-    def _handle_self_no_self(pargs, kwargs):
-        return pargs, kwargs, None
+    def _search(expressions, names):
+        return any(expression.search(name) for expression in expressions for name in names)
 
-    def wrapped_function(self):
+    def selects(self, *names):
         """
-        Return a function and not a (un)bound method. We do not want to interfere with self.
+        :return: True if any of the names is included and none is excluded.
         """
-        def wrapped(*pargs, **kwargs):
-            return wrapped.tracer._call(pargs, kwargs)
-        wrapped.tracer = self
-        wrapped.__name__ = self._func.__name__
-        wrapped.__doc__ = self._func.__doc__
-        return wrapped
+        if self._include is not None and not self._search(self._include, names):
+            return False
+        return self._exclude is None or not self._search(self._exclude, names)
 
-    def _call(self, pargs, kwargs):
-        looping = _check_recursion_loop()
-        instance = 0  # in case exception is raised in a loop
-        if not looping:
-            filtered_pargs, filtered_kwargs, instance = self._handle_self(pargs, kwargs)
-            thread_id = id(threading.current_thread())
-            self._log_call(filtered_pargs, filtered_kwargs, instance, thread_id)
-        try:
-            ret = self._func(*pargs, **kwargs)
-            if not looping:
-                self._log_return(ret, instance, thread_id)
-            return ret
-        except:
-            self._log_exception(instance, thread_id)
-            raise
 
-    def _log_call(self, pargs, kwargs, instance, thread_id):
-        _output(self._format_call(pargs, kwargs, instance, thread_id))
+def trace_package(package, include=None, exclude=None, **options):
+    """
+    Trace all modules of a package, see trace_module(). Modules already imported are traced right
+    away, an import hook traces the modules imported later as soon as they are loaded. Requires
+    Python 3.4 or later.
 
-    def _format_call(self, pargs, kwargs, instance, thread_id):
-        formatted_pargs = self._format_arguments(zip(self._arg_names, pargs))
-        formatted_kwargs = self._format_arguments(kwargs.items())
-        comma = ', ' if formatted_pargs and formatted_kwargs else ''
+    :param package: Name of the package, which does not need to be imported yet.
+    :param include: Patterns of full names to trace, see trace_module().
+    :param exclude: Patterns of full names not to trace.
+    :param options: Options as for trace().
+    """
+    untrace_package(package)
+    hook = _TracingImportHook(package, _NameFilter(include, exclude), options)
+    sys.meta_path.insert(0, hook)
+    for name, module in list(sys.modules.items()):
+        if module is not None and hook.covers(name):
+            _trace_module(module, hook.name_filter, options)
 
-        return self._call_format.format(thread=thread_id,
-                                        instance_id=instance,
-                                        pargs=formatted_pargs,
-                                        kwargs=formatted_kwargs,
-                                        comma=comma)
 
-    @staticmethod
-    def _format_arguments(arg_pairs):
-        if arg_pairs:
-            return ', '.join('{}={}'.format(key, _safe_str(value)) for key, value in arg_pairs)
-        else:
-            return ''
+def untrace_package(package):
+    """
+    Remove the import hook of trace_package() and remove tracing from the modules of the package
+    imported so far.
+    """
+    for hook in [hook for hook in sys.meta_path if isinstance(hook, _TracingImportHook)]:
+        if hook.package == package:
+            sys.meta_path.remove(hook)
+    prefix = package + '.'
+    for name, module in list(sys.modules.items()):
+        if module is not None and (name == package or name.startswith(prefix)):
+            if module in _originals:
+                untrace(module)
 
-    def _log_return(self, return_value, instance, thread_id):
-        _output(self._return_format.format(thread=thread_id,
-                                           instance_id=instance,
-                                           return_value=return_value))
 
-    def _log_exception(self, instance, thread_id):
-        _output(self._exception_format.format(thread=thread_id,
-                                              instance_id=instance))
-        _output(traceback.format_exc())
+class _TracingImportHook(object):
+    """
+    Meta path finder tracing the modules of a package after they are executed. Finding the module
+    is left to the other finders, only the loader is wrapped.
+    """
+    def __init__(self, package, name_filter, options):
+        self.package = package
+        self.name_filter = name_filter
+        self.options = options
+        self._prefix = package + '.'
 
+    def covers(self, name):
+        return name == self.package or name.startswith(self._prefix)
 
-class _TestCallTraceDecorator(unittest.TestCase):
-    def __init__(self, methodName='runTest'):
-        super(_TestCallTraceDecorator, self).__init__(methodName)
+    def find_spec(self, fullname, path, target=None):
+        if not self.covers(fullname):
+            return None
+        for finder in sys.meta_path:
+            if finder is self or not hasattr(finder, 'find_spec'):
+                continue
+            spec = finder.find_spec(fullname, path, target)
+            if spec is not None:
+                if hasattr(spec.loader, 'exec_module'):
+                    spec.loader = _TracingLoader(spec.loader, self)
+                return spec
+        return None
 
-        # Prevent requiring mock for normal use
-        import mock
-        self._mock = mock
 
-        self._original_output = None
+class _TracingLoader(object):
+    """
+    Wraps a loader to trace the module after executing it.
+    """
+    def __init__(self, loader, hook):
+        self._loader = loader
+        self._hook = hook
 
-        self.maxDiff = None
+    def create_module(self, spec):
+        return self._loader.create_module(spec)
 
-    def setUp(self):
-        global _output
-        self._original_output = _output
-        _output = self._mock.MagicMock()
+    def exec_module(self, module):
+        self._loader.exec_module(module)
+        _trace_module(module, self._hook.name_filter, self._hook.options)
 
-    def tearDown(self):
-        global _output
-        _output = self._original_output
+    def __getattr__(self, name):
+        return getattr(self._loader, name)
 
-    def test_function_decorating(self):
-        @trace
-        def _test_func(a, b, c, d=34):
-            return a+b+c+d
 
-        ret = _test_func(1, 2, c=3)
-        self.assertEqual(ret, 40)
+_enabled = True
 
-        thread_id = id(threading.current_thread())
-        expected = [self._mock.call('Thread{{{}}}:_test_func(a=1, b=2, c=3)'.format(thread_id)),
-                    self._mock.call('Thread{{{}}}:_test_func returned 40'.format(thread_id))]
-        self.assertListEqual(_output.mock_calls, expected)
 
-    def test_method_decorating_old_style_class(self):
-        class _TestClass:
-            @trace
-            def test_method(self, a, b, c, d=34):
-                return a+b+c+d
+def enable(obj=None):
+    """
+    Enable tracing again after disable().
 
-        tc = _TestClass()
-        ret = tc.test_method(1, 2, c=3)
-        self.assertEqual(ret, 40)
+    :param obj: Traced function, method or class to enable. None to enable tracing globally. Tracers
+                disabled individually stay disabled.
+    """
+    _set_enabled(obj, True)
 
-        thread_id = id(threading.current_thread())
-        expected = [self._mock.call('Thread{{{}}}:[{}].test_method(self={}, a=1, b=2, c=3)'
-                                    .format(thread_id, id(tc), str(tc))),
-                    self._mock.call('Thread{{{}}}:[{}].test_method returned 40'
-                                    .format(thread_id, id(tc)))]
-        self.assertListEqual(_output.mock_calls, expected)
 
-    def test_method_decorating_new_style_class(self):
-        class _TestClass(object):
-            @trace
-            def test_method(self, a, b, c, d=34):
-                return a+b+c+d
+def disable(obj=None):
+    """
+    Disable tracing without removing the tracers. Calls to disabled tracers are passed on directly.
 
-        tc = _TestClass()
-        ret = tc.test_method(1, 2, c=3)
-        self.assertEqual(ret, 40)
+    :param obj: Traced function, method or class to disable. None to disable tracing globally.
+    """
+    _set_enabled(obj, False)
 
-        thread_id = id(threading.current_thread())
-        expected = [self._mock.call('Thread{{{}}}:[{}].test_method(self={}, a=1, b=2, c=3)'
-                                    .format(thread_id, id(tc), str(tc))),
-                    self._mock.call('Thread{{{}}}:[{}].test_method returned 40'
-                                    .format(thread_id, id(tc)))]
-        self.assertListEqual(_output.mock_calls, expected)
 
-    def test_class_decorating_old_style(self):
-        @trace
-        class _TestClass:
-            def test_method(self, a, b, c, d=34):
-                return a+b+c+d
+def is_enabled(obj=None):
+    """
+    :param obj: Traced function, method or class. None to check the global state.
+    :return: True if tracing is enabled globally and for all tracers of obj.
+    """
+    if obj is None:
+        return _enabled
+    return _enabled and all(tracer.enabled for tracer in _tracers_of(obj))
 
-            def test_method2(self, e, f):
-                return e+f
 
-        tc = _TestClass()
+def _set_enabled(obj, enabled):
+    global _enabled
+    if obj is None:
+        _enabled = enabled
+        tracers = list(_tracers)
+    else:
+        tracers = _tracers_of(obj)
+        for tracer in tracers:
+            tracer.enabled = enabled
+    for tracer in tracers:
+        tracer.update_active()
 
-        ret = tc.test_method(2, 3, 4)
-        self.assertEqual(ret, 43)
 
-        ret = tc.test_method2(5, 6)
-        self.assertEqual(ret, 11)
+def set_sampling(obj, every=None, rate=None):
+    """
+    Only trace part of the calls to a traced function, method or class. Calls that are not sampled
+    are neither logged nor timed. Without every and rate all calls are traced again.
 
-        thread_id = id(threading.current_thread())
-        expected = [self._mock.call('Thread{{{}}}:_TestClass[{}].test_method(self={}, a=2, b=3, c=4)'
-                                    .format(thread_id, id(tc), str(tc))),
-                    self._mock.call('Thread{{{}}}:_TestClass[{}].test_method returned 43'
-                                    .format(thread_id, id(tc))),
-                    self._mock.call('Thread{{{}}}:_TestClass[{}].test_method2(self={}, e=5, f=6)'
-                                    .format(thread_id, id(tc), str(tc))),
-                    self._mock.call('Thread{{{}}}:_TestClass[{}].test_method2 returned 11'
-                                    .format(thread_id, id(tc)))]
-        self.assertListEqual(_output.mock_calls, expected)
+    :param every: Trace 1 in every N calls.
+    :param rate: Trace calls with this probability (0.0 - 1.0).
+    """
+    for tracer in _tracers_of(obj):
+        tracer.set_sampling(every, rate)
 
-    def test_class_decorating_new_style(self):
-        @trace
-        class _TestClass(object):
-            def test_method(self, a, b, c, d=34):
-                return a+b+c+d
 
-            def test_method2(self, e, f):
-                return e+f
+def _tracers_of(obj):
+    """
+    Find the tracers of a traced function, method or class.
+    """
+    if inspect.ismethod(obj):
+        obj = obj.__func__
+    if inspect.isclass(obj):
+        tracers = []
+        for value in vars(obj).values():
+            tracer = _attribute_tracer(value)
+            if tracer is not None:
+                tracers.append(tracer)
+            elif isinstance(value, (_TracedProperty, _TracedDescriptor)):
+                tracers.extend(value.tracers)
+        return tracers
 
-        tc = _TestClass()
+    tracer = _attribute_tracer(obj)
+    if tracer is None:
+        raise TypeError('Object is not traced.')
+    return [tracer]
 
-        ret = tc.test_method(2, 3, 4)
-        self.assertEqual(ret, 43)
 
-        ret = tc.test_method2(5, 6)
-        self.assertEqual(ret, 11)
+def _attribute_tracer(value):
+    """
+    Get the tracer of a traced function, static method or class method.
 
-        thread_id = id(threading.current_thread())
-        expected = [self._mock.call('Thread{{{}}}:_TestClass[{}].test_method(self={}, a=2, b=3, c=4)'
-                                    .format(thread_id, id(tc), str(tc))),
-                    self._mock.call('Thread{{{}}}:_TestClass[{}].test_method returned 43'
-                                    .format(thread_id, id(tc))),
-                    self._mock.call('Thread{{{}}}:_TestClass[{}].test_method2(self={}, e=5, f=6)'
-                                    .format(thread_id, id(tc), str(tc))),
-                    self._mock.call('Thread{{{}}}:_TestClass[{}].test_method2 returned 11'
-                                    .format(thread_id, id(tc)))]
-        self.assertListEqual(_output.mock_calls, expected)
+    :return: The tracer or None if value is not traced.
+    """
+    value = getattr(value, '__func__', value)
+    tracer = getattr(value, 'tracer', None)
+    return tracer if isinstance(tracer, _FunctionTracer) else None
 
-    def test_prevent_recursion_str(self):
-        """
-        If __str__ is present and traced or calls a traced method, a loop
-        can occur. This should be prevented.
-        """
-        @trace
-        class _TestClass(object):
-            def method(self):
+
+class _ThreadState(object):
+    """
+    Tracing state of a single thread. Created once per thread and cached in thread local storage.
+    """
+    __slots__ = ('thread_id', 'in_safe_str', 'depth', 'call_id', 'pending')
+
+    def __init__(self):
+        # The id of the thread object is shown in the traces
+        self.thread_id = id(threading.current_thread())
+        self.in_safe_str = 0
+        # Traced calls in progress and the id of the innermost. Generators and coroutines are left
+        # out, as they can be suspended and resumed at any depth.
+        self.depth = 0
+        self.call_id = None
+        # Calls in progress not written yet, outermost first, see set_slow_threshold()
+        self.pending = []
+
+
+_local = threading.local()
+
+
+def _thread_state():
+    try:
+        return _local.state
+    except AttributeError:
+        state = _local.state = _ThreadState()
+        return state
+
+
+def _safe_str(obj, limited=True):
+    """
+    Get string representations for objects without causing recursions in traced objects. Goes
+    together with _check_recursion_loop().
+
+    :param limited: Apply the format limits, see set_format_limits().
+    """
+    state = _thread_state()
+    state.in_safe_str += 1
+    try:
+        return _formatter.format(obj) if limited else str(obj)
+    except Exception:
+        # Like a broken __str__, or infinite recursion, which should no longer happen
+        return '<unprintable {} at 0x{:x}>'.format(type(obj).__name__, id(obj))
+    finally:
+        state.in_safe_str -= 1
+
+
+def set_format_limits(max_length=None, max_items=None, max_depth=None):
+    """
+    Limit the size of formatted arguments, so formatting costs the same no matter how large the
+    argument is. Limits that are not given are left unchanged.
+
+    :param max_length: Maximum number of characters per argument. Defaults to 500.
+    :param max_items: Maximum number of items shown of lists, tuples, sets and dicts. Defaults to
+                      20.
+    :param max_depth: Maximum nesting of containers shown. Defaults to 4.
+    """
+    if max_length is not None:
+        _formatter.max_length = max(max_length, 4)
+    if max_items is not None:
+        _formatter.max_items = max_items
+    if max_depth is not None:
+        _formatter.max_depth = max_depth
+
+
+def register_formatter(cls, formatter):
+    """
+    Use a custom function to format arguments of a type, including its subclasses. The result is
+    still cut off at the maximum length.
+
+    :param cls: Type to format.
+    :param formatter: Function taking the object and returning a string, or None to remove a
+                      custom formatter.
+    """
+    _formatter.register(cls, formatter)
+
+
+class _ArgumentFormatter(object):
+    """
+    Bounded version of str(), in the spirit of reprlib. The common builtin types are formatted the
+    same as str() would, but only up to a maximum length, number of items and depth. So are deques,
+    named tuples, the dicts of the collections module and subclasses of the builtin containers that
+    keep their representation. Numpy arrays are shown as their shape and dtype only. Other objects
+    are converted with str() and cut off.
+    """
+    _empty = {list: '[]', tuple: '()', dict: '{}', set: 'set()', frozenset: 'frozenset()'}
+    _elided = {list: '[...]', tuple: '(...)', dict: '{...}', set: '{...}',
+               frozenset: 'frozenset({...})'}
+
+    def __init__(self, max_length=500, max_items=20, max_depth=4):
+        self.max_length = max_length
+        self.max_items = max_items
+        self.max_depth = max_depth
+        self._custom = {}
+        self._custom_lookup = {}
+
+    def register(self, cls, formatter):
+        if formatter is None:
+            self._custom.pop(cls, None)
+        else:
+            self._custom[cls] = formatter
+        self._custom_lookup = {}
+
+    def format(self, obj):
+        """
+        Like str(obj), but bounded.
+        """
+        return self._format(obj, 0, True)
+
+    def _format(self, obj, depth, top):
+        cls = type(obj)
+        if self._custom:
+            custom = self._find_custom(cls)
+            if custom is not None:
+                return self._truncate(custom(obj))
+
+        if cls is str:
+            if top:
+                return self._truncate(obj)
+            return self._truncate(repr(obj[:self.max_length]))
+        elif cls is int:
+            # Converting huge numbers to decimal takes quadratic time
+            if obj.bit_length() > self.max_length * 3:
+                return '<int of {} bits>'.format(obj.bit_length())
+            return self._truncate(repr(obj))
+        elif cls in (float, bool, type(None)):
+            return repr(obj)
+        elif cls in (bytes, bytearray):
+            return self._truncate(repr(obj[:self.max_length]))
+        elif cls in self._empty:
+            return self._format_container(obj, cls, depth)
+        elif cls.__module__ == 'numpy' and getattr(obj, 'ndim', 0) > 0:
+            # Only arrays, scalars like numpy.float64 have ndim 0 and are shown by value
+            return '{}(shape={}, dtype={})'.format(cls.__name__, obj.shape, obj.dtype)
+        elif isinstance(obj, self._container_types):
+            text = self._format_derived_container(obj, cls, depth)
+            if text is not None:
+                return text
+        if top:
+            return self._truncate(str(obj))
+        else:
+            return self._truncate(repr(obj))
+
+    def _format_container(self, obj, cls, depth):
+        if not obj:
+            return self._empty[cls]
+        if depth >= self.max_depth:
+            return self._elided[cls]
+
+        if cls is dict:
+            items = ('{}: {}'.format(self._format(key, depth + 1, False),
+                                     self._format(value, depth + 1, False))
+                     for key, value in itertools.islice(obj.items(), self.max_items))
+        else:
+            items = (self._format(item, depth + 1, False)
+                     for item in itertools.islice(obj, self.max_items))
+
+        if cls is list:
+            start, end = '[', ']'
+        elif cls is tuple:
+            start, end = '(', ',)' if len(obj) == 1 else ')'
+        elif cls is frozenset:
+            start, end = 'frozenset({', '})'
+        else:
+            start, end = '{', '}'
+        return self._truncate(self._join(start, items, len(obj), end))
+
+    _container_types = (list, tuple, dict, set, frozenset, collections.deque)
+
+    def _format_derived_container(self, obj, cls, depth):
+        """
+        Format the containers that are not exactly builtin types without converting them whole.
+
+        :return: The text, or None if the class has its own representation.
+        """
+        if cls is collections.deque:
+            text = 'deque(' + self._format_container(obj, list, depth)
+            if obj.maxlen is not None:
+                text += ', maxlen={}'.format(obj.maxlen)
+            return self._truncate(text + ')')
+        elif isinstance(obj, tuple) and hasattr(obj, '_fields'):
+            # Named tuple
+            fields = ('{}={}'.format(name, self._format(value, depth + 1, False))
+                      for name, value in itertools.islice(zip(obj._fields, obj), self.max_items))
+            return self._truncate(self._join(cls.__name__ + '(', fields, len(obj), ')'))
+        elif cls in (collections.OrderedDict, collections.Counter):
+            if not obj:
+                return cls.__name__ + '()'
+            if depth >= self.max_depth:
+                return cls.__name__ + '({...})'
+            if cls is collections.OrderedDict and sys.version_info < (3, 12):
+                # Shown as a list of pairs before Python 3.12
+                pairs = ('({}, {})'.format(self._format(key, depth + 2, False),
+                                           self._format(value, depth + 2, False))
+                         for key, value in itertools.islice(obj.items(), self.max_items))
+                return self._truncate(self._join('OrderedDict([', pairs, len(obj), '])'))
+            return self._truncate(cls.__name__ + '(' + self._format_container(obj, dict, depth) +
+                                  ')')
+        elif cls is collections.defaultdict:
+            return self._truncate('defaultdict({}, {})'.format(
+                self._format(obj.default_factory, depth + 1, False),
+                self._format_container(obj, dict, depth)))
+
+        for base in self._empty:
+            if isinstance(obj, base):
+                if cls.__repr__ is not base.__repr__ or cls.__str__ is not base.__str__:
+                    return None
+                return self._format_container(obj, base, depth)
+        return None
+
+    def _join(self, start, items, count, end):
+        parts = []
+        length = 0
+        for item in items:
+            parts.append(item)
+            length += len(item) + 2
+            if length > self.max_length:
+                break
+        if len(parts) < count:
+            parts.append('...')
+        return start + ', '.join(parts) + end
+
+    def _truncate(self, text):
+        if len(text) > self.max_length:
+            return text[:self.max_length - 3] + '...'
+        return text
+
+    def _find_custom(self, cls):
+        try:
+            return self._custom_lookup[cls]
+        except KeyError:
+            pass
+        found = None
+        for base in inspect.getmro(cls):
+            if base in self._custom:
+                found = self._custom[base]
+                break
+        self._custom_lookup[cls] = found
+        return found
+
+
+_formatter = _ArgumentFormatter()
+
+
+def _check_recursion_loop():
+    """
+    Check that we are causing an infinite loop. This happens when str() uses __str__() which
+    calls another traced method.
+
+    This only works if this module consistently uses _safe_str() instead of str()
+
+    :return: True if we are looping.
+    """
+    return _thread_state().in_safe_str > 0
+
+
+def _output(msg):
+    print('CallTracing:', msg)
+
+
+# Overflow policies for the asynchronous writer
+BLOCK = 'block'
+DROP_OLDEST = 'drop_oldest'
+DROP_NEWEST = 'drop_newest'
+
+_writer = None
+_snapshot_arguments = False
+
+
+def start_async_output(queue_size=10000, overflow=BLOCK, batch_size=256, snapshot=False):
+    """
+    Write traces from a background thread. Traced calls only append raw records to a bounded queue
+    which is drained in batches by a dedicated writer thread. The writer thread formats the records.
+
+    As formatting is deferred, arguments are shown as they are at the time of writing. Mutable
+    builtin containers (list, dict, set and bytearray) can be copied at call time by setting
+    snapshot. Other objects are always kept by reference.
+
+    :param queue_size: Maximum number of traces waiting to be written.
+    :param overflow: What to do when the queue is full: BLOCK the traced thread until there is room,
+                     DROP_OLDEST to discard the oldest waiting trace or DROP_NEWEST to discard the
+                     new trace. Dropped traces are counted, see dropped_count().
+    :param batch_size: Maximum number of traces written per batch.
+    :param snapshot: Copy mutable builtin containers passed as arguments at call time.
+    """
+    global _writer, _snapshot_arguments
+    stop_async_output()
+    _snapshot_arguments = snapshot
+    _writer = _AsyncWriter(queue_size, overflow, batch_size)
+    _writer.start()
+
+
+def stop_async_output():
+    """
+    Write all pending traces and return to synchronous output.
+    """
+    global _writer, _snapshot_arguments
+    writer, _writer = _writer, None
+    _snapshot_arguments = False
+    if writer is not None:
+        writer.stop()
+
+
+def flush():
+    """
+    Wait until all traces queued so far have been written and flush the sink.
+    """
+    writer = _writer
+    if writer is not None:
+        writer.flush()
+    _flush_sinks()
+
+
+def dropped_count():
+    """
+    Number of traces dropped by the asynchronous writer because its queue was full.
+    """
+    writer = _writer
+    return writer.dropped if writer is not None else 0
+
+
+def set_sink(sink):
+    """
+    Select where traces are written to. The default sink prints traces as text.
+
+    :param sink: New sink, or None to return to the default text output.
+    :return: List of the previous sinks. They are flushed, but not closed.
+    """
+    global _sinks
+    flush()
+    previous, _sinks = list(_sinks), (sink if sink is not None else _TextSink(),)
+    return previous
+
+
+def add_sink(sink):
+    """
+    Write traces to an additional sink.
+    """
+    global _sinks
+    flush()
+    _sinks = _sinks + (sink,)
+
+
+def remove_sink(sink):
+    """
+    Stop writing traces to a sink. The sink is flushed, but not closed.
+    """
+    global _sinks
+    flush()
+    _sinks = tuple(s for s in _sinks if s is not sink)
+
+
+def _flush_sinks():
+    for sink in _sinks:
+        sink.flush()
+
+
+def _shutdown():
+    stop_async_output()
+    _flush_sinks()
+
+
+atexit.register(_shutdown)
+
+
+def _after_fork_in_child():
+    global _writer
+    # The writer thread does not exist in the child, the parent writes the traces it queued
+    writer = _writer
+    if writer is not None:
+        _writer = writer.forked()
+    _traceback_limiter.after_fork()
+    if _instances is not None:
+        _instances.after_fork()
+    for sink in _sinks:
+        sink.after_fork()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
+
+
+def _emit(record):
+    writer = _writer
+    if writer is None:
+        _write_record(record)
+    else:
+        writer.put(record)
+
+
+def _write_record(record):
+    for sink in _sinks:
+        try:
+            sink.write(record)
+        except Exception:
+            # Tracing must not change the behaviour of the traced code, nor stop the writer thread
+            _report_sink_error(sink)
+
+
+# Sinks that failed before, their errors are only reported once
+_failed_sinks = weakref.WeakSet()
+
+
+def _report_sink_error(sink):
+    if sink in _failed_sinks:
+        return
+    _failed_sinks.add(sink)
+    print('calltrace: {!r} failed, further errors of this sink are not reported'.format(sink),
+          file=sys.stderr)
+    traceback.print_exc()
+
+
+# Trace record kinds
+_CALL = 0
+_RETURN = 1
+_EXCEPTION = 2
+
+_kind_names = {_CALL: 'call', _RETURN: 'return', _EXCEPTION: 'exception'}
+
+
+class Sink(object):
+    """
+    Base class for sinks. Sinks receive the raw records of all traces. By default the record is
+    converted to a dict of structured fields and passed to emit():
+    - event: 'call', 'return' or 'exception'
+    - function, class: Name of the traced function and its class (or None)
+    - instance: Id of self, or None
+    - thread, task: Id of the thread and the asyncio task (or None)
+    - depth: Number of traced calls in progress in the same thread when this call was made.
+      Generators and coroutines do not count, except that coroutines count for the coroutines
+      they await in the same asyncio task.
+    - call_id, parent_id: Unique id of the call, shared by its call and return or exception
+      records, and the id of the traced call it was made from (or None)
+    - timestamp: Monotonic timestamp in ns
+    - args: For calls, ordered dict of argument names and values
+    - return_value: For returns, the value returned, its type or None, see the returns option of
+      trace()
+    - exception, traceback: For exceptions, the exception and its formatted traceback. Depending on
+      the exceptions option of trace() and the traceback limit, the exception can be None and the
+      traceback replaced by a summary or None.
+    - duration: For returns and exceptions of timed calls, the duration in ns (otherwise None)
+
+    Values are the actual objects, not copies or strings. With start_async_output() sinks are
+    called from the writer thread. Exceptions raised by sinks are not passed on to the traced code,
+    the first one of each sink is printed to stderr.
+    """
+    def write(self, record):
+        self.emit(record.fields())
+
+    def emit(self, event):
+        raise NotImplementedError()
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+    def after_fork(self):
+        """
+        Called in the child process after a fork, before it continues tracing. Only the forking
+        thread exists in the child, locks held by other threads of the parent stay locked.
+        """
+        pass
+
+
+class _TextSink(Sink):
+    """
+    Default sink, printing traces as text.
+    """
+    def write(self, record):
+        for msg in record.tracer.render(record):
+            _output(msg)
+
+
+_sinks = (_TextSink(),)
+
+
+class LoggingSink(Sink):
+    """
+    Send traces to a logger of the standard logging module. The message is the normal text trace,
+    which is only formatted if a handler needs it. The structured fields are attached to the log
+    record as its calltrace attribute.
+    """
+    def __init__(self, logger='calltrace', level=logging.DEBUG):
+        self._logger = logging.getLogger(logger) if isinstance(logger, str) else logger
+        self._level = level
+
+    def write(self, record):
+        if self._logger.isEnabledFor(self._level):
+            self._logger.log(self._level, '%s', _RenderedRecord(record),
+                             extra={'calltrace': record.fields()})
+
+
+class _RenderedRecord(object):
+    """
+    Renders the text of a record when converted to str.
+    """
+    __slots__ = ('_record',)
+
+    def __init__(self, record):
+        self._record = record
+
+    def __str__(self):
+        return '\n'.join(self._record.tracer.render(self._record))
+
+
+class JsonLinesSink(Sink):
+    """
+    Write traces as JSON objects, one per line, containing the structured fields. Values that are
+    not supported by JSON are converted to strings.
+
+    Lines are collected in a buffer of about buffer_size bytes before they are written. Like
+    BinarySink, a process forked while writing leaves the file to its parent and stops writing.
+    """
+    def __init__(self, path, buffer_size=1 << 16):
+        self._buffer_size = buffer_size
+        self._lock = threading.Lock()
+        # Unbuffered, so a forked child can drop the buffer of its parent
+        self._file = io.open(path, 'wb', buffering=0)
+        self._buffer = bytearray()
+
+    def emit(self, event):
+        try:
+            text = json.dumps(event, default=_safe_str)
+        except (TypeError, ValueError):
+            # Keys JSON does not support, like tuples, or circular references
+            text = json.dumps(_formatted_fields(event), default=_safe_str)
+        line = (text + '\n').encode('utf-8')
+        with self._lock:
+            if self._file is None:
+                return
+            self._buffer += line
+            if len(self._buffer) >= self._buffer_size:
+                self._write_buffer()
+
+    def _write_buffer(self):
+        data = bytes(self._buffer)
+        del self._buffer[:]
+        while data:
+            data = data[self._file.write(data):]
+
+    def flush(self):
+        with self._lock:
+            if self._file is not None:
+                self._write_buffer()
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._write_buffer()
+                self._file.close()
+                self._file = None
+
+    def after_fork(self):
+        # The lock may have been held by another thread of the parent
+        self._lock = threading.Lock()
+        self._buffer = bytearray()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def _formatted_fields(event):
+    """
+    Replace the argument values, return value and exception of structured fields by their
+    formatted text.
+    """
+    event = dict(event)
+    if event.get('args') is not None:
+        event['args'] = collections.OrderedDict((name, _safe_str(value))
+                                                for name, value in event['args'].items())
+    for name in ('return_value', 'exception'):
+        if event.get(name) is not None:
+            event[name] = _safe_str(event[name])
+    return event
+
+
+class RingBufferSink(Sink):
+    """
+    Keep the latest traces in memory. Only the records are stored, formatting is done when the
+    traces are requested.
+    """
+    def __init__(self, capacity=1000):
+        self._records = collections.deque(maxlen=capacity)
+
+    def write(self, record):
+        self._records.append(record)
+
+    def events(self):
+        """
+        :return: List of dicts with the structured fields of the stored traces, oldest first.
+        """
+        return [record.fields() for record in list(self._records)]
+
+    def lines(self):
+        """
+        :return: List of the stored traces as text, oldest first.
+        """
+        return [line for record in list(self._records) for line in record.tracer.render(record)]
+
+    def clear(self):
+        self._records.clear()
+
+
+class FlightRecorder(Sink):
+    """
+    Keep the last traces of each thread in memory without printing anything. The traces of a thread
+    are dumped as text when an exception escapes from its outermost traced call. They can also be
+    dumped on demand with dump(), or when receiving a signal, see install_signal().
+
+    Only the traceback of the escaping exception is formatted, not the tracebacks of every traced
+    call it passed through.
+
+    The traces of a thread are forgotten when its thread object is freed, so a later thread reusing
+    its id starts with an empty ring.
+    """
+    def __init__(self, capacity=100, output=None, dump_on_exception=True):
+        """
+        :param capacity: Number of traces to keep per thread.
+        :param output: Function called with each line of a dump, defaults to printing it.
+        :param dump_on_exception: Dump when an exception escapes the outermost traced call.
+        """
+        self._capacity = capacity
+        self._output = output
+        self._dump_on_exception = dump_on_exception
+        self._rings = {}
+        self._threads = {}
+        self._lock = threading.Lock()
+
+    def write(self, record):
+        ring = self._rings.get(record.thread_id)
+        if ring is None:
+            ring = self._add_ring(record.thread_id)
+        ring.append(record)
+
+        if self._dump_on_exception and record.kind == _EXCEPTION and record.depth == 0:
+            self._dump_ring(record.thread_id, ring, 'exception')
+
+    def after_fork(self):
+        # The lock may have been held by another thread of the parent, only the forking thread
+        # exists in the child
+        self._lock = threading.Lock()
+        thread_id = id(threading.current_thread())
+        self._rings = dict((key, ring) for key, ring in self._rings.items() if key == thread_id)
+        self._threads = dict((key, ref) for key, ref in self._threads.items() if key == thread_id)
+
+    def dump(self, thread_id=None, reason='request'):
+        """
+        Dump the traces kept for one thread, or for all threads. The dumped traces are forgotten.
+
+        :param thread_id: Id of the thread object, as shown in the traces.
+        """
+        with self._lock:
+            rings = list(self._rings.items())
+        for ring_thread_id, ring in rings:
+            if thread_id is None or thread_id == ring_thread_id:
+                self._dump_ring(ring_thread_id, ring, reason)
+
+    def install_signal(self, signum):
+        """
+        Dump all threads when receiving a signal, for example signal.SIGUSR1. Must be called from
+        the main thread.
+
+        :return: The previous signal handler.
+        """
+        import signal
+        return signal.signal(signum, lambda received, frame: self.dump(reason='signal'))
+
+    def _add_ring(self, thread_id):
+        thread = threading.current_thread()
+        if id(thread) != thread_id:
+            # Written by the asynchronous writer thread
+            thread = next((t for t in threading.enumerate() if id(t) == thread_id), None)
+        ring = _Ring(self._capacity)
+        if thread is None:
+            # The thread already ended, its id may be reused at any time
+            return ring
+        with self._lock:
+            if thread_id in self._rings:
+                return self._rings[thread_id]
+            self._threads[thread_id] = weakref.ref(thread, functools.partial(self._forget,
+                                                                             thread_id))
+            self._rings[thread_id] = ring
+        return ring
+
+    def _forget(self, thread_id, ref):
+        with self._lock:
+            # The id may already belong to a new thread
+            if self._threads.get(thread_id) is ref:
+                del self._threads[thread_id]
+                del self._rings[thread_id]
+
+    def _dump_ring(self, thread_id, ring, reason):
+        records = ring.take()
+        if not records:
+            return
+        output = self._output if self._output is not None else _output
+        output('Flight recorder dump of Thread{{{}}} ({}), last {} traces:'
+               .format(thread_id, reason, len(records)))
+        last = len(records) - 1
+        for index, record in enumerate(records):
+            # Only the final exception gets a full traceback
+            for line in record.tracer.render(record, with_traceback=index == last):
+                output(line)
+
+
+class _Ring(object):
+    """
+    Preallocated ring buffer. Appending is not locked, as each ring is only written by a single
+    thread at a time.
+    """
+    __slots__ = ('_items', '_next', '_size')
+
+    def __init__(self, capacity):
+        self._items = [None] * capacity
+        self._next = 0
+        self._size = 0
+
+    def append(self, item):
+        items = self._items
+        items[self._next] = item
+        self._next = (self._next + 1) % len(items)
+        if self._size < len(items):
+            self._size += 1
+
+    def take(self):
+        """
+        Remove and return all items, oldest first.
+        """
+        items = self._items
+        start = (self._next - self._size) % len(items)
+        taken = [items[(start + i) % len(items)] for i in range(self._size)]
+        self._items = [None] * len(items)
+        self._next = 0
+        self._size = 0
+        return taken
+
+
+class CallTreeSink(Sink):
+    """
+    Rebuild the call trees of all threads from the traces and merge them, so every path of traced
+    calls appears once with its number of calls and their inclusive and exclusive time. Exclusive
+    time leaves out the time spent in traced calls made from the call itself.
+
+    Times are taken from the trace timestamps, so timing does not need to be enabled, but they
+    include the overhead of tracing. Calls still in progress are not counted. Generators and
+    coroutines do not nest other calls, only the coroutines awaited in the same asyncio task, see
+    the depth field of Sink.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._root = _CallTreeNode(None)
+        self._pending = {}
+        self._active = collections.Counter()
+        self._totals = {}
+
+    def after_fork(self):
+        # The lock may have been held by another thread of the parent
+        self._lock = threading.Lock()
+
+    def write(self, record):
+        name = record.tracer.qualified_name
+        key = (record.thread_id, name)
+        with self._lock:
+            if record.kind == _CALL:
+                parent = self._pending.get(record.parent_id)
+                node = (parent.node if parent is not None else self._root).child(name)
+                self._pending[record.call_id] = _PendingCall(node, record.timestamp)
+                self._active[key] += 1
+                return
+
+            pending = self._pending.pop(record.call_id, None)
+            if pending is None:
+                # Called before this sink was added
+                return
+            elapsed = record.timestamp - pending.start
+            exclusive = elapsed - pending.nested
+            pending.node.add(elapsed, exclusive)
+            parent = self._pending.get(record.parent_id)
+            if parent is not None:
+                parent.nested += elapsed
+
+            # Recursive calls are only added to the inclusive time of the outermost call
+            total = self._totals.get(name)
+            if total is None:
+                total = self._totals[name] = _CallTreeNode(name)
+            self._active[key] -= 1
+            if self._active[key] > 0:
+                total.add(0, exclusive)
+            else:
+                del self._active[key]
+                total.add(elapsed, exclusive)
+
+    def totals(self):
+        """
+        :return: List of dicts with name, count, inclusive and exclusive time per function, summed
+                 over all paths it was called from, highest inclusive time first. Times are in
+                 nanoseconds.
+        """
+        with self._lock:
+            result = [{'name': node.name, 'count': node.count, 'inclusive': node.inclusive,
+                       'exclusive': node.exclusive} for node in self._totals.values()]
+        result.sort(key=lambda entry: entry['inclusive'], reverse=True)
+        return result
+
+    def format_tree(self):
+        """
+        :return: List of lines showing the merged call tree, children indented below their caller
+                 and sorted by inclusive time.
+        """
+        lines = []
+
+        def add(node, indent):
+            for child in node.sorted_children():
+                lines.append('{}{} count={} inclusive={} exclusive={}'.format(
+                    indent, child.name, child.count, _format_duration(child.inclusive),
+                    _format_duration(child.exclusive)))
+                add(child, indent + '  ')
+
+        with self._lock:
+            add(self._root, '')
+        return lines
+
+    def collapsed_stacks(self):
+        """
+        :return: List of lines in the collapsed stack format read by flame graph tools: the names
+                 on the path separated by semicolons, followed by the exclusive time in
+                 nanoseconds.
+        """
+        lines = []
+
+        def add(node, path):
+            for child in node.sorted_children():
+                child_path = path + (child.name,)
+                if child.count:
+                    lines.append('{} {}'.format(';'.join(child_path), child.exclusive))
+                add(child, child_path)
+
+        with self._lock:
+            add(self._root, ())
+        return lines
+
+    def clear(self):
+        """
+        Forget all calls, including those still in progress.
+        """
+        with self._lock:
+            self._root = _CallTreeNode(None)
+            self._pending.clear()
+            self._active.clear()
+            self._totals.clear()
+
+
+class _CallTreeNode(object):
+    """
+    Calls to a function made through the same path of traced calls.
+    """
+    __slots__ = ('name', 'count', 'inclusive', 'exclusive', 'children')
+
+    def __init__(self, name):
+        self.name = name
+        self.count = 0
+        self.inclusive = 0
+        self.exclusive = 0
+        self.children = {}
+
+    def child(self, name):
+        node = self.children.get(name)
+        if node is None:
+            node = self.children[name] = _CallTreeNode(name)
+        return node
+
+    def add(self, inclusive, exclusive):
+        self.count += 1
+        self.inclusive += inclusive
+        self.exclusive += exclusive
+
+    def sorted_children(self):
+        return sorted(self.children.values(), key=lambda node: node.inclusive, reverse=True)
+
+
+class _PendingCall(object):
+    """
+    Call in progress, with the time spent so far in traced calls made from it.
+    """
+    __slots__ = ('node', 'start', 'nested')
+
+    def __init__(self, node, start):
+        self.node = node
+        self.start = start
+        self.nested = 0
+
+
+class BinarySink(Sink):
+    """
+    Write traces to a compact binary file. Decode it with decode() or `python -m calltrace decode`.
+
+    Every traced function and every thread is written only once. After that each trace is a fixed
+    size header containing the kind of trace, the function, the thread, the instance, the asyncio
+    task, a monotonic timestamp and the duration if known. It is followed by the formatted
+    arguments, return value or traceback, unless payload is disabled.
+
+    Traces are collected in a buffer of buffer_size bytes before they are written. A process forked
+    while writing keeps the file of the parent, so the child stops writing, use ShardSink instead.
+    """
+    def __init__(self, path, payload=True, buffer_size=1 << 20):
+        self._payload = payload
+        self._buffer_size = buffer_size
+        self._lock = threading.Lock()
+        self._open(path)
+
+    def _open(self, path):
+        self.path = path
+        # Unbuffered, so a forked child can drop the buffer of its parent
+        self._file = io.open(path, 'wb', buffering=0)
+        self._buffer = bytearray(_BINARY_MAGIC)
+        self._sites = {}
+        self._threads = {}
+
+    def write(self, record):
+        tracer = record.tracer
+        if self._payload:
+            if record.kind == _CALL:
+                pargs, kwargs = record.args
+                payload = tracer.format_arguments(pargs, kwargs)
+            elif record.kind == _RETURN:
+                payload = tracer.format_return_value(record.value)
+            else:
+                payload = tracer.format_exception(record.value) or ''
+            payload = payload.encode('utf-8', 'replace')
+            length = len(payload)
+        else:
+            payload = b''
+            length = _BINARY_NO_PAYLOAD
+
+        instance = record.instance
+        kind = record.kind if instance is not None else record.kind | _BINARY_NO_INSTANCE
+        with self._lock:
+            if self._file is None:
+                return
+            site = self._sites.get(tracer)
+            if site is None:
+                site = self._define(self._sites, tracer, _BINARY_SITE,
+                                    tracer.name_format.encode('utf-8'), 0)
+            thread = self._threads.get(record.thread_id)
+            if thread is None:
+                thread = self._define(self._threads, record.thread_id, _BINARY_THREAD,
+                                      b'', record.thread_id)
+            duration = record.duration
+            self._buffer += _binary_header.pack(kind, site, thread, instance or 0,
+                                                record.task_id or 0, record.timestamp,
+                                                duration if duration is not None else -1, length)
+            self._buffer += payload
+            if len(self._buffer) >= self._buffer_size:
+                self._write_buffer()
+
+    def _define(self, index, key, kind, payload, instance):
+        number = len(index)
+        index[key] = number
+        self._buffer += _binary_header.pack(kind, number, number, instance, 0, 0, -1, len(payload))
+        self._buffer += payload
+        return number
+
+    def _write_buffer(self):
+        data = bytes(self._buffer)
+        del self._buffer[:]
+        while data:
+            data = data[self._file.write(data):]
+
+    def flush(self):
+        with self._lock:
+            if self._file is not None:
+                self._write_buffer()
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._write_buffer()
+                self._file.close()
+                self._file = None
+
+    def after_fork(self):
+        # The lock may have been held by another thread of the parent
+        self._lock = threading.Lock()
+        self._buffer = bytearray()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class ShardSink(BinarySink):
+    """
+    Write the traces of each process to its own binary file, a shard named after the process id.
+    Forked child processes, like the workers of a pool, continue in a shard of their own, so
+    processes never share a file. Combine the shards into a single stream ordered by time with
+    merge() or `python -m calltrace merge`.
+
+    Timestamps come from the monotonic clock, which is shared by all processes on a machine. The
+    traces of each shard show its process id, as thread ids may be the same in different
+    processes.
+    """
+    def __init__(self, directory, prefix='calltrace', payload=True, buffer_size=1 << 20):
+        """
+        :param directory: Directory to write the shards to.
+        :param prefix: Start of the shard file names, followed by the process id.
+        """
+        self._directory = directory
+        self._prefix = prefix
+        super(ShardSink, self).__init__(self._shard_path(), payload, buffer_size)
+
+    def _shard_path(self):
+        return os.path.join(self._directory, '{}.{}.bin'.format(self._prefix, os.getpid()))
+
+    def _open(self, path):
+        super(ShardSink, self)._open(path)
+        pid = os.getpid()
+        self._buffer += _binary_header.pack(_BINARY_PROCESS, 0, 0, pid, 0, 0, -1, 0)
+
+    def after_fork(self):
+        super(ShardSink, self).after_fork()
+        self._open(self._shard_path())
+
+
+_BINARY_MAGIC = b'CALLTRC\x01'
+_BINARY_SITE = 0x10
+_BINARY_THREAD = 0x11
+_BINARY_PROCESS = 0x12
+_BINARY_NO_INSTANCE = 0x80
+_BINARY_NO_PAYLOAD = 0xffffffff
+
+# kind, site, thread, instance, task (0 for none), timestamp, duration (-1 for none), payload length
+_binary_header = struct.Struct('<BIIQQqqI')
+
+
+def decode(path):
+    """
+    Read a file written by BinarySink.
+
+    :return: Generator of (timestamp in ns, message) in the same text format as normal output.
+    """
+    with io.open(path, 'rb') as f:
+        if f.read(len(_BINARY_MAGIC)) != _BINARY_MAGIC:
+            raise ValueError('Not a call trace file: {}'.format(path))
+
+        sites = {}
+        threads = {}
+        process = ''
+        while True:
+            header = f.read(_binary_header.size)
+            if len(header) < _binary_header.size:
+                return
+            (kind, site, thread, instance, task, timestamp, duration,
+             length) = _binary_header.unpack(header)
+            if length == _BINARY_NO_PAYLOAD:
+                payload = '...'
+            else:
+                payload = f.read(length).decode('utf-8', 'replace')
+
+            if kind == _BINARY_SITE:
+                sites[site] = payload
+                continue
+            elif kind == _BINARY_THREAD:
+                threads[thread] = instance
+                continue
+            elif kind == _BINARY_PROCESS:
+                process = 'Process{{{}}}:'.format(instance)
+                continue
+
+            if kind & _BINARY_NO_INSTANCE:
+                instance = None
+                kind &= ~_BINARY_NO_INSTANCE
+            prefix = '{}{}:{}'.format(process, _thread_label(threads[thread], task or None),
+                                      sites[site].format(instance_id=instance))
+            elapsed = _format_elapsed(duration if duration >= 0 else None)
+            if kind == _CALL:
+                yield timestamp, '{}({})'.format(prefix, payload)
+            elif kind == _RETURN:
+                yield timestamp, '{} returned {}{}'.format(prefix, payload, elapsed)
+            else:
+                yield timestamp, '{} raised an exception{}'.format(prefix, elapsed)
+                if length != _BINARY_NO_PAYLOAD and payload:
+                    yield timestamp, payload
+
+
+def merge(paths):
+    """
+    Combine files written by BinarySink or ShardSink into a single stream ordered by timestamp.
+
+    :param paths: Paths of the files, directories are searched for shards.
+    :return: Generator of (timestamp in ns, message), like decode().
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(sorted(os.path.join(path, name) for name in os.listdir(path)
+                                if name.endswith('.bin')))
+        else:
+            files.append(path)
+    return heapq.merge(*[decode(path) for path in files])
+
+
+class CaptureSink(Sink):
+    """
+    Record calls of selected functions with their arguments and results in a corpus file, to call
+    them again as a benchmark with replay() or `python -m calltrace replay`. Arguments and results
+    are pickled, calls with arguments that cannot be pickled are skipped. Methods are recorded with
+    self. Constructors, generators and coroutines, and functions that cannot be found again by
+    their module and qualified name, like nested functions, are not recorded.
+
+    Arguments are pickled when the sink receives the call. For functions that modify their
+    arguments, use start_async_output(snapshot=True) or synchronous output, and no slow call
+    threshold, which keeps calls back until they return.
+
+    Recording stops for a function after max_calls calls, and for all functions once the corpus
+    would grow beyond max_bytes. Calls are written when they return, at most max_pending calls wait
+    for their return, beyond that the oldest are skipped. That also drops calls whose return is
+    never seen, like calls of threads that never finish. The arguments of waiting calls count
+    towards max_bytes, calls that would not fit are skipped.
+    """
+    def __init__(self, path, include=None, exclude=None, max_calls=1000, max_bytes=64 << 20,
+                 max_pending=10000):
+        """
+        :param path: Path of the corpus file.
+        :param include: Patterns of names of functions to record, like 'Class.method', as for
+                        trace_module(). Defaults to all.
+        :param exclude: Patterns of names not to record.
+        """
+        self.path = path
+        self._filter = _NameFilter(include, exclude)
+        self._max_calls = max_calls
+        self._max_bytes = max_bytes
+        self._max_pending = max_pending
+        self._lock = threading.Lock()
+        self._file = io.open(path, 'wb')
+        self._file.write(_CAPTURE_MAGIC)
+        self._size = len(_CAPTURE_MAGIC)
+        self._sites = {}
+        # Calls waiting for their return, oldest first, and the size of their pickled arguments
+        self._pending = collections.OrderedDict()
+        self._pending_size = 0
+        self.recorded = 0
+        self.skipped = 0
+
+    def write(self, record):
+        if record.kind == _CALL:
+            site = self._sites.get(record.tracer, False)
+            if site is False:
+                site = self._define(record.tracer)
+            if (site is None or site.calls >= self._max_calls or self._file is None or
+                    self._size >= self._max_bytes):
+                return
+            try:
+                args = pickle.dumps(record.tracer.received_arguments(*record.args),
+                                    pickle.HIGHEST_PROTOCOL)
+            except Exception:
+                self.skipped += 1
+                return
+            site.calls += 1
+            with self._lock:
+                if self._size + self._pending_size + len(args) > self._max_bytes:
+                    self.skipped += 1
+                    return
+                self._pending[record.call_id] = site, args
+                self._pending_size += len(args)
+                if len(self._pending) > self._max_pending:
+                    _, (_, dropped) = self._pending.popitem(last=False)
+                    self._pending_size -= len(dropped)
+                    self.skipped += 1
+            return
+
+        with self._lock:
+            pending = self._pending.pop(record.call_id, None)
+            if pending is not None:
+                self._pending_size -= len(pending[1])
+        if pending is None:
+            return
+        site, args = pending
+        if record.kind == _RETURN:
+            result = None
+            if site.compare:
+                try:
+                    result = pickle.dumps(record.value, pickle.HIGHEST_PROTOCOL)
+                except Exception:
+                    # Timed, but not compared
+                    pass
+        else:
+            exc_type = record.value.type
+            result = exc_type.__name__ if exc_type is not None else None
+        self._append((_CAPTURE_CALL, site.index, args, record.kind == _RETURN, result))
+
+    def _define(self, tracer):
+        func = tracer.original
+        qualname = getattr(func, '__qualname__', '<locals>')
+        with self._lock:
+            site = self._sites.get(tracer, False)
+            if site is not False:
+                # Defined by another thread
+                return site
+            site = None
+            if (tracer.kind == _FUNCTION and not tracer.is_constructor and
+                    '<locals>' not in qualname and self._filter.selects(tracer.qualified_name)):
+                compare = tracer.capture_returns in (CAPTURE_TRUNCATED, CAPTURE_FULL)
+                site = _CaptureSite(len(self._sites), compare)
+                self._write_entry((_CAPTURE_FUNCTION, site.index, tracer.qualified_name,
+                                   func.__module__, qualname))
+            self._sites[tracer] = site
+        return site
+
+    def _append(self, entry):
+        with self._lock:
+            if self._write_entry(entry):
+                self.recorded += 1
+            else:
+                self.skipped += 1
+
+    def _write_entry(self, entry):
+        """
+        :return: True if written, False if the corpus is full or closed.
+        """
+        data = pickle.dumps(entry, pickle.HIGHEST_PROTOCOL)
+        if self._file is None or self._size + len(data) > self._max_bytes:
+            return False
+        self._file.write(data)
+        self._size += len(data)
+        return True
+
+    def flush(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.flush()
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def after_fork(self):
+        # Like BinarySink, the child stops recording
+        self._lock = threading.Lock()
+        self._file = None
+
+
+class _CaptureSite(object):
+    __slots__ = ('index', 'compare', 'calls')
+
+    def __init__(self, index, compare):
+        self.index = index
+        self.compare = compare
+        self.calls = 0
+
+
+_CAPTURE_MAGIC = b'CALLCAP\x01'
+# Pickled entries: (_CAPTURE_FUNCTION, index, name, module, qualified name) and (_CAPTURE_CALL,
+# index, pickled (pargs, kwargs), returned, pickled return value or exception type name or None)
+_CAPTURE_FUNCTION = 0
+_CAPTURE_CALL = 1
+
+
+def _read_corpus(path):
+    with io.open(path, 'rb') as f:
+        if f.read(len(_CAPTURE_MAGIC)) != _CAPTURE_MAGIC:
+            raise ValueError('Not a call corpus: {}'.format(path))
+        while True:
+            try:
+                yield pickle.load(f)
+            except (EOFError, pickle.UnpicklingError):
+                # End of the file, or of what a process wrote before it was killed
+                return
+
+
+def _find_function(module, qualname):
+    """
+    Find the original function of a recorded call, bypassing tracing.
+
+    :return: The function or None if it no longer exists.
+    """
+    try:
+        obj = importlib.import_module(module)
+        for name in qualname.split('.'):
+            obj = vars(obj)[name]
+    except (ImportError, KeyError, TypeError):
+        return None
+    tracer = _attribute_tracer(obj)
+    obj = tracer.original if tracer is not None else obj
+    obj = getattr(obj, '__func__', obj)
+    return obj if callable(obj) else None
+
+
+class StreamSink(Sink):
+    """
+    Publish traces on a Unix domain socket or a local TCP port. Any number of subscribers can
+    connect and disconnect at runtime, for example with `python -m calltrace tail <address>`.
+
+    A subscriber receives nothing until it sends a filter: a JSON object on a single line, with any
+    of these keys:
+    - functions: Glob or list of globs of function names like 'Class.method', or 'Class.*'
+    - thread: Id of the thread, as shown in the traces
+    - min_duration: Only returns and exceptions of timed calls that took at least this many
+      seconds
+    An empty object matches everything. Sending another filter replaces the previous one.
+
+    Filters are applied before a trace is formatted, traces nobody subscribed to are not formatted
+    at all. Matching traces are sent as lines of text. A background thread serves the sockets, a
+    subscriber that cannot keep up loses its oldest traces.
+
+    Anyone who can connect sees the arguments of the traced calls, so TCP sockets only listen on
+    loopback addresses unless allow_remote is set.
+    """
+    def __init__(self, address, queue_size=10000, allow_remote=False):
+        """
+        :param address: Path of a Unix domain socket, or (host, port) of a TCP socket. Use port 0
+                        to pick a free port, see the address attribute. A socket left behind at the
+                        path is replaced, other files are not.
+        :param queue_size: Maximum number of lines waiting to be sent per subscriber.
+        :param allow_remote: Allow listening on TCP addresses other than loopback addresses.
+        """
+        import socket
+        self._queue_size = queue_size
+        self._subscribers = ()
+        if isinstance(address, str):
+            if not _unlink_socket(address) and os.path.lexists(address):
+                raise OSError(errno.EEXIST, 'File exists and is not a socket', address)
+            self._listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        else:
+            if not allow_remote and not _is_loopback(address[0]):
+                raise ValueError('Not a loopback address: {!r}, use allow_remote to listen on '
+                                 'other addresses'.format(address[0]))
+            self._listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self._listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._listener.bind(address)
+        self._listener.listen(5)
+        self.address = self._listener.getsockname()
+        self._stopping = False
+        self._thread = threading.Thread(target=self._serve, name='CallTraceStream')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def write(self, record):
+        subscribers = self._subscribers
+        if not subscribers:
+            return
+        data = None
+        for subscriber in subscribers:
+            if subscriber.matches(record):
+                if data is None:
+                    data = ('\n'.join(record.tracer.render(record)) + '\n').encode(
+                        'utf-8', 'replace')
+                subscriber.pending.append(data)
+
+    def flush(self):
+        # Give the serving thread a moment to send what is pending
+        deadline = time.time() + 1.0
+        while (self._thread is not None and time.time() < deadline and
+               any(subscriber.waiting() for subscriber in self._subscribers)):
+            time.sleep(0.01)
+
+    def close(self):
+        """
+        Send the pending traces and disconnect all subscribers.
+        """
+        self._stopping = True
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def after_fork(self):
+        # The serving thread only exists in the parent, which keeps the sockets
+        self._thread = None
+        self._close_sockets(unlink=False)
+
+    def _close_sockets(self, unlink=True):
+        subscribers, self._subscribers = self._subscribers, ()
+        for subscriber in subscribers:
+            subscriber.socket.close()
+        self._listener.close()
+        if unlink and isinstance(self.address, str):
+            _unlink_socket(self.address)
+
+    def _serve(self):
+        import select
+        self._listener.setblocking(False)
+        try:
+            while not self._stopping:
+                subscribers = self._subscribers
+                readable, writable, _ = select.select(
+                    [self._listener] + [subscriber.socket for subscriber in subscribers],
+                    [subscriber.socket for subscriber in subscribers if subscriber.waiting()],
+                    [], 0.05)
+                for subscriber in subscribers:
+                    if subscriber.socket in readable and not subscriber.receive():
+                        self._remove(subscriber)
+                    elif subscriber.socket in writable and not subscriber.send():
+                        self._remove(subscriber)
+                if self._listener in readable:
+                    self._accept()
+            for subscriber in self._subscribers:
+                subscriber.send_all()
+        finally:
+            self._close_sockets()
+
+    def _accept(self):
+        import socket
+        try:
+            connection, _ = self._listener.accept()
+        except socket.error:
+            return
+        connection.setblocking(False)
+        self._subscribers = self._subscribers + (_Subscriber(connection, self._queue_size),)
+
+    def _remove(self, subscriber):
+        subscriber.socket.close()
+        self._subscribers = tuple(s for s in self._subscribers if s is not subscriber)
+
+
+def _unlink_socket(path):
+    """
+    Remove a Unix domain socket, leaving other files alone.
+
+    :return: True if a socket was removed.
+    """
+    import stat
+    try:
+        if not stat.S_ISSOCK(os.lstat(path).st_mode):
+            return False
+        os.unlink(path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        return False
+    return True
+
+
+def _is_loopback(host):
+    import ipaddress
+    import socket
+    try:
+        return all(ipaddress.ip_address(info[4][0]).is_loopback
+                   for info in socket.getaddrinfo(host or None, None, 0, socket.SOCK_STREAM,
+                                                  0, socket.AI_PASSIVE))
+    except (socket.error, ValueError):
+        return False
+
+
+class _Subscriber(object):
+    """
+    Connection of a StreamSink subscriber, with its filter and the lines waiting to be sent.
+    """
+    def __init__(self, connection, queue_size):
+        self.socket = connection
+        self.pending = collections.deque(maxlen=queue_size)
+        # Rest of partially sent lines, kept out of pending so an overflow cannot drop it
+        self._unsent = b''
+        self._received = b''
+        self._names = None
+        self._matching = {}
+        self._thread = None
+        self._min_duration = None
+        self._subscribed = False
+
+    def waiting(self):
+        """
+        :return: True if there is anything left to send.
+        """
+        return bool(self._unsent or self.pending)
+
+    def matches(self, record):
+        if not self._subscribed:
+            return False
+        if self._thread is not None and record.thread_id != self._thread:
+            return False
+        if self._min_duration is not None and (record.duration is None or
+                                               record.duration < self._min_duration):
+            return False
+        if self._names is None:
+            return True
+        tracer = record.tracer
+        matching = self._matching.get(tracer)
+        if matching is None:
+            matching = self._matching[tracer] = self._names.selects(tracer.qualified_name)
+        return matching
+
+    def receive(self):
+        """
+        Read filters sent by the subscriber.
+
+        :return: False if the connection was closed.
+        """
+        import socket
+        try:
+            data = self.socket.recv(4096)
+        except socket.error:
+            return False
+        if not data:
+            return False
+        self._received += data
+        while b'\n' in self._received:
+            line, self._received = self._received.split(b'\n', 1)
+            if line.strip():
+                self._set_filter(line)
+        return True
+
+    def _set_filter(self, line):
+        try:
+            spec = json.loads(line.decode('utf-8'))
+            names = spec.get('functions')
+            min_duration = spec.get('min_duration')
+            thread = spec.get('thread')
+            self._names = _NameFilter(names, None) if names else None
+            self._min_duration = int(min_duration * 1e9) if min_duration is not None else None
+            self._thread = int(thread) if thread is not None else None
+        except (ValueError, TypeError, AttributeError) as error:
+            self.pending.append('calltrace: invalid filter: {}\n'.format(error).encode('utf-8'))
+            return
+        self._matching = {}
+        self._subscribed = True
+
+    def send(self):
+        """
+        Send as much of the pending lines as the socket accepts.
+
+        :return: False if the connection was closed.
+        """
+        import socket
+        chunks = [self._unsent]
+        size = len(self._unsent)
+        pending = self.pending
+        while pending and size < 1 << 16:
+            chunk = pending.popleft()
+            chunks.append(chunk)
+            size += len(chunk)
+        data = b''.join(chunks)
+        try:
+            sent = self.socket.send(data)
+        except socket.error as error:
+            if error.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                sent = 0
+            else:
+                return False
+        self._unsent = data[sent:]
+        return True
+
+    def send_all(self):
+        """
+        Send all pending lines, waiting at most a second.
+        """
+        import socket
+        self.socket.settimeout(1.0)
+        try:
+            self.socket.sendall(self._unsent)
+            self._unsent = b''
+            while self.pending:
+                self.socket.sendall(self.pending.popleft())
+        except socket.error:
+            pass
+
+
+def subscribe(address, functions=None, thread=None, min_duration=None):
+    """
+    Subscribe to the traces published by a StreamSink.
+
+    :param address: Path of the Unix domain socket or (host, port) of the TCP socket.
+    :param functions: Glob or list of globs of function names to receive, defaults to all.
+    :param thread: Id of the only thread to receive traces of.
+    :param min_duration: Only receive returns and exceptions of timed calls that took at least this
+                         many seconds.
+    :return: Generator of the lines of the traces, ending when the connection is closed.
+    """
+    import socket
+    family = socket.AF_UNIX if isinstance(address, str) else socket.AF_INET
+    connection = socket.socket(family, socket.SOCK_STREAM)
+    connection.connect(address)
+    spec = dict((key, value) for key, value in (('functions', functions), ('thread', thread),
+                                                ('min_duration', min_duration))
+                if value is not None)
+    connection.sendall((json.dumps(spec) + '\n').encode('utf-8'))
+    return _receive_lines(connection)
+
+
+def _receive_lines(connection):
+    received = b''
+    try:
+        while True:
+            data = connection.recv(1 << 16)
+            if not data:
+                return
+            received += data
+            lines = received.split(b'\n')
+            received = lines.pop()
+            for line in lines:
+                yield line.decode('utf-8', 'replace')
+    finally:
+        connection.close()
+
+
+_timing = False
+_tracers = weakref.WeakSet()
+_perf_counter_ns = getattr(time, 'perf_counter_ns', None) or (lambda: int(time.time() * 1e9))
+
+
+def set_timing(enabled):
+    """
+    Measure the duration of calls to all traced functions, except those traced with an explicit
+    timing option.
+    """
+    global _timing
+    _timing = enabled
+
+
+_slow_threshold = None
+
+
+def set_slow_threshold(seconds):
+    """
+    Only write the traces of calls that take at least this long or raise an exception, for all
+    traced functions except those traced with an explicit slow_threshold option. The call is kept
+    until it returns, so its trace appears together with the return, at the time of the call.
+    Traced calls made by a slow call are only written when they are slow themselves, traced calls
+    around it are always written.
+
+    :param seconds: The latency budget, or None to write all calls again.
+    """
+    global _slow_threshold
+    _slow_threshold = int(seconds * 1e9) if seconds else None
+
+
+def stats():
+    """
+    Latency statistics of all timed functions, busiest first. Percentiles are estimates, accurate
+    to about 12%. Concurrent calls update the statistics without locking, so under heavy contention
+    a few calls may be missing.
+
+    :return: List of dicts with name, count, exceptions, total, min, max, mean, p50, p95 and p99.
+             Durations are in nanoseconds.
+    """
+    result = []
+    for tracer in list(_tracers):
+        histogram = tracer.histogram
+        if histogram.count:
+            entry = histogram.summary()
+            entry['name'] = tracer.qualified_name
+            result.append(entry)
+    result.sort(key=lambda entry: entry['total'], reverse=True)
+    return result
+
+
+def reset_stats():
+    """
+    Forget all latency, memoization and instance statistics collected so far.
+    """
+    for tracer in list(_tracers):
+        tracer.histogram = _Histogram()
+        tracer.sketch = None
+    if _instances is not None:
+        _instances.reset()
+
+
+def report(file=None):
+    """
+    Print a table with the latency statistics of all timed functions.
+
+    :param file: File to print to, defaults to stdout.
+    """
+    columns = ('count', 'exceptions', 'total', 'mean', 'min', 'p50', 'p95', 'p99', 'max')
+    entries = stats()
+    name_width = max([len(entry['name']) for entry in entries] + [len('function')])
+
+    lines = [' '.join(['{:<{}}'.format('function', name_width)] +
+                      ['{:>10}'.format(column) for column in columns])]
+    for entry in entries:
+        cells = ['{:<{}}'.format(entry['name'], name_width),
+                 '{:>10}'.format(entry['count']),
+                 '{:>10}'.format(entry['exceptions'])]
+        cells += ['{:>10}'.format(_format_duration(entry[column])) for column in columns[2:]]
+        lines.append(' '.join(cells))
+    print('\n'.join(lines), file=file or sys.stdout)
+
+
+_memoization = False
+
+
+def set_memoization_analysis(enabled):
+    """
+    Estimate for all traced functions, except those traced with an explicit memoization option,
+    how many calls repeat the arguments of an earlier call, so a cache would have returned the
+    result. Calls are also timed, to estimate the time a cache would save.
+
+    Distinct arguments are counted with a HyperLogLog sketch of fixed size per function, accurate
+    to about 3%. Arguments are compared by hash and equality, as a cache would, so self is part of
+    the arguments of methods. Calls with unhashable arguments are counted separately.
+    """
+    global _memoization
+    _memoization = enabled
+
+
+def memoization_stats():
+    """
+    Memoization candidates among the analysed functions, ranked by the estimated time a cache would
+    have saved, then by hit ratio.
+
+    :return: List of dicts with name, calls, unhashable (calls that cannot be cached), distinct
+             (estimated number of distinct arguments), repeated (estimated calls that a cache would
+             have answered), hit_ratio (repeated / calls), total (time spent in ns, None if not
+             timed) and savings (estimated time a cache would have saved in ns, or None).
+    """
+    result = []
+    for tracer in list(_tracers):
+        sketch = tracer.sketch
+        if sketch is None or not sketch.calls:
+            continue
+        distinct = min(sketch.distinct(), sketch.calls - sketch.unhashable)
+        repeated = sketch.calls - sketch.unhashable - distinct
+        hit_ratio = float(repeated) / sketch.calls
+        histogram = tracer.histogram
+        total = histogram.total if histogram.count else None
+        result.append({'name': tracer.qualified_name,
+                       'calls': sketch.calls,
+                       'unhashable': sketch.unhashable,
+                       'distinct': distinct,
+                       'repeated': repeated,
+                       'hit_ratio': hit_ratio,
+                       'total': total,
+                       'savings': int(total * hit_ratio) if total is not None else None})
+    result.sort(key=lambda entry: (entry['savings'] or 0, entry['hit_ratio']), reverse=True)
+    return result
+
+
+def memoization_report(file=None):
+    """
+    Print a table with the memoization candidates, see memoization_stats().
+
+    :param file: File to print to, defaults to stdout.
+    """
+    columns = ('calls', 'unhashable', 'distinct', 'repeated', 'hit ratio', 'total', 'savings')
+    entries = memoization_stats()
+    name_width = max([len(entry['name']) for entry in entries] + [len('function')])
+
+    lines = [' '.join(['{:<{}}'.format('function', name_width)] +
+                      ['{:>10}'.format(column) for column in columns])]
+    for entry in entries:
+        cells = ['{:<{}}'.format(entry['name'], name_width)]
+        cells += ['{:>10}'.format(entry[column])
+                  for column in ('calls', 'unhashable', 'distinct', 'repeated')]
+        cells.append('{:>9.1f}%'.format(entry['hit_ratio'] * 100))
+        cells += ['{:>10}'.format(_format_duration(entry[column]) if entry[column] is not None
+                                  else '-') for column in ('total', 'savings')]
+        lines.append(' '.join(cells))
+    print('\n'.join(lines), file=file or sys.stdout)
+
+
+_instances = None
+_instance_filter = None
+
+
+def set_instance_registry(enabled):
+    """
+    Identify instances in traces by a sequence number instead of their id, which Python reuses
+    once an object is freed. Each instance gets the next number on its first traced call and keeps
+    it for life, the registry only holds weak references. Objects that do not support weak
+    references keep their id.
+
+    Also counts the calls and exceptions per instance, and the time spent if timed, see
+    instance_stats().
+    """
+    global _instances, _instance_filter
+    if not enabled:
+        _instances = _instance_filter = None
+    elif _instances is None:
+        _instances = _InstanceRegistry()
+
+
+def instance_number(instance):
+    """
+    :return: The number identifying an instance in traces, or None if the instance registry is not
+             enabled, see set_instance_registry().
+    """
+    registry = _instances
+    return registry.number(instance) if registry is not None else None
+
+
+def set_instance_filter(instance):
+    """
+    Only trace method calls of a single instance, calls of functions without self are still
+    traced. Enables the instance registry, see set_instance_registry().
+
+    :param instance: The instance, its number as shown in traces, or None to trace all instances
+                     again.
+    """
+    global _instance_filter
+    if instance is None:
+        _instance_filter = None
+        return
+    set_instance_registry(True)
+    _instance_filter = instance if isinstance(instance, int) else _instances.number(instance)
+
+
+def instance_stats():
+    """
+    Statistics of the live instances in the registry, busiest first, see set_instance_registry().
+    Statistics are dropped together with their instance.
+
+    :return: List of dicts with class, instance (the number), calls, exceptions and total (time
+             spent in ns, 0 if not timed).
+    """
+    registry = _instances
+    if registry is None:
+        return []
+    result = [{'class': entry.class_name,
+               'instance': entry.number,
+               'calls': entry.calls,
+               'exceptions': entry.exceptions,
+               'total': entry.total}
+              for entry in registry.entries() if entry.calls]
+    result.sort(key=lambda entry: (entry['total'], entry['calls']), reverse=True)
+    return result
+
+
+def _format_elapsed(duration):
+    return ' after ' + _format_duration(duration) if duration is not None else ''
+
+
+def _format_duration(ns):
+    for unit, scale in (('s', 1e9), ('ms', 1e6), ('us', 1e3)):
+        if ns >= scale:
+            return '{:.1f}{}'.format(ns / scale, unit)
+    return '{}ns'.format(int(ns))
+
+
+class _Histogram(object):
+    """
+    Log-scale histogram of durations in nanoseconds. Every power of two is split in 4 buckets, so a
+    fixed list of 256 counters covers all durations.
+    """
+    __slots__ = ('count', 'exceptions', 'total', 'min', 'max', 'buckets')
+
+    def __init__(self):
+        self.count = 0
+        self.exceptions = 0
+        self.total = 0
+        self.min = None
+        self.max = 0
+        self.buckets = None
+
+    def add(self, ns, exception=False):
+        if self.buckets is None:
+            self.buckets = [0] * 256
+        self.count += 1
+        self.total += ns
+        if exception:
+            self.exceptions += 1
+        if self.min is None or ns < self.min:
+            self.min = ns
+        if ns > self.max:
+            self.max = ns
+
+        if ns < 4:
+            self.buckets[ns] += 1
+        else:
+            bits = ns.bit_length()
+            self.buckets[min(((bits - 2) << 2) + ((ns >> (bits - 3)) & 3), 255)] += 1
+
+    @staticmethod
+    def _bucket_middle(index):
+        if index < 4:
+            return index
+        shift = (index >> 2) - 1
+        low = (4 + (index & 3)) << shift
+        return low + (1 << shift) // 2
+
+    def percentile(self, fraction):
+        if not self.count:
+            return 0
+        wanted = fraction * self.count
+        seen = 0
+        for index, count in enumerate(self.buckets):
+            seen += count
+            if count and seen >= wanted:
+                return max(self.min, min(self.max, self._bucket_middle(index)))
+        return self.max
+
+    def summary(self):
+        return {'count': self.count,
+                'exceptions': self.exceptions,
+                'total': self.total,
+                'min': self.min or 0,
+                'max': self.max,
+                'mean': self.total // self.count if self.count else 0,
+                'p50': self.percentile(0.5),
+                'p95': self.percentile(0.95),
+                'p99': self.percentile(0.99)}
+
+
+class _ArgumentSketch(object):
+    """
+    Counts calls and estimates the number of distinct arguments with a HyperLogLog sketch of 1024
+    registers, so memory use is fixed. Not locked, like _Histogram.
+    """
+    __slots__ = ('calls', 'unhashable', 'registers')
+
+    _precision = 10
+    _mask = (1 << 64) - 1
+
+    def __init__(self):
+        self.calls = 0
+        self.unhashable = 0
+        self.registers = bytearray(1 << self._precision)
+
+    def add(self, pargs, kwargs):
+        self.calls += 1
+        try:
+            value = hash((pargs, frozenset(kwargs.items()))) if kwargs else hash(pargs)
+        except Exception:
+            # Not hashable, or a broken __hash__ that must not fail the traced call
+            self.unhashable += 1
+            return
+
+        # Hashes of small ints are the ints themselves, mix the bits (splitmix64 finalizer)
+        mask = self._mask
+        value &= mask
+        value = ((value ^ (value >> 30)) * 0xbf58476d1ce4e5b9) & mask
+        value = ((value ^ (value >> 27)) * 0x94d049bb133111eb) & mask
+        value ^= value >> 31
+
+        precision = self._precision
+        index = value & ((1 << precision) - 1)
+        rank = 64 - precision - (value >> precision).bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def distinct(self):
+        """
+        :return: Estimated number of distinct hashable arguments.
+        """
+        registers = self.registers
+        size = len(registers)
+        harmonic = sum(2.0 ** -rank for rank in registers)
+        estimate = 0.7213 / (1 + 1.079 / size) * size * size / harmonic
+        zeros = registers.count(0)
+        if estimate <= 2.5 * size and zeros:
+            # Small range correction
+            estimate = size * math.log(float(size) / zeros)
+        return int(round(estimate))
+
+
+class _RegisteredInstance(object):
+    __slots__ = ('ref', 'number', 'class_name', 'calls', 'exceptions', 'total')
+
+    def __init__(self, ref, number, class_name):
+        self.ref = ref
+        self.number = number
+        self.class_name = class_name
+        self.calls = 0
+        self.exceptions = 0
+        self.total = 0
+
+
+class _InstanceRegistry(object):
+    """
+    Numbers instances in order of appearance, holding only weak references. Entries are found by
+    id for the traces and by number for the statistics, both in constant time, and are removed when
+    their instance is freed. Instances without weak reference support are identified by their id.
+    The statistics are not locked, like _Histogram.
+    """
+
+    def __init__(self):
+        self._by_id = {}
+        self._by_number = {}
+        self._numbers = itertools.count(1)
+        # Types whose instances cannot be weakly referenced, so they skip the lock
+        self._unreferenceable = set()
+        self._lock = threading.Lock()
+
+    def after_fork(self):
+        # The lock may have been held by another thread of the parent
+        self._lock = threading.Lock()
+
+    def number(self, instance):
+        entry = self._by_id.get(id(instance))
+        if entry is not None and entry.ref() is instance:
+            return entry.number
+        if type(instance) in self._unreferenceable:
+            return id(instance)
+        return self._register(instance)
+
+    def _register(self, instance):
+        key = id(instance)
+        with self._lock:
+            entry = self._by_id.get(key)
+            if entry is not None and entry.ref() is instance:
+                return entry.number
+            try:
+                ref = weakref.ref(instance, functools.partial(self._forget, key))
+            except TypeError:
+                self._unreferenceable.add(type(instance))
+                return key
+            entry = _RegisteredInstance(ref, next(self._numbers), type(instance).__name__)
+            self._by_id[key] = entry
+            self._by_number[entry.number] = entry
+        return entry.number
+
+    def _forget(self, key, ref):
+        with self._lock:
+            entry = self._by_id.get(key)
+            # The id may already belong to a new instance
+            if entry is not None and entry.ref is ref:
+                del self._by_id[key]
+                del self._by_number[entry.number]
+
+    def add(self, number, duration, exception=False):
+        entry = self._by_number.get(number)
+        if entry is None:
+            return
+        entry.calls += 1
+        if exception:
+            entry.exceptions += 1
+        if duration is not None:
+            entry.total += duration
+
+    def entries(self):
+        return list(self._by_number.values())
+
+    def reset(self):
+        for entry in self.entries():
+            entry.calls = entry.exceptions = entry.total = 0
+
+
+def _instance_id(instance):
+    """
+    Identify the instance of a traced call, see set_instance_registry().
+    """
+    registry = _instances
+    return id(instance) if registry is None else registry.number(instance)
+
+
+class _Record(object):
+    """
+    Raw trace event. Converted to text only when it is written. For calls args contains the
+    positional and keyword arguments, for returns value contains the return value and for
+    exceptions value contains the exception info.
+    """
+    __slots__ = ('kind', 'tracer', 'thread_id', 'task_id', 'instance', 'depth', 'call_id',
+                 'parent_id', 'args', 'value', 'duration', 'timestamp')
+
+    def __init__(self, kind, tracer, thread_id, task_id, instance, depth, call_id, parent_id,
+                 args=None, value=None, duration=None):
+        self.kind = kind
+        self.tracer = tracer
+        self.thread_id = thread_id
+        self.task_id = task_id
+        self.instance = instance
+        self.depth = depth
+        self.call_id = call_id
+        self.parent_id = parent_id
+        self.args = args
+        self.value = value
+        self.duration = duration
+        self.timestamp = _clock()
+
+    def result(self, kind, value, duration):
+        """
+        Create the return or exception record for this call record.
+        """
+        return _Record(kind, self.tracer, self.thread_id, self.task_id, self.instance, self.depth,
+                       self.call_id, self.parent_id, None, value, duration)
+
+    def fields(self):
+        """
+        Structured fields of the record, see Sink.
+        """
+        tracer = self.tracer
+        event = {'event': _kind_names[self.kind],
+                 'function': tracer.function_name,
+                 'class': tracer.class_name,
+                 'instance': self.instance,
+                 'thread': self.thread_id,
+                 'task': self.task_id,
+                 'depth': self.depth,
+                 'call_id': self.call_id,
+                 'parent_id': self.parent_id,
+                 'timestamp': self.timestamp}
+        if self.kind == _CALL:
+            event['args'] = collections.OrderedDict(tracer.bound_arguments(*self.args))
+        elif self.kind == _RETURN:
+            event['return_value'] = self.value
+            event['duration'] = self.duration
+        else:
+            event['exception'] = self.value.value
+            event['traceback'] = tracer.format_exception(self.value)
+            event['duration'] = self.duration
+        return event
+
+
+_clock = getattr(time, 'monotonic_ns', None) or (lambda: int(time.time() * 1e9))
+_call_ids = itertools.count(1)
+
+
+try:
+    import contextvars
+except ImportError:
+    # Python before 3.7
+    contextvars = None
+
+# Per asyncio task, the task id, depth and call id of the innermost traced coroutine in progress.
+# Coroutines do not nest on the thread, as other tasks run while they are suspended.
+_coroutine_call = (contextvars.ContextVar('calltrace_coroutine_call', default=None)
+                   if contextvars is not None else None)
+
+
+def _current_task_id():
+    """
+    :return: Id of the running asyncio task, or None outside of a task.
+    """
+    asyncio = sys.modules.get('asyncio')
+    if asyncio is None or asyncio._get_running_loop() is None:
+        return None
+    current_task = getattr(asyncio, 'current_task', None) or asyncio.Task.current_task
+    task = current_task()
+    return id(task) if task is not None else None
+
+
+def _thread_label(thread_id, task_id):
+    if task_id is None:
+        return 'Thread{{{}}}'.format(thread_id)
+    return 'Thread{{{}}}:Task{{{}}}'.format(thread_id, task_id)
+
+
+_snapshot_types = {list: list, dict: dict, set: set, bytearray: bytearray}
+
+
+def _snapshot(pargs, kwargs):
+    """
+    Shallow copy mutable builtin containers in the arguments, so deferred formatting shows them as
+    they were at call time.
+    """
+    get_copier = _snapshot_types.get
+    pargs = tuple(get_copier(type(value), _keep)(value) for value in pargs)
+    if kwargs:
+        kwargs = {key: get_copier(type(value), _keep)(value) for key, value in kwargs.items()}
+    return pargs, kwargs
+
+
+def _keep(value):
+    return value
+
+
+class _AsyncWriter(object):
+    """
+    Bounded queue drained by a writer thread. Producers only take a lock when they need to wake up
+    the writer, when they have to wait for room or when they drop a trace.
+    """
+    def __init__(self, queue_size, overflow, batch_size):
+        if overflow not in (BLOCK, DROP_OLDEST, DROP_NEWEST):
+            raise ValueError('Unknown overflow policy: {}'.format(overflow))
+        self._queue = collections.deque()
+        self._queue_size = queue_size
+        self._overflow = overflow
+        self._batch_size = batch_size
+        self._wakeup = threading.Event()
+        self._not_full = threading.Condition()
+        self._drop_lock = threading.Lock()
+        self._sleeping = False
+        self._waiting_producers = 0
+        self._stopping = False
+        self._thread = None
+        self.dropped = 0
+
+    def forked(self):
+        """
+        Create and start a new writer with the same settings in a forked child process.
+        """
+        writer = _AsyncWriter(self._queue_size, self._overflow, self._batch_size)
+        writer.start()
+        return writer
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='CallTraceWriter')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stopping = True
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def flush(self):
+        if self._thread is None or threading.current_thread() is self._thread:
+            return
+        done = threading.Event()
+        # The marker bypasses the overflow policy, it must never be dropped
+        self._queue.append(done)
+        self._wakeup.set()
+        done.wait()
+
+    def put(self, item):
+        if threading.current_thread() is self._thread:
+            # Waiting for ourselves would deadlock
+            _write_record(item)
+            return
+
+        if len(self._queue) >= self._queue_size:
+            if self._overflow == DROP_NEWEST:
+                self._count_drop()
+                return
+            elif self._overflow == DROP_OLDEST:
+                try:
+                    oldest = self._queue.popleft()
+                except IndexError:
+                    pass
+                else:
+                    self._count_drop()
+                    if isinstance(oldest, threading.Event):
+                        # Never drop a flush marker, drop the new trace instead
+                        self._queue.appendleft(oldest)
+                        return
+            else:
+                self._wait_for_room()
+
+        self._queue.append(item)
+        if self._sleeping:
+            self._wakeup.set()
+
+    def _count_drop(self):
+        with self._drop_lock:
+            self.dropped += 1
+
+    def _wait_for_room(self):
+        with self._not_full:
+            self._waiting_producers += 1
+            try:
+                while len(self._queue) >= self._queue_size and self._thread is not None:
+                    self._wakeup.set()
+                    self._not_full.wait(0.1)
+            finally:
+                self._waiting_producers -= 1
+
+    def _take_batch(self):
+        batch = []
+        queue = self._queue
+        try:
+            for _ in range(self._batch_size):
+                batch.append(queue.popleft())
+        except IndexError:
+            pass
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._take_batch()
+            if batch:
+                self._write(batch)
+                if self._waiting_producers:
+                    with self._not_full:
+                        self._not_full.notify_all()
+                continue
+            if self._stopping:
+                break
+
+            # Set the flag before checking the queue, so producers appending in between will wake us
+            self._sleeping = True
+            if not self._queue:
+                self._wakeup.wait(1.0)
+            self._sleeping = False
+            self._wakeup.clear()
+
+    @staticmethod
+    def _write(batch):
+        for item in batch:
+            if isinstance(item, threading.Event):
+                item.set()
+            else:
+                _write_record(item)
+
+
+# Capture policies for return values and exceptions
+CAPTURE_OFF = 'off'
+CAPTURE_TYPE = 'type'
+CAPTURE_TRUNCATED = 'truncated'
+CAPTURE_FULL = 'full'
+
+_capture_policies = (CAPTURE_OFF, CAPTURE_TYPE, CAPTURE_TRUNCATED, CAPTURE_FULL)
+
+# Exception as captured by a tracer. Parts not captured are None. Limited is set when the traceback
+# was left out by the traceback limit, suppressed is the number of similar tracebacks left out
+# before a captured one.
+_CapturedException = collections.namedtuple('_CapturedException', ('type', 'value', 'traceback',
+                                                                   'suppressed', 'limited'))
+
+
+def _capture_exception(capture, depth):
+    """
+    Capture the exception being handled according to a capture policy.
+
+    :param depth: Depth of the traced call the exception passes through.
+    """
+    exc_type, exc_value, exc_traceback = sys.exc_info()
+    if capture == CAPTURE_FULL:
+        allowed, suppressed = _traceback_limiter.check(exc_type, exc_value, exc_traceback, depth)
+        if allowed:
+            return _CapturedException(exc_type, exc_value, exc_traceback, suppressed, False)
+        return _CapturedException(exc_type, exc_value, None, 0, True)
+    elif capture == CAPTURE_TRUNCATED:
+        return _CapturedException(exc_type, exc_value, None, 0, False)
+    elif capture == CAPTURE_TYPE:
+        return _CapturedException(exc_type, None, None, 0, False)
+    return _CapturedException(None, None, None, 0, False)
+
+
+def set_traceback_limit(limit=10, interval=60.0):
+    """
+    Limit the number of tracebacks captured per interval for each combination of exception type
+    and raising site. Beyond the limit exceptions are traced with their type and message only, and
+    the next captured traceback tells how many were suppressed. This keeps an error storm from
+    being made worse by formatting thousands of identical tracebacks. Forgets the counts so far.
+
+    :param limit: Tracebacks per interval and site, or None for no limit.
+    :param interval: Length of the interval in seconds.
+    """
+    global _traceback_limiter
+    _traceback_limiter = _TracebackLimiter(limit, interval)
+
+
+def suppressed_tracebacks():
+    """
+    :return: List of dicts with exception (the type name), file, line and the number of suppressed
+             tracebacks, most suppressed first.
+    """
+    return _traceback_limiter.summary()
+
+
+class _TracebackLimiter(object):
+    """
+    Counts tracebacks per exception type and raising site in fixed intervals. An exception passing
+    through several traced calls counts once, the outer calls get the decision made for the
+    innermost one. Exceptions do not support weak references, so they are recognized by id while
+    the depth of the traced calls decreases.
+    """
+    def __init__(self, limit, interval):
+        self._limit = limit
+        self._interval = int(interval * 1e9)
+        self._sites = {}
+        self._lock = threading.Lock()
+        # Per thread, the id of the last exception checked, its depth and the decision
+        self._last = threading.local()
+
+    def check(self, exc_type, exc_value, exc_traceback, depth):
+        """
+        :param depth: Depth of the traced call the exception passes through.
+        :return: Tuple of whether the traceback may be captured and the number of tracebacks
+                 suppressed since the last one captured for the same site.
+        """
+        if self._limit is None or exc_traceback is None:
+            return True, 0
+        last = getattr(self._last, 'decision', None)
+        if last is not None and last[0] == id(exc_value) and depth < last[1]:
+            self._last.decision = last[0], depth, last[2]
+            return last[2], 0
+        allowed, suppressed = self._check_site(exc_type, exc_traceback)
+        self._last.decision = id(exc_value), depth, allowed
+        return allowed, suppressed
+
+    def _check_site(self, exc_type, exc_traceback):
+        while exc_traceback.tb_next is not None:
+            exc_traceback = exc_traceback.tb_next
+        key = (exc_type, exc_traceback.tb_frame.f_code.co_filename, exc_traceback.tb_lineno)
+        now = _perf_counter_ns()
+        with self._lock:
+            site = self._sites.get(key)
+            if site is None:
+                site = self._sites[key] = _TracebackSite(now)
+            if now - site.start >= self._interval:
+                site.start = now
+                site.captured = 0
+            if site.captured < self._limit:
+                site.captured += 1
+                suppressed, site.pending = site.pending, 0
+                return True, suppressed
+            site.pending += 1
+            site.total += 1
+            return False, 0
+
+    def after_fork(self):
+        # The lock may have been held by another thread of the parent
+        self._lock = threading.Lock()
+
+    def summary(self):
+        with self._lock:
+            result = [{'exception': exc_type.__name__, 'file': filename, 'line': line,
+                       'suppressed': site.total}
+                      for (exc_type, filename, line), site in self._sites.items() if site.total]
+        result.sort(key=lambda entry: entry['suppressed'], reverse=True)
+        return result
+
+
+class _TracebackSite(object):
+    __slots__ = ('start', 'captured', 'pending', 'total')
+
+    def __init__(self, start):
+        # Start of the interval, tracebacks captured in it, suppressed since the last captured
+        # one and suppressed in total
+        self.start = start
+        self.captured = 0
+        self.pending = 0
+        self.total = 0
+
+
+_traceback_limiter = _TracebackLimiter(10, 60.0)
+
+
+_ArgSpec = collections.namedtuple('_ArgSpec', ('args', 'varargs', 'keywords', 'defaults',
+                                               'kwonlyargs', 'kwonlydefaults', 'posonlycount',
+                                               'signature'))
+
+# Argument specifications per function, functions inherited by many classes are inspected once
+_argspecs = weakref.WeakKeyDictionary()
+
+
+def _get_argspec(func):
+    """
+    Get the parameters of a function like the removed inspect.getargspec(), plus the names and
+    defaults of keyword-only parameters and the number of leading positional-only parameters in
+    args. Decorated functions are not followed to the function they wrap.
+    """
+    spec = _argspecs.get(func)
+    if spec is None:
+        spec = _argspecs[func] = _inspect_argspec(func)
+    return spec
+
+
+def _inspect_argspec(func):
+    if not hasattr(inspect, 'signature'):
+        spec = inspect.getargspec(func)
+        return _ArgSpec(spec.args, spec.varargs, spec.keywords, spec.defaults, [], {}, 0, None)
+
+    args = []
+    varargs = None
+    keywords = None
+    defaults = []
+    kwonlyargs = []
+    kwonlydefaults = {}
+    posonlycount = 0
+    signature = inspect.signature(func, follow_wrapped=False)
+    for parameter in signature.parameters.values():
+        if parameter.kind in (parameter.POSITIONAL_ONLY, parameter.POSITIONAL_OR_KEYWORD):
+            args.append(parameter.name)
+            if parameter.kind == parameter.POSITIONAL_ONLY:
+                posonlycount += 1
+            if parameter.default is not parameter.empty:
+                defaults.append(parameter.default)
+        elif parameter.kind == parameter.VAR_POSITIONAL:
+            varargs = parameter.name
+        elif parameter.kind == parameter.KEYWORD_ONLY:
+            kwonlyargs.append(parameter.name)
+            if parameter.default is not parameter.empty:
+                kwonlydefaults[parameter.name] = parameter.default
+        else:
+            keywords = parameter.name
+    return _ArgSpec(args, varargs, keywords, tuple(defaults) or None, kwonlyargs, kwonlydefaults,
+                    posonlycount, signature)
+
+
+class _Omitted(object):
+    """
+    Type of _OMITTED, recorded for arguments left at their default, see _generate_wrapper().
+    """
+    def __repr__(self):
+        return '<omitted>'
+
+    def __reduce__(self):
+        return '_OMITTED'
+
+
+_OMITTED = _Omitted()
+
+
+# Kinds of traced functions, they need different wrappers
+_FUNCTION = 'function'
+_COROUTINE = 'coroutine'
+_GENERATOR = 'generator'
+_ASYNC_GENERATOR = 'async generator'
+
+_iscoroutinefunction = getattr(inspect, 'iscoroutinefunction', lambda func: False)
+_isasyncgenfunction = getattr(inspect, 'isasyncgenfunction', lambda func: False)
+_markcoroutinefunction = getattr(inspect, 'markcoroutinefunction', None)
+
+# Code of the generated wrappers per traced function and name, see _generate_wrapper()
+_wrapper_code = weakref.WeakValueDictionary()
+_wrapper_numbers = itertools.count()
+
+
+class _FunctionTracer(object):
+    def __init__(self, func, class_name=None, timing=None, enabled=True, sample_every=None,
+                 sample_rate=None, aggregate_only=False, returns=CAPTURE_TRUNCATED,
+                 exceptions=CAPTURE_FULL, memoization=None, slow_threshold=None,
+                 show_defaults=False, name=None):
+        for capture in (returns, exceptions):
+            if capture not in _capture_policies:
+                raise ValueError('Unknown capture policy: {}'.format(capture))
+        self._capture_returns = returns
+        self._capture_exceptions = exceptions
+        self._func = func
+        self._get_details()
+        if name is not None:
+            self._name = name
+
+        # Static/class methods do not have the class associated, so allow passing a fallback
+        if class_name and not self._class_name:
+            self._class_name = class_name
+
+        self.qualified_name = ('{}.{}'.format(self._class_name, self._name) if self._class_name
+                               else self._name)
+        self._select_call_format()
+        self._select_handle_self()
+        self._select_binding(show_defaults)
+
+        self.timing = timing
+        self.histogram = _Histogram()
+        self.memoization = memoization
+        self.sketch = None
+        self.slow_threshold = slow_threshold
+
+        self.enabled = enabled
+        self.active = False
+        self.update_active()
+        self.set_sampling(sample_every, sample_rate)
+        if aggregate_only:
+            self._enter = self._count_enter
+            self._leave = self._count_leave
+            self._fail = self._count_fail
+        _tracers.add(self)
+
+    @property
+    def original(self):
+        return self._func
+
+    @property
+    def function_name(self):
+        return self._name
+
+    @property
+    def class_name(self):
+        return self._class_name
+
+    @property
+    def kind(self):
+        """
+        'function', 'coroutine', 'generator' or 'async generator'.
+        """
+        return self._kind
+
+    @property
+    def is_constructor(self):
+        return self._is_init
+
+    @property
+    def capture_returns(self):
+        """
+        What is captured of return values, see the returns option of trace().
+        """
+        return self._capture_returns
+
+    def update_active(self):
+        """
+        Combine the global and the tracer specific switch into the single flag checked per call.
+        """
+        self.active = self.enabled and _enabled
+
+    def set_sampling(self, every=None, rate=None):
+        if every is not None and rate is not None:
+            raise ValueError('Use either every or rate for sampling, not both.')
+        if every is not None and every > 1:
+            self._sample_every = every
+            self._sample_counter = 0
+            self._sampled = self._sampled_every
+        elif rate is not None and rate < 1.0:
+            self._sample_rate = rate
+            self._sampled = self._sampled_rate
+        else:
+            self._sampled = None
+
+    def _sampled_every(self):
+        # Not locked, concurrent calls may occasionally sample slightly more or less
+        self._sample_counter += 1
+        if self._sample_counter >= self._sample_every:
+            self._sample_counter = 0
+            return True
+        return False
+
+    def _sampled_rate(self):
+        return random.random() < self._sample_rate
+
+    def _get_details(self):
+        self._name = self._func.__name__
+
+        self._class_name = None
+        if inspect.ismethod(self._func):
+            # Bound methods pass self or cls themselves, their signature leaves it out
+            owner = self._func.__self__
+            self._class_name = (owner if inspect.isclass(owner) else type(owner)).__name__
+            real_func = self._func.__func__
+        else:
+            real_func = self._func
+
+        self._argspec = _get_argspec(self._func)
+        self._arg_names = self._argspec.args
+
+        # Omitted arguments are not shown, unless show_defaults is set
+        defaults = self._argspec.defaults or ()
+        self._defaults = dict(zip(self._arg_names[len(self._arg_names) - len(defaults):],
+                                  defaults))
+        self._defaults.update(self._argspec.kwonlydefaults)
+
+        self._is_init = self._name == '__init__'
+        self._has_self = 'self' in self._arg_names
+
+        if _iscoroutinefunction(real_func):
+            self._kind = _COROUTINE
+        elif _isasyncgenfunction(real_func):
+            self._kind = _ASYNC_GENERATOR
+        elif inspect.isgeneratorfunction(real_func):
+            self._kind = _GENERATOR
+        else:
+            self._kind = _FUNCTION
+
+        # Without the duration the traces of asynchronous code say very little
+        self._always_timed = self._kind in (_COROUTINE, _ASYNC_GENERATOR)
+        self._nests = self._kind == _FUNCTION
+        # Coroutines awaited by traced coroutines nest within their task
+        self._nests_in_task = self._kind == _COROUTINE and _coroutine_call is not None
+
+    def _select_call_format(self):
+        if self._class_name and self._has_self:
+            name_format = '{class_name}[{instance_id}].{func_name}'
+        elif self._class_name and not self._has_self:
+            name_format = '{class_name}.{func_name}'
+        elif not self._class_name and self._has_self:
+            name_format = '[{instance_id}].{func_name}'
+        else:
+            name_format = '{func_name}'
+
+        self.name_format = name_format.format(class_name=self._class_name,
+                                              func_name=self._name,
+                                              instance_id='{instance_id}')
+        thread_format = '{thread}:'
+
+        self._call_format = thread_format + self.name_format + '({arguments})'
+        self._return_format = thread_format + self.name_format + ' returned {return_value}'
+        self._exception_format = thread_format + self.name_format + ' raised an exception'
+
+    def _select_handle_self(self):
+        if self._has_self and self._is_init:
+            # Need to ignore self
+            self._arg_names = self._arg_names[1:]
+            self._handle_self = self._handle_self_remove_self
+        elif self._has_self:
+            self._handle_self = self._handle_self_use_self
+        else:
+            self._handle_self = self._handle_self_no_self
+
+    @staticmethod
+    def _handle_self_remove_self(pargs, kwargs):
+        if 'self' in kwargs:
+            instance = _instance_id(kwargs['self'])
+            kwargs = {k: v for k, v in kwargs.items() if k != 'self'}
+        elif len(pargs) > 0:
+            instance = _instance_id(pargs[0])
+            pargs = pargs[1:]
+        else:
+            instance = None
+        return pargs, kwargs, instance
+
+    @staticmethod
+    def _handle_self_use_self(pargs, kwargs):
+        if 'self' in kwargs:
+            instance = _instance_id(kwargs['self'])
+        elif len(pargs) > 0:
+            instance = _instance_id(pargs[0])
+        else:
+            instance = None
+        return pargs, kwargs, instance
+
+    @staticmethod
+    def _handle_self_no_self(pargs, kwargs):
+        return pargs, kwargs, None
+
+    def _select_binding(self, show_defaults):
+        """
+        Choose how to pair the recorded arguments with the parameter names, see bound_arguments().
+        Positional arguments are paired with the names of the positional parameters, extra ones
+        are collected under the name of *args, and keyword arguments, including keyword-only ones,
+        have their own names.
+        """
+        self._positional_count = len(self._arg_names)
+        self._parameter_names = self._arg_names + self._argspec.kwonlyargs
+        if show_defaults:
+            self.bound_arguments = self._bound_arguments_with_defaults
+        elif self._argspec.varargs:
+            self.bound_arguments = self._bound_arguments_with_varargs
+
+    def wrapped_function(self):
+        """
+        Return a function and not a (un)bound method. We do not want to interfere with self.
+
+        The wrapper is generated with the exact signature of the traced function, so calls do not
+        need to pack and unpack the arguments or find self at runtime.
+        """
+        wrapped = self._generate_wrapper()
+        if wrapped is None:
+            wrapped = self._generic_wrapper()
+        elif hasattr(inspect, 'signature') and (self._argspec.defaults or
+                                                self._argspec.kwonlydefaults):
+            # Show the real defaults instead of _OMITTED
+            wrapped.__signature__ = self._argspec.signature
+        # Like __module__ and __qualname__, for pickle and documentation tools
+        functools.update_wrapper(wrapped, self._func)
+        if self._kind == _COROUTINE and _markcoroutinefunction is not None:
+            _markcoroutinefunction(wrapped)
+        wrapped.tracer = self
+        return wrapped
+
+    def _generic_wrapper(self):
+        tracer = self
+        func = self._func
+
+        def wrapped(*pargs, **kwargs):
+            if not tracer.active:
+                return func(*pargs, **kwargs)
+            return tracer._call(pargs, kwargs)
+        return wrapped
+
+    _wrapper_templates = {_FUNCTION: """\
+def {name}({parameters}):
+    if not __ct_tracer.active:
+        return __ct_func({arguments})
+    __ct_call = __ct_enter({instance}, {pargs}, {kwargs})
+    if __ct_call is None:
+        return __ct_func({arguments})
+    try:
+        __ct_ret = __ct_func({arguments})
+    except:
+        __ct_fail(__ct_call)
+        raise
+    __ct_leave(__ct_call, __ct_ret)
+    return __ct_ret
+""",
+                          # Plain functions, so when tracing is disabled the caller gets the
+                          # coroutine or generator of the traced function without another frame
+                          _COROUTINE: """\
+def {name}({parameters}):
+    if not __ct_tracer.active:
+        return __ct_func({arguments})
+
+    async def __ct_traced():
+        __ct_call = __ct_enter({instance}, {pargs}, {kwargs})
+        if __ct_call is None:
+            return await __ct_func({arguments})
+        try:
+            __ct_ret = await __ct_func({arguments})
+        except:
+            __ct_fail(__ct_call)
+            raise
+        __ct_leave(__ct_call, __ct_ret)
+        return __ct_ret
+    return __ct_traced()
+""",
+                          _GENERATOR: """\
+def {name}({parameters}):
+    if not __ct_tracer.active:
+        return __ct_func({arguments})
+
+    def __ct_traced():
+        __ct_call = __ct_enter({instance}, {pargs}, {kwargs})
+        if __ct_call is None:
+            return (yield from __ct_func({arguments}))
+        try:
+            __ct_ret = yield from __ct_func({arguments})
+        except GeneratorExit:
+            __ct_leave(__ct_call, None)
+            raise
+        except:
+            __ct_fail(__ct_call)
+            raise
+        __ct_leave(__ct_call, __ct_ret)
+        return __ct_ret
+    return __ct_traced()
+""",
+                          # Async generators cannot delegate with yield from, so forward asend(),
+                          # athrow() and aclose() by hand
+                          _ASYNC_GENERATOR: """\
+def {name}({parameters}):
+    if not __ct_tracer.active:
+        return __ct_func({arguments})
+
+    async def __ct_traced():
+        __ct_call = __ct_enter({instance}, {pargs}, {kwargs})
+        __ct_gen = __ct_func({arguments})
+        __ct_send = __ct_gen.asend
+        __ct_value = None
+        try:
+            while True:
+                try:
+                    __ct_item = await __ct_send(__ct_value)
+                except StopAsyncIteration:
+                    break
+                __ct_send = __ct_gen.asend
+                try:
+                    __ct_value = yield __ct_item
+                except GeneratorExit:
+                    await __ct_gen.aclose()
+                    raise
+                except BaseException as __ct_error:
+                    __ct_send = __ct_gen.athrow
+                    __ct_value = __ct_error
+        except GeneratorExit:
+            if __ct_call is not None:
+                __ct_leave(__ct_call, None)
+            raise
+        except:
+            if __ct_call is not None:
+                __ct_fail(__ct_call)
+            raise
+        if __ct_call is not None:
+            __ct_leave(__ct_call, None)
+    return __ct_traced()
+"""}
+    if _markcoroutinefunction is None:
+        # Before Python 3.12 a plain function cannot pass for a coroutine function, which
+        # frameworks check to decide whether to await the result
+        _wrapper_templates[_COROUTINE] = """\
+async def {name}({parameters}):
+    if not __ct_tracer.active:
+        return await __ct_func({arguments})
+    __ct_call = __ct_enter({instance}, {pargs}, {kwargs})
+    if __ct_call is None:
+        return await __ct_func({arguments})
+    try:
+        __ct_ret = await __ct_func({arguments})
+    except:
+        __ct_fail(__ct_call)
+        raise
+    __ct_leave(__ct_call, __ct_ret)
+    return __ct_ret
+"""
+
+    def _generate_wrapper(self):
+        """
+        Create a wrapper function with the same signature as the traced function. Wrappers of the
+        same function and name, like those of a method inherited by many traced classes, share
+        the compiled code and only get their own globals.
+
+        :return: The wrapper, or None if the signature is not supported.
+        """
+        spec = self._argspec
+        names = spec.args + spec.kwonlyargs
+        if spec.varargs:
+            names.append(spec.varargs)
+        if spec.keywords:
+            names.append(spec.keywords)
+        if any(not isinstance(name, str) or name.startswith('__ct_') for name in names):
+            # Python 2 tuple parameters or clashes with our own names
+            return None
+
+        namespace = {'__ct_tracer': self,
+                     '__ct_func': self._func,
+                     '__ct_enter': self._enter,
+                     '__ct_leave': self._leave,
+                     '__ct_fail': self._fail,
+                     '__ct_id': _instance_id,
+                     '__ct_no_kwargs': {},
+                     '__ct_omitted': _OMITTED}
+        defaults = spec.defaults or ()
+        first_default = len(spec.args) - len(defaults)
+        for index, default in enumerate(defaults, first_default):
+            namespace['__ct_default_{}'.format(index)] = default
+        for name, default in spec.kwonlydefaults.items():
+            namespace['__ct_kwdefault_{}'.format(name)] = default
+
+        key = (self._func, self.qualified_name)
+        code = _wrapper_code.get(key)
+        if code is None:
+            wrapper = self._compile_wrapper(namespace)
+            if wrapper is not None:
+                _wrapper_code[key] = wrapper.__code__
+            return wrapper
+
+        wrapper = types.FunctionType(code, namespace, code.co_name,
+                                     (_OMITTED,) * len(defaults) or None)
+        if spec.kwonlydefaults:
+            wrapper.__kwdefaults__ = dict.fromkeys(spec.kwonlydefaults, _OMITTED)
+        return wrapper
+
+    def _compile_wrapper(self, namespace):
+        spec = self._argspec
+
+        # Parameters with a default default to _OMITTED, so the traces can tell omitted arguments
+        # from those passed explicitly, the function gets the real default
+        parameters = []
+        arguments = []
+        first_default = len(spec.args) - len(spec.defaults or ())
+        for index, name in enumerate(spec.args):
+            if index >= first_default:
+                parameters.append(name + '=__ct_omitted')
+                arguments.append('({0} if {0} is not __ct_omitted else __ct_default_{1})'.format(
+                    name, index))
+            else:
+                parameters.append(name)
+                arguments.append(name)
+        if spec.posonlycount:
+            # Otherwise keywords named like positional-only parameters would bind to them
+            parameters.insert(spec.posonlycount, '/')
+        if spec.varargs:
+            parameters.append('*' + spec.varargs)
+            arguments.append('*' + spec.varargs)
+        elif spec.kwonlyargs:
+            parameters.append('*')
+        for name in spec.kwonlyargs:
+            if name in spec.kwonlydefaults:
+                parameters.append(name + '=__ct_omitted')
+                arguments.append('{0}=({0} if {0} is not __ct_omitted else __ct_kwdefault_{0})'
+                                 .format(name))
+            else:
+                parameters.append(name)
+                arguments.append('{0}={0}'.format(name))
+        if spec.keywords:
+            parameters.append('**' + spec.keywords)
+            arguments.append('**' + spec.keywords)
+
+        # Same arguments as handled by _handle_self(): self is left out for __init__. The
+        # arguments are recorded as passed, so keyword-only ones are keyword arguments.
+        recorded = [name for name in spec.args if not (self._is_init and name == 'self')]
+        pargs = '(' + ''.join(arg + ', ' for arg in recorded) + ')'
+        if spec.varargs:
+            pargs += ' + ' + spec.varargs
+        kwargs = spec.keywords or '__ct_no_kwargs'
+        if spec.kwonlyargs:
+            kwargs = '{' + ''.join("'{0}': {0}, ".format(name) for name in spec.kwonlyargs)
+            kwargs += '**{}}}'.format(spec.keywords) if spec.keywords else '}'
+        name = self._name if re.match(r'[A-Za-z_]\w*$', self._name) else 'wrapped'
+        source = self._wrapper_templates[self._kind].format(
+            name=name,
+            parameters=', '.join(parameters),
+            arguments=', '.join(arguments),
+            instance='__ct_id(self)' if self._has_self else 'None',
+            pargs=pargs,
+            kwargs=kwargs)
+
+        filename = '<calltrace {} {}>'.format(self.qualified_name, next(_wrapper_numbers))
+        try:
+            code = compile(source, filename, 'exec')
+        except SyntaxError:
+            # Python version without yield from or async def
+            return None
+        exec(code, namespace)
+        # The globals of the wrapper should not keep it alive
+        wrapper = namespace.pop(name)
+
+        # Register the source, so tracebacks through the wrapper show the lines, until the last
+        # wrapper using the code is gone
+        lines = source.splitlines(True)
+        linecache.cache[filename] = (len(source), None, lines, filename)
+        weakref.finalize(wrapper.__code__, linecache.cache.pop, filename, None)
+        return wrapper
+
+    def _call(self, pargs, kwargs):
+        filtered_pargs, filtered_kwargs, instance = self._handle_self(pargs, kwargs)
+        call = self._enter(instance, filtered_pargs, filtered_kwargs)
+        if call is None:
+            return self._func(*pargs, **kwargs)
+        try:
+            ret = self._func(*pargs, **kwargs)
+        except:
+            self._fail(call)
+            raise
+        self._leave(call, ret)
+        return ret
+
+    def _enter(self, instance, pargs, kwargs):
+        """
+        Start tracing a call.
+
+        :return: State to pass to _leave() or _fail(), or None if the call is not traced.
+        """
+        sampled = self._sampled
+        if sampled is not None and not sampled():
+            return None
+        if _instance_filter is not None and instance is not None and instance != _instance_filter:
+            return None
+        state = _thread_state()
+        if state.in_safe_str:
+            # Called while formatting a trace, see _check_recursion_loop()
+            return None
+
+        memoization = self.memoization if self.memoization is not None else _memoization
+        if memoization:
+            self._observe_arguments(pargs, kwargs)
+
+        threshold = (_slow_threshold if self.slow_threshold is None
+                     else int(self.slow_threshold * 1e9) or None)
+        task_id = _current_task_id()
+        depth, parent_id = state.depth, state.call_id
+        context = None
+        if self._nests_in_task:
+            outer = _coroutine_call.get()
+            if outer is not None and outer[0] == task_id:
+                depth, parent_id = outer[1] + 1, outer[2]
+        call = self._new_call(pargs, kwargs, instance, state.thread_id, task_id, depth, parent_id)
+        if self._nests_in_task:
+            context = _coroutine_call.set((task_id, depth, call.call_id))
+        if threshold:
+            # Written on return if slow, see _release()
+            if self._nests:
+                state.pending.append(call)
+        else:
+            if state.pending:
+                self._write_pending(state)
+            _emit(call)
+        if self._nests:
+            state.depth = call.depth + 1
+            state.call_id = call.call_id
+
+        timed = threshold or (self.timing if self.timing is not None else
+                              _timing or self._always_timed or memoization)
+        return call, state, _perf_counter_ns() if timed else None, threshold, context
+
+    def _observe_arguments(self, pargs, kwargs):
+        # Hashing calls __hash__ of the arguments, which may be traced too, guarded like _safe_str()
+        state = _thread_state()
+        if state.in_safe_str:
+            return
+        sketch = self.sketch
+        if sketch is None:
+            sketch = self.sketch = _ArgumentSketch()
+        state.in_safe_str += 1
+        try:
+            sketch.add(pargs, kwargs)
+        finally:
+            state.in_safe_str -= 1
+
+    def _leave(self, token, ret):
+        call, state, start, threshold, context = token
+        if self._nests:
+            state.depth = call.depth
+            state.call_id = call.parent_id
+        elif context is not None:
+            _coroutine_call.reset(context)
+        if start is not None:
+            duration = _perf_counter_ns() - start
+            self.histogram.add(duration)
+        else:
+            duration = None
+        if _instances is not None and call.instance is not None:
+            _instances.add(call.instance, duration)
+        if threshold and not self._release(call, state, duration >= threshold):
+            return
+        self._log_return(call, ret, duration)
+
+    def _fail(self, token):
+        call, state, start, threshold, context = token
+        if self._nests:
+            state.depth = call.depth
+            state.call_id = call.parent_id
+        elif context is not None:
+            _coroutine_call.reset(context)
+        if start is not None:
+            duration = _perf_counter_ns() - start
+            self.histogram.add(duration, exception=True)
+        else:
+            duration = None
+        if _instances is not None and call.instance is not None:
+            _instances.add(call.instance, duration, exception=True)
+        if threshold:
+            self._release(call, state, True)
+        self._log_exception(call, duration)
+
+    def _release(self, call, state, slow):
+        """
+        Finish a call kept back by the slow call threshold, writing it if it is slow, together with
+        the calls around it that were not written yet.
+
+        :return: True if the call was written, now or before because a call it made was slow.
+        """
+        if not self._nests:
+            # Generators and coroutines are not kept on the thread, as they can be resumed anywhere
+            if slow:
+                _emit(call)
+            return slow
+        pending = state.pending
+        if not pending or pending[-1] is not call:
+            return True
+        pending.pop()
+        if slow:
+            self._write_pending(state)
+            _emit(call)
+        return slow
+
+    @staticmethod
+    def _write_pending(state):
+        pending = state.pending
+        for call in pending:
+            _emit(call)
+        del pending[:]
+
+    def _count_enter(self, instance, pargs, kwargs):
+        """
+        Replaces _enter() for aggregate only tracers, the token is the start time and the instance.
+        """
+        sampled = self._sampled
+        if sampled is not None and not sampled():
+            return None
+        if self.memoization if self.memoization is not None else _memoization:
+            self._observe_arguments(pargs, kwargs)
+        return _perf_counter_ns(), instance
+
+    def _count_leave(self, token, ret):
+        start, instance = token
+        duration = _perf_counter_ns() - start
+        self.histogram.add(duration)
+        if _instances is not None and instance is not None:
+            _instances.add(instance, duration)
+
+    def _count_fail(self, token):
+        start, instance = token
+        duration = _perf_counter_ns() - start
+        self.histogram.add(duration, exception=True)
+        if _instances is not None and instance is not None:
+            _instances.add(instance, duration, exception=True)
+
+    def _new_call(self, pargs, kwargs, instance, thread_id, task_id, depth, parent_id):
+        if _snapshot_arguments:
+            pargs, kwargs = _snapshot(pargs, kwargs)
+        return _Record(_CALL, self, thread_id, task_id, instance, depth, next(_call_ids),
+                       parent_id, (pargs, kwargs))
+
+    def _log_return(self, call, return_value, duration):
+        capture = self._capture_returns
+        if capture == CAPTURE_TYPE:
+            return_value = type(return_value)
+        elif capture == CAPTURE_OFF:
+            return_value = None
+        _emit(call.result(_RETURN, return_value, duration))
+
+    def _log_exception(self, call, duration):
+        _emit(call.result(_EXCEPTION, _capture_exception(self._capture_exceptions, call.depth),
+                          duration))
+
+    def render(self, record, with_traceback=True):
+        """
+        Format a record of this tracer into lines of text.
+
+        :param with_traceback: Include the traceback of exceptions.
+        """
+        thread = _thread_label(record.thread_id, record.task_id)
+        if record.kind == _CALL:
+            pargs, kwargs = record.args
+            return [self._format_call(pargs, kwargs, record.instance, thread)]
+        elif record.kind == _RETURN:
+            return [self._format_return(record.value, record.instance, thread) +
+                    _format_elapsed(record.duration)]
+        else:
+            lines = [self._exception_format.format(thread=thread, instance_id=record.instance) +
+                     _format_elapsed(record.duration)]
+            if with_traceback:
+                details = self.format_exception(record.value)
+                if details is not None:
+                    lines.append(details)
+            return lines
+
+    def _format_call(self, pargs, kwargs, instance, thread):
+        return self._call_format.format(thread=thread,
+                                        instance_id=instance,
+                                        arguments=self.format_arguments(pargs, kwargs))
+
+    def format_arguments(self, pargs, kwargs):
+        return ', '.join('{}={}'.format(key, _safe_str(value))
+                         for key, value in self.bound_arguments(pargs, kwargs))
+
+    def bound_arguments(self, pargs, kwargs):
+        """
+        :return: List of (name, value) of the arguments of a call, leaving out the omitted ones.
+                 Extra positional arguments are a tuple named after *args. Replaced by another
+                 variant for functions with *args or when showing defaults, see _select_binding().
+        """
+        arguments = itertools.chain(zip(self._arg_names, pargs), kwargs.items())
+        return [(key, value) for key, value in arguments if value is not _OMITTED]
+
+    def _bound_arguments_with_varargs(self, pargs, kwargs):
+        extra = pargs[self._positional_count:]
+        return [(key, value)
+                for key, value in itertools.chain(zip(self._arg_names, pargs),
+                                                  ((self._argspec.varargs, extra),) if extra
+                                                  else (),
+                                                  kwargs.items())
+                if value is not _OMITTED]
+
+    def _bound_arguments_with_defaults(self, pargs, kwargs):
+        # Calls through the generic wrapper leave out the arguments not passed
+        positional = dict((key, value) for key, value in zip(self._arg_names, pargs)
+                          if value is not _OMITTED)
+        values = dict(self._defaults)
+        values.update(positional)
+        keywords = []
+        for key, value in kwargs.items():
+            if value is _OMITTED:
+                continue
+            elif key in positional:
+                # Named like a positional-only parameter, so part of **kwargs
+                keywords.append((key, value))
+            else:
+                values[key] = value
+        bound = [(key, values.pop(key)) for key in self._parameter_names if key in values]
+        extra = pargs[self._positional_count:]
+        if extra:
+            bound.insert(self._positional_count, (self._argspec.varargs, extra))
+        bound.extend(values.items())
+        bound.extend(keywords)
+        return bound
+
+    def received_arguments(self, pargs, kwargs):
+        """
+        :return: (pargs, kwargs) of a recorded call as the function received them, with omitted
+                 arguments replaced by their defaults.
+        """
+        defaults = self._defaults
+        if any(value is _OMITTED for value in pargs):
+            pargs = tuple(defaults[key] if value is _OMITTED else value
+                          for key, value in zip(self._arg_names, pargs))
+        if any(value is _OMITTED for value in kwargs.values()):
+            kwargs = dict((key, defaults[key] if value is _OMITTED else value)
+                          for key, value in kwargs.items())
+        return pargs, kwargs
+
+    def _format_return(self, return_value, instance, thread):
+        return self._return_format.format(thread=thread,
+                                          instance_id=instance,
+                                          return_value=self.format_return_value(return_value))
+
+    def format_return_value(self, return_value):
+        """
+        Format a return value as captured by this tracer.
+        """
+        capture = self._capture_returns
+        if capture == CAPTURE_TRUNCATED:
+            return _safe_str(return_value)
+        elif capture == CAPTURE_FULL:
+            return _safe_str(return_value, limited=False)
+        elif capture == CAPTURE_TYPE:
+            return '<{}>'.format(return_value.__name__)
+        return '...'
+
+    @staticmethod
+    def format_exception(captured):
+        """
+        Format an exception captured by a tracer: its traceback, or a summary with the type and
+        message when the traceback was not captured.
+
+        :return: The text or None if nothing was captured.
+        """
+        if captured.type is None:
+            return None
+        if captured.traceback is not None:
+            text = ''.join(traceback.format_exception(captured.type, captured.value,
+                                                      captured.traceback))
+            if captured.suppressed:
+                text += '{} similar tracebacks were suppressed before this one\n'.format(
+                    captured.suppressed)
+            return text
+
+        summary = captured.type.__name__
+        if captured.value is not None:
+            message = _safe_str(captured.value)
+            if message:
+                summary += ': ' + message
+        if captured.limited:
+            summary += ' (traceback suppressed)'
+        return summary
+
+
+class _NullSink(Sink):
+    """
+    Discards all traces, to measure the cost of creating the records.
+    """
+    def write(self, record):
+        pass
+
+
+class _RenderingSink(Sink):
+    """
+    Formats all traces as text and discards them, to measure formatting without terminal I/O.
+    """
+    def write(self, record):
+        record.tracer.render(record)
+
+
+# Benchmark modes: trace options, sink factory taking a scratch directory and asynchronous output
+_benchmark_modes = collections.OrderedDict([
+    ('disabled', ({'enabled': False}, lambda directory: _NullSink(), False)),
+    ('aggregate only', ({'aggregate_only': True}, lambda directory: _NullSink(), False)),
+    ('null sink', ({}, lambda directory: _NullSink(), False)),
+    ('timing', ({'timing': True}, lambda directory: _NullSink(), False)),
+    ('text', ({}, lambda directory: _RenderingSink(), False)),
+    ('ring buffer', ({}, lambda directory: RingBufferSink(), False)),
+    ('json lines', ({}, lambda directory: JsonLinesSink(os.path.join(directory, 'bench.jsonl')),
+                    False)),
+    ('binary', ({}, lambda directory: BinarySink(os.path.join(directory, 'bench.bin')), False)),
+    ('shards', ({}, lambda directory: ShardSink(directory), False)),
+    ('logging', ({}, lambda directory: _benchmark_logging_sink(), False)),
+    ('flight recorder', ({}, lambda directory: FlightRecorder(output=lambda line: None), False)),
+    ('call tree', ({}, lambda directory: CallTreeSink(), False)),
+    ('stream idle', ({}, lambda directory: StreamSink(os.path.join(directory, 'bench.sock')),
+                     False)),
+    ('capture', ({}, lambda directory: CaptureSink(os.path.join(directory, 'bench.corpus')),
+                 False)),
+    ('async text', ({}, lambda directory: _RenderingSink(), True)),
+])
+
+
+def _benchmark_logging_sink():
+    """
+    LoggingSink creating log records for a handler that discards them.
+    """
+    logger = logging.getLogger('calltrace.benchmark')
+    logger.propagate = False
+    logger.setLevel(logging.DEBUG)
+    if not logger.handlers:
+        logger.addHandler(logging.NullHandler())
+    return LoggingSink(logger)
+
+
+_benchmark_scenarios = ('no args', 'positional args', 'keyword args', 'large args', 'method',
+                        'static method', 'class method', 'exception', 'threads')
+
+
+def _benchmark_calls(wrap):
+    """
+    Create the calls of the benchmark scenarios, to functions and classes prepared with wrap.
+
+    :return: Dict of scenario names and functions making a single call.
+    """
+    def no_args():
+        pass
+
+    def positional_args(a, b, c, d, e, f, g, h):
+        pass
+
+    def keyword_args(a=None, b=None, c=None, d=None):
+        pass
+
+    def large_args(data):
+        pass
+
+    def raises():
+        raise ValueError()
+
+    class Methods(object):
+        def method(self, a):
+            pass
+
+        @staticmethod
+        def static_method(a):
+            pass
+
+        @classmethod
+        def class_method(cls, a):
+            pass
+
+    no_args = wrap(no_args)
+    positional_args = wrap(positional_args)
+    keyword_args = wrap(keyword_args)
+    large_args = wrap(large_args)
+    raises = wrap(raises)
+    Methods = wrap(Methods)
+    instance = Methods()
+    data = [list(range(1000)), dict((str(i), i) for i in range(100)), 'x' * 10000]
+
+    def exception():
+        try:
+            raises()
+        except ValueError:
+            pass
+
+    return {'no args': no_args,
+            'positional args': lambda: positional_args(1, 2, 3, 4, 5, 6, 7, 8),
+            'keyword args': lambda: keyword_args(a=1, b=2, c=3, d=4),
+            'large args': lambda: large_args(data),
+            'method': lambda: instance.method(1),
+            'static method': lambda: Methods.static_method(1),
+            'class method': lambda: Methods.class_method(1),
+            'exception': exception,
+            'threads': no_args}
+
+
+def _benchmark_time(call, number, repeat, threads):
+    """
+    :return: Best time per call in ns out of repeat runs of number calls, spread over threads.
+    """
+    import timeit
+
+    def run_threads():
+        barrier = threading.Barrier(threads + 1)
+
+        def worker():
+            barrier.wait()
+            for _ in range(number // threads):
+                call()
+
+        workers = [threading.Thread(target=worker) for _ in range(threads)]
+        for thread in workers:
+            thread.start()
+        barrier.wait()
+        start = time.perf_counter()
+        for thread in workers:
+            thread.join()
+        return time.perf_counter() - start
+
+    best = None
+    for _ in range(repeat):
+        if threads > 1:
+            elapsed = run_threads()
+        else:
+            elapsed = timeit.Timer(call).timeit(number)
+        best = elapsed if best is None else min(best, elapsed)
+    return best / (number // threads * threads) * 1e9
+
+
+def benchmark(number=20000, repeat=5, scenarios=None, modes=None, threads=4):
+    """
+    Measure the overhead of tracing per call, for a set of scenarios in each output mode.
+
+    Scenarios: no args, positional args, keyword args, large args, method, static method, class
+    method, exception and threads (no args called from several threads at once).
+
+    Modes: disabled, aggregate only, null sink (records are created and discarded), timing, text
+    (formatted and discarded), ring buffer, json lines, binary, shards, logging (log records are
+    created and discarded), flight recorder, call tree, stream idle (nobody subscribed, subscribers
+    cost about as much as text), capture (the benchmark functions are nested, so it measures the
+    cost for functions that are not recorded) and async text.
+
+    Replaces the sinks while running, tracing of the application should be idle.
+
+    :param number: Number of calls per run.
+    :param repeat: Number of runs, the fastest run counts.
+    :param scenarios: Names of the scenarios to run, defaults to all.
+    :param modes: Names of the modes to run, defaults to all.
+    :param threads: Number of threads of the threads scenario.
+    :return: List of dicts with scenario, mode, baseline (untraced), traced and overhead in ns per
+             call and the ratio of traced to baseline.
+    """
+    import shutil
+    import tempfile
+    scenarios = list(scenarios or _benchmark_scenarios)
+    modes = list(modes or _benchmark_modes)
+    for name in scenarios:
+        if name not in _benchmark_scenarios:
+            raise ValueError('Unknown benchmark scenario: {}'.format(name))
+    for name in modes:
+        if name not in _benchmark_modes:
+            raise ValueError('Unknown benchmark mode: {}'.format(name))
+
+    def thread_count(scenario):
+        return threads if scenario == 'threads' else 1
+
+    baseline_calls = _benchmark_calls(lambda obj: obj)
+    baselines = dict((scenario, _benchmark_time(baseline_calls[scenario], number, repeat,
+                                                thread_count(scenario)))
+                     for scenario in scenarios)
+
+    results = []
+    directory = tempfile.mkdtemp()
+    previous_sinks = set_sink(None)
+    try:
+        for mode in modes:
+            options, sink_factory, asynchronous = _benchmark_modes[mode]
+            calls = _benchmark_calls(functools.partial(trace, **options))
+            sink = sink_factory(directory)
+            set_sink(sink)
+            if asynchronous:
+                start_async_output()
+            try:
+                for scenario in scenarios:
+                    traced = _benchmark_time(calls[scenario], number, repeat,
+                                             thread_count(scenario))
+                    baseline = baselines[scenario]
+                    results.append({'scenario': scenario,
+                                    'mode': mode,
+                                    'baseline': baseline,
+                                    'traced': traced,
+                                    'overhead': traced - baseline,
+                                    'ratio': traced / baseline if baseline else None})
+            finally:
+                stop_async_output()
+                set_sink(None)
+                sink.close()
+    finally:
+        set_sink(previous_sinks[0])
+        for sink in previous_sinks[1:]:
+            add_sink(sink)
+        shutil.rmtree(directory)
+    return results
+
+
+def report_benchmark(results, previous=None, file=None):
+    """
+    Print a table with benchmark results.
+
+    :param results: Results of benchmark().
+    :param previous: Optional results of an earlier run, to show the change in overhead.
+    :param file: File to print to, defaults to stdout.
+    """
+    previous_overhead = dict(((entry['scenario'], entry['mode']), entry['overhead'])
+                             for entry in previous or ())
+    columns = ['scenario', 'mode', 'baseline', 'traced', 'overhead', 'ratio']
+    if previous is not None:
+        columns.append('change')
+    lines = [' '.join('{:>16}'.format(column) for column in columns)]
+    for entry in results:
+        cells = ['{:>16}'.format(entry['scenario']),
+                 '{:>16}'.format(entry['mode']),
+                 '{:>13.0f} ns'.format(entry['baseline']),
+                 '{:>13.0f} ns'.format(entry['traced']),
+                 '{:>13.0f} ns'.format(entry['overhead']),
+                 '{:>15.1f}x'.format(entry['ratio']) if entry['ratio'] else '{:>16}'.format('-')]
+        if previous is not None:
+            before = previous_overhead.get((entry['scenario'], entry['mode']))
+            if before:
+                cells.append('{:>+15.0f}%'.format((entry['overhead'] - before) * 100 / before))
+            else:
+                cells.append('{:>16}'.format('-'))
+        lines.append(' '.join(cells))
+    print('\n'.join(lines), file=file or sys.stdout)
+
+
+def replay(path, number=5, include=None, exclude=None):
+    """
+    Call the functions recorded by CaptureSink again with the recorded arguments, timing the calls
+    and comparing their results with the recorded ones. The original functions are called, without
+    tracing. Every call gets a fresh copy of its arguments, as functions may modify them.
+
+    The corpus is read with pickle, which can run arbitrary code while loading. Only replay corpora
+    from trusted sources.
+
+    :param path: Path of the corpus file.
+    :param number: Times to repeat each call, the fastest counts.
+    :param include: Patterns of names of functions to replay, as for CaptureSink.
+    :param exclude: Patterns of names not to replay.
+    :return: List of dicts with name, calls, errors (calls that could not be made, as the function
+             or the classes of the arguments no longer exist), mismatches (calls returning a
+             different result or raising a different exception), total and mean (time of the
+             calls made in ns), in order of the total time.
+    """
+    name_filter = _NameFilter(include, exclude)
+    functions = {}
+    results = collections.OrderedDict()
+    for entry in _read_corpus(path):
+        if entry[0] == _CAPTURE_FUNCTION:
+            _, index, name, module, qualname = entry
+            if name_filter.selects(name):
+                functions[index] = name, _find_function(module, qualname)
+            continue
+
+        _, index, args, returned, expected = entry
+        if index not in functions:
+            continue
+        name, func = functions[index]
+        result = results.get(name)
+        if result is None:
+            result = results[name] = {'name': name, 'calls': 0, 'errors': 0, 'mismatches': 0,
+                                      'total': 0, 'mean': None}
+        result['calls'] += 1
+        try:
+            if func is None:
+                raise LookupError()
+            if returned and expected is not None:
+                expected = pickle.loads(expected)
+            best = None
+            for _ in range(number):
+                pargs, kwargs = pickle.loads(args)
+                start = _perf_counter_ns()
+                try:
+                    value = func(*pargs, **kwargs)
+                    raised = None
+                except Exception as e:
+                    raised = e
+                elapsed = _perf_counter_ns() - start
+                best = elapsed if best is None else min(best, elapsed)
+        except Exception:
+            result['errors'] += 1
+            continue
+
+        result['total'] += best
+        if returned:
+            mismatch = raised is not None or (expected is not None and
+                                              not _same_result(value, expected))
+        else:
+            mismatch = raised is None or (expected is not None and
+                                          type(raised).__name__ != expected)
+        if mismatch:
+            result['mismatches'] += 1
+
+    for result in results.values():
+        made = result['calls'] - result['errors']
+        if made:
+            result['mean'] = result['total'] // made
+    return sorted(results.values(), key=lambda result: result['total'], reverse=True)
+
+
+def _same_result(value, expected):
+    try:
+        return bool(value == expected)
+    except Exception:
+        return False
+
+
+def report_replay(results, previous=None, file=None):
+    """
+    Print a table with replay results.
+
+    :param results: Results of replay().
+    :param previous: Optional results of an earlier replay, to show the change in mean time.
+    :param file: File to print to, defaults to stdout.
+    """
+    previous_mean = dict((entry['name'], entry['mean']) for entry in previous or ())
+    columns = ['calls', 'errors', 'mismatches', 'total', 'mean']
+    if previous is not None:
+        columns.append('change')
+    name_width = max([len(entry['name']) for entry in results] + [len('function')])
+
+    lines = [' '.join(['{:<{}}'.format('function', name_width)] +
+                      ['{:>10}'.format(column) for column in columns])]
+    for entry in results:
+        cells = ['{:<{}}'.format(entry['name'], name_width)]
+        cells += ['{:>10}'.format(entry[column]) for column in ('calls', 'errors', 'mismatches')]
+        cells += ['{:>10}'.format(_format_duration(entry[column]) if entry[column] is not None
+                                  else '-') for column in ('total', 'mean')]
+        if previous is not None:
+            before = previous_mean.get(entry['name'])
+            if before and entry['mean'] is not None:
+                cells.append('{:>+9.0f}%'.format((entry['mean'] - before) * 100.0 / before))
+            else:
+                cells.append('{:>10}'.format('-'))
+        lines.append(' '.join(cells))
+    print('\n'.join(lines), file=file or sys.stdout)
+
+
+def _main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m calltrace', description='Call trace tools')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    decode_parser = commands.add_parser('decode', help='Convert a binary trace file to text')
+    decode_parser.add_argument('file')
+    decode_parser.add_argument('--timestamps', action='store_true',
+                               help='Prefix each trace with its monotonic timestamp in ns')
+
+    merge_parser = commands.add_parser('merge', help='Combine trace shards ordered by time')
+    merge_parser.add_argument('files', nargs='+', help='Binary trace files or shard directories')
+    merge_parser.add_argument('--timestamps', action='store_true',
+                              help='Prefix each trace with its monotonic timestamp in ns')
+
+    tail_parser = commands.add_parser('tail', help='Show the traces published by a StreamSink')
+    tail_parser.add_argument('address', help='Path of a Unix domain socket or host:port')
+    tail_parser.add_argument('--function', action='append',
+                             help='Glob of function names like Class.method, may be repeated')
+    tail_parser.add_argument('--thread', type=int, help='Only show traces of this thread id')
+    tail_parser.add_argument('--min-duration', type=float,
+                             help='Only show returns of timed calls taking at least this many '
+                                  'seconds')
+
+    bench_parser = commands.add_parser('bench', help='Measure the overhead of tracing per call')
+    bench_parser.add_argument('--number', type=int, default=20000, help='Calls per run')
+    bench_parser.add_argument('--repeat', type=int, default=5, help='Runs, the fastest counts')
+    bench_parser.add_argument('--scenario', action='append', choices=_benchmark_scenarios,
+                              help='Scenario to run, may be repeated, defaults to all')
+    bench_parser.add_argument('--mode', action='append', choices=list(_benchmark_modes),
+                              help='Mode to run, may be repeated, defaults to all')
+    bench_parser.add_argument('--json', help='Save the results to this file')
+    bench_parser.add_argument('--compare', help='Show the change relative to a saved JSON file')
+
+    replay_parser = commands.add_parser('replay', help='Time the calls recorded by a CaptureSink')
+    replay_parser.add_argument('file')
+    replay_parser.add_argument('--number', type=int, default=5,
+                               help='Times to repeat each call, the fastest counts')
+    replay_parser.add_argument('--function', action='append',
+                               help='Glob of function names like Class.method, may be repeated')
+    replay_parser.add_argument('--json', help='Save the results to this file')
+    replay_parser.add_argument('--compare', help='Show the change relative to a saved JSON file')
+
+    args = parser.parse_args(argv)
+    if args.command == 'bench':
+        return _main_bench(args)
+    elif args.command == 'replay':
+        return _main_replay(args)
+    elif args.command == 'tail':
+        return _main_tail(args)
+    elif args.command == 'decode':
+        traces = decode(args.file)
+    else:
+        traces = merge(args.files)
+    for timestamp, msg in traces:
+        if args.timestamps:
+            print(timestamp, end=' ')
+        _output(msg)
+    return 0
+
+
+def _main_tail(args):
+    address = args.address
+    host, _, port = address.rpartition(':')
+    if host and port.isdigit():
+        address = (host, int(port))
+    try:
+        for line in subscribe(address, args.function, args.thread, args.min_duration):
+            print(line)
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+def _main_bench(args):
+    previous = None
+    if args.compare:
+        with io.open(args.compare, encoding='utf-8') as f:
+            previous = json.load(f)['results']
+
+    results = benchmark(args.number, args.repeat, args.scenario, args.mode)
+    report_benchmark(results, previous)
+    if args.json:
+        with io.open(args.json, 'w', encoding='utf-8') as f:
+            f.write(json.dumps({'python': sys.version,
+                                'platform': sys.platform,
+                                'number': args.number,
+                                'repeat': args.repeat,
+                                'results': results}, indent=2))
+    return 0
+
+
+def _main_replay(args):
+    previous = None
+    if args.compare:
+        with io.open(args.compare, encoding='utf-8') as f:
+            previous = json.load(f)['results']
+
+    results = replay(args.file, args.number, args.function)
+    report_replay(results, previous)
+    if args.json:
+        with io.open(args.json, 'w', encoding='utf-8') as f:
+            f.write(json.dumps({'python': sys.version,
+                                'platform': sys.platform,
+                                'number': args.number,
+                                'results': results}, indent=2))
+    # Fail regression tests on results that changed
+    return 1 if any(entry['errors'] or entry['mismatches'] for entry in results) else 0
+
+
+class _OutputMockTestCase(unittest.TestCase):
+    """
+    Replace the output with a mock during each test.
+    """
+    def __init__(self, methodName='runTest'):
+        super(_OutputMockTestCase, self).__init__(methodName)
+
+        # Prevent requiring mock for normal use
+        import mock
+        self._mock = mock
+
+        self._original_output = None
+
+    def setUp(self):
+        global _output
+        self._original_output = _output
+        _output = self._mock.MagicMock()
+
+    def tearDown(self):
+        global _output
+        _output = self._original_output
+
+
+class _TestCallTraceDecorator(_OutputMockTestCase):
+    maxDiff = None
+
+    def test_function_decorating(self):
+        @trace
+        def _test_func(a, b, c, d=34):
+            return a+b+c+d
+
+        ret = _test_func(1, 2, c=3)
+        self.assertEqual(ret, 40)
+
+        thread_id = id(threading.current_thread())
+        expected = [self._mock.call('Thread{{{}}}:_test_func(a=1, b=2, c=3)'.format(thread_id)),
+                    self._mock.call('Thread{{{}}}:_test_func returned 40'.format(thread_id))]
+        self.assertListEqual(_output.mock_calls, expected)
+
+    def test_method_decorating_old_style_class(self):
+        class _TestClass:
+            @trace
+            def test_method(self, a, b, c, d=34):
+                return a+b+c+d
+
+        tc = _TestClass()
+        ret = tc.test_method(1, 2, c=3)
+        self.assertEqual(ret, 40)
+
+        thread_id = id(threading.current_thread())
+        expected = [self._mock.call('Thread{{{}}}:[{}].test_method(self={}, a=1, b=2, c=3)'
+                                    .format(thread_id, id(tc), str(tc))),
+                    self._mock.call('Thread{{{}}}:[{}].test_method returned 40'
+                                    .format(thread_id, id(tc)))]
+        self.assertListEqual(_output.mock_calls, expected)
+
+    def test_method_decorating_new_style_class(self):
+        class _TestClass(object):
+            @trace
+            def test_method(self, a, b, c, d=34):
+                return a+b+c+d
+
+        tc = _TestClass()
+        ret = tc.test_method(1, 2, c=3)
+        self.assertEqual(ret, 40)
+
+        thread_id = id(threading.current_thread())
+        expected = [self._mock.call('Thread{{{}}}:[{}].test_method(self={}, a=1, b=2, c=3)'
+                                    .format(thread_id, id(tc), str(tc))),
+                    self._mock.call('Thread{{{}}}:[{}].test_method returned 40'
+                                    .format(thread_id, id(tc)))]
+        self.assertListEqual(_output.mock_calls, expected)
+
+    def test_class_decorating_old_style(self):
+        @trace
+        class _TestClass:
+            def test_method(self, a, b, c, d=34):
+                return a+b+c+d
+
+            def test_method2(self, e, f):
+                return e+f
+
+        tc = _TestClass()
+
+        ret = tc.test_method(2, 3, 4)
+        self.assertEqual(ret, 43)
+
+        ret = tc.test_method2(5, 6)
+        self.assertEqual(ret, 11)
+
+        thread_id = id(threading.current_thread())
+        expected = [self._mock.call('Thread{{{}}}:_TestClass[{}].test_method(self={}, a=2, b=3, c=4)'
+                                    .format(thread_id, id(tc), str(tc))),
+                    self._mock.call('Thread{{{}}}:_TestClass[{}].test_method returned 43'
+                                    .format(thread_id, id(tc))),
+                    self._mock.call('Thread{{{}}}:_TestClass[{}].test_method2(self={}, e=5, f=6)'
+                                    .format(thread_id, id(tc), str(tc))),
+                    self._mock.call('Thread{{{}}}:_TestClass[{}].test_method2 returned 11'
+                                    .format(thread_id, id(tc)))]
+        self.assertListEqual(_output.mock_calls, expected)
+
+    def test_class_decorating_new_style(self):
+        @trace
+        class _TestClass(object):
+            def test_method(self, a, b, c, d=34):
+                return a+b+c+d
+
+            def test_method2(self, e, f):
+                return e+f
+
+        tc = _TestClass()
+
+        ret = tc.test_method(2, 3, 4)
+        self.assertEqual(ret, 43)
+
+        ret = tc.test_method2(5, 6)
+        self.assertEqual(ret, 11)
+
+        thread_id = id(threading.current_thread())
+        expected = [self._mock.call('Thread{{{}}}:_TestClass[{}].test_method(self={}, a=2, b=3, c=4)'
+                                    .format(thread_id, id(tc), str(tc))),
+                    self._mock.call('Thread{{{}}}:_TestClass[{}].test_method returned 43'
+                                    .format(thread_id, id(tc))),
+                    self._mock.call('Thread{{{}}}:_TestClass[{}].test_method2(self={}, e=5, f=6)'
+                                    .format(thread_id, id(tc), str(tc))),
+                    self._mock.call('Thread{{{}}}:_TestClass[{}].test_method2 returned 11'
+                                    .format(thread_id, id(tc)))]
+        self.assertListEqual(_output.mock_calls, expected)
+
+    def test_prevent_recursion_str(self):
+        """
+        If __str__ is present and traced or calls a traced method, a loop
+        can occur. This should be prevented.
+        """
+        @trace
+        class _TestClass(object):
+            def method(self):
                 return 'Return'
 
-            def my_name(self):
-                return 'My Name'
+            def my_name(self):
+                return 'My Name'
+
+            def __str__(self):
+                return self.my_name()
+
+        tc = _TestClass()
+
+        self.assertEqual(str(tc), 'My Name')
+
+        ret = tc.method()
+        self.assertEqual(ret, 'Return')
+
+        thread_id = id(threading.current_thread())
+        expected = [self._mock.call('Thread{{{}}}:_TestClass[{}].__str__(self=My Name)'
+                                    .format(thread_id, id(tc))),
+                    self._mock.call('Thread{{{}}}:_TestClass[{}].my_name(self=My Name)'
+                                    .format(thread_id, id(tc))),
+                    self._mock.call('Thread{{{}}}:_TestClass[{}].my_name returned My Name'
+                                    .format(thread_id, id(tc))),
+                    self._mock.call('Thread{{{}}}:_TestClass[{}].__str__ returned My Name'
+                                    .format(thread_id, id(tc))),
+                    # Here __str__ and calls from it are suppressed
+                    self._mock.call('Thread{{{}}}:_TestClass[{}].method(self=My Name)'
+                                    .format(thread_id, id(tc))),
+                    self._mock.call('Thread{{{}}}:_TestClass[{}].method returned Return'
+                                    .format(thread_id, id(tc)))]
+        self.assertListEqual(_output.mock_calls, expected)
+
+    def test_init_prevent_access_to_members(self):
+        """
+        When tracing __init__ we must prevent calling __str__ as it can try to access the instance
+        before it is ready to use.
+        """
+        @trace
+        class _TestClass(object):
+            def __init__(self, a):
+                self._a = a
+
+            def __str__(self):
+                return self._a
+
+        tc = _TestClass('bla')
+        thread_id = id(threading.current_thread())
+        expected = [self._mock.call('Thread{{{}}}:_TestClass[{}].__init__(a=bla)'
+                                    .format(thread_id, id(tc))),
+                    self._mock.call('Thread{{{}}}:_TestClass[{}].__init__ returned None'
+                                    .format(thread_id, id(tc)))]
+        self.assertListEqual(_output.mock_calls, expected)
+
+    def test_method_raises_exception(self):
+        @trace
+        class _TestClass(object):
+            def boom(self):
+                raise TypeError('badaboom')
+
+        tc = _TestClass()
+        with self.assertRaises(TypeError):
+            tc.boom()
+
+        thread_id = id(threading.current_thread())
+
+        class _RegexMatch(object):
+            def __init__(self, expected_regex):
+                self._expected = expected_regex
+
+            def __eq__(self, other):
+                import re
+                return re.match(self._expected, other) is not None
+
+            def __repr__(self):
+                return 'Regex: ' + repr(self._expected)
+
+        expected_traceback = _RegexMatch('Traceback \\(most recent call last\\):\n'
+                                         '  File "<calltrace _TestClass\\.boom \\w+>", line \\d+, '
+                                         'in boom\n'
+                                         '    __ct_ret = __ct_func\\(self\\)\n'
+                                         '(?: +\\^+\n)?'
+                                         '  File ".*calltrace\\.py", line \\d+, in boom\n'
+                                         '    raise TypeError\\(\'badaboom\'\\)\n'
+                                         '(?: +\\^+\n)?'
+                                         'TypeError: badaboom\n')
+
+        expected = [self._mock.call('Thread{{{}}}:_TestClass[{}].boom(self={})'
+                                    .format(thread_id, id(tc), str(tc))),
+                    self._mock.call('Thread{{{}}}:_TestClass[{}].boom raised an exception'
+                                    .format(thread_id, id(tc))),
+                    self._mock.call(expected_traceback)]
+        self.assertListEqual(_output.mock_calls, expected)
+
+    def test_masquerade(self):
+        @trace
+        class _TestClass(object):
+            def test_method(self, a, b, c, d=34):
+                """First test method"""
+                return a+b+c+d
+
+            def test_method2(self, e, f):
+                """Second test method"""
+                return e+f
+
+        tc = _TestClass()
+
+        self.assertEqual(tc.test_method.__name__, 'test_method')
+        self.assertEqual(tc.test_method.__doc__, 'First test method')
+
+        self.assertEqual(tc.test_method2.__name__, 'test_method2')
+        self.assertEqual(tc.test_method2.__doc__, 'Second test method')
+
+    def test_static_method(self):
+        @trace
+        class _TestClass(object):
+            @staticmethod
+            def test_method(a, b, c, d=34):
+                return a+b+c+d
+
+        ret = _TestClass.test_method(1, 2, c=3)
+        self.assertEqual(ret, 40)
+
+        thread_id = id(threading.current_thread())
+        expected = [self._mock.call('Thread{{{}}}:_TestClass.test_method(a=1, b=2, c=3)'
+                                    .format(thread_id)),
+                    self._mock.call('Thread{{{}}}:_TestClass.test_method returned 40'
+                                    .format(thread_id))]
+        self.assertListEqual(_output.mock_calls, expected)
+
+    def test_class_method(self):
+        @trace
+        class _TestClass(object):
+            @classmethod
+            def test_method(cls, a, b, c, d=34):
+                return a+b+c+d
+
+        ret = _TestClass.test_method(1, 2, c=3)
+        self.assertEqual(ret, 40)
+
+        thread_id = id(threading.current_thread())
+        expected = [self._mock.call('Thread{{{}}}:_TestClass.test_method(cls={}, a=1, b=2, c=3)'
+                                    .format(thread_id, str(_TestClass))),
+                    self._mock.call('Thread{{{}}}:_TestClass.test_method returned 40'
+                                    .format(thread_id))]
+        self.assertListEqual(_output.mock_calls, expected)
+
+    def test_bound_method(self):
+        class _TestClass(object):
+            def test_method(self, a, b=2):
+                return a + b
+
+        traced = trace(_TestClass().test_method)
+        self.assertEqual(traced(1), 3)
+        self.assertEqual(traced(1, b=3), 4)
+
+        thread_id = id(threading.current_thread())
+        expected = [self._mock.call('Thread{{{}}}:_TestClass.test_method(a=1)'.format(thread_id)),
+                    self._mock.call('Thread{{{}}}:_TestClass.test_method returned 3'
+                                    .format(thread_id)),
+                    self._mock.call('Thread{{{}}}:_TestClass.test_method(a=1, b=3)'
+                                    .format(thread_id)),
+                    self._mock.call('Thread{{{}}}:_TestClass.test_method returned 4'
+                                    .format(thread_id))]
+        self.assertListEqual(_output.mock_calls, expected)
+        self.assertEqual(str(inspect.signature(traced)), '(a, b=2)')
+
+    def test_sub_class(self):
+        @trace
+        class _BaseClass(object):
+            def method_one(self, a, b):
+                return a+b
+
+            def method_two(self, c, d):
+                return c+d
+
+        @trace
+        class _SubClass(_BaseClass):
+            def method_two(self, c, d):
+                return c-d
+
+            def method_three(self, e, f):
+                return e+f
+
+        bc = _BaseClass()
+        sc = _SubClass()
+
+        ret = bc.method_one(1, 2)
+        self.assertEqual(ret, 3)
+
+        ret = bc.method_two(4, 5)
+        self.assertEqual(ret, 9)
+
+        ret = sc.method_one(1, 2)
+        self.assertEqual(ret, 3)
+
+        ret = sc.method_two(4, 5)
+        self.assertEqual(ret, -1)
+
+        ret = sc.method_three(3, 1)
+        self.assertEqual(ret, 4)
+
+        thread_id = id(threading.current_thread())
+        expected = [self._mock.call('Thread{{{}}}:_BaseClass[{}].method_one(self={}, a=1, b=2)'
+                                    .format(thread_id, id(bc), str(bc))),
+                    self._mock.call('Thread{{{}}}:_BaseClass[{}].method_one returned 3'
+                                    .format(thread_id, id(bc))),
+                    self._mock.call('Thread{{{}}}:_BaseClass[{}].method_two(self={}, c=4, d=5)'
+                                    .format(thread_id, id(bc), str(bc))),
+                    self._mock.call('Thread{{{}}}:_BaseClass[{}].method_two returned 9'
+                                    .format(thread_id, id(bc))),
+                    self._mock.call('Thread{{{}}}:_BaseClass[{}].method_one(self={}, a=1, b=2)'
+                                    .format(thread_id, id(sc), str(sc))),
+                    self._mock.call('Thread{{{}}}:_BaseClass[{}].method_one returned 3'
+                                    .format(thread_id, id(sc))),
+                    self._mock.call('Thread{{{}}}:_SubClass[{}].method_two(self={}, c=4, d=5)'
+                                    .format(thread_id, id(sc), str(sc))),
+                    self._mock.call('Thread{{{}}}:_SubClass[{}].method_two returned -1'
+                                    .format(thread_id, id(sc))),
+                    self._mock.call('Thread{{{}}}:_SubClass[{}].method_three(self={}, e=3, f=1)'
+                                    .format(thread_id, id(sc), str(sc))),
+                    self._mock.call('Thread{{{}}}:_SubClass[{}].method_three returned 4'
+                                    .format(thread_id, id(sc)))]
+        self.assertListEqual(_output.mock_calls, expected)
+
+    def test_sub_classes_have_own_tracers(self):
+        class _BaseClass(object):
+            def method(self, a):
+                return a
+
+            @staticmethod
+            def static_method(a):
+                return a
+
+            @classmethod
+            def class_method(cls, a):
+                return cls.__name__
+
+        @trace
+        class _SubClassOne(_BaseClass):
+            pass
+
+        @trace
+        class _SubClassTwo(_BaseClass):
+            pass
+
+        for name in ('method', 'static_method', 'class_method'):
+            one = getattr(vars(_SubClassOne)[name], '__func__', vars(_SubClassOne)[name])
+            two = getattr(vars(_SubClassTwo)[name], '__func__', vars(_SubClassTwo)[name])
+            self.assertIsNot(one.tracer, two.tracer)
+            # The wrapper is compiled once for all subclasses
+            self.assertIs(one.__code__, two.__code__)
+        self.assertIsNone(_attribute_tracer(vars(_BaseClass)['method']))
+
+        # Switching one subclass leaves the other alone
+        disable(_SubClassTwo)
+        _SubClassTwo().method(0)
+        self.assertListEqual(_output.mock_calls, [])
+        enable(_SubClassTwo)
+
+        self.assertEqual(_SubClassTwo().class_method(1), '_SubClassTwo')
+        self.assertEqual(_SubClassOne.static_method(2), 2)
+        sc = _SubClassOne()
+        self.assertEqual(sc.method(3), 3)
+
+        thread_id = id(threading.current_thread())
+        self.assertEqual(_output.mock_calls[2], self._mock.call(
+            'Thread{{{}}}:_BaseClass.static_method(a=2)'.format(thread_id)))
+        self.assertEqual(_output.mock_calls[4], self._mock.call(
+            'Thread{{{}}}:_BaseClass[{}].method(self={}, a=3)'.format(thread_id, id(sc), sc)))
+
+    def test_traced_classes_are_freed(self):
+        for i in range(20):
+            namespace = {}
+            exec('def _test_generated_{}(self):\n'
+                 '    return 1\n'.format(i), namespace)
+            base = type('_TestGeneratedBase', (object,),
+                        {'method': namespace['_test_generated_{}'.format(i)]})
+            trace(type('_TestGeneratedClass', (base,), {}), timing=True)().method()
+        gc.collect()
+        self.assertListEqual([tracer for tracer in _tracers
+                              if tracer.function_name.startswith('_test_generated_')], [])
+        self.assertListEqual([key for key in _wrapper_code.keys()
+                              if key[1].startswith('_TestGeneratedBase.')], [])
+
+    @unittest.skipIf(sys.version_info < (3,), 'Keyword-only arguments need Python 3')
+    def test_keyword_only_arguments(self):
+        namespace = {'trace': trace}
+        exec('@trace\n'
+             'def _test_func(a, *, b=2, **kwargs):\n'
+             '    return a + b\n', namespace)
+        self.assertEqual(namespace['_test_func'](1, b=3), 4)
+        thread_id = id(threading.current_thread())
+        self.assertEqual(_output.mock_calls[0], self._mock.call(
+            'Thread{{{}}}:_test_func(a=1, b=3)'.format(thread_id)))
+
+    @unittest.skipIf(sys.version_info < (3, 8), 'Positional-only parameters need Python 3.8')
+    def test_positional_only_arguments(self):
+        namespace = {}
+        exec('def _test_update(self, other=(), /, **kwds):\n'
+             '    return self, other, kwds\n'
+             'def _test_single(a, /):\n'
+             '    return a\n', namespace)
+        update = trace(namespace['_test_update'])
+        single = trace(namespace['_test_single'])
+        self.assertTrue(update.__code__.co_filename.startswith('<calltrace'))
+        self.assertEqual(inspect.signature(update),
+                         inspect.signature(namespace['_test_update']))
+        self.assertEqual(update(0, self=1, other=2), (0, (), {'self': 1, 'other': 2}))
+        self.assertEqual(single(1), 1)
+        self.assertRaises(TypeError, single, a=1)
+        thread_id = id(threading.current_thread())
+        self.assertEqual(_output.mock_calls[0], self._mock.call(
+            'Thread{{{}}}:[{}]._test_update(self=0, self=1, other=2)'.format(thread_id, id(0))))
+
+        shown = trace(namespace['_test_update'], show_defaults=True)
+        self.assertListEqual(shown.tracer.bound_arguments((0,), {'self': 1}),
+                             [('self', 0), ('other', ()), ('self', 1)])
+
+    def test_wrapper_metadata(self):
+        class _TestClass(object):
+            def method(self, a=1):
+                """Documented."""
+                return a
+        _TestClass.method.custom = 'kept'
+        original = _TestClass.method
+
+        trace(_TestClass)
+        traced = vars(_TestClass)['method']
+        self.assertEqual(traced.__module__, __name__)
+        self.assertEqual(traced.__qualname__, original.__qualname__)
+        self.assertEqual(traced.__doc__, 'Documented.')
+        self.assertEqual(traced.custom, 'kept')
+        self.assertIs(traced.__wrapped__, original)
+        self.assertEqual(str(inspect.signature(traced)), '(self, a=1)')
+
+        # The source of the wrapper is kept for tracebacks while the wrapper exists
+        filename = traced.__code__.co_filename
+        self.assertIn(filename, linecache.cache)
+        del traced
+        untrace(_TestClass)
+        gc.collect()
+        self.assertNotIn(filename, linecache.cache)
+
+
+class _TestArgumentFormatter(unittest.TestCase):
+    def test_same_as_str_when_small(self):
+        formatter = _ArgumentFormatter()
+        values = ['bla', 12, -3.5, True, None, b'bytes', bytearray(b'array'), [1, 'a', None],
+                  (1,), (1, 2), {'x': [1, 2], 'y': {'z': (3,)}}, {1}, frozenset([2]), set(),
+                  frozenset(), [], (), {}, collections.OrderedDict([('a', 1)]), object()]
+        point = collections.namedtuple('Point', 'x y')
+        values += [collections.deque([1, 'a']), collections.deque([1], maxlen=3),
+                   collections.Counter('aab'), collections.defaultdict(list, {'a': [1]}),
+                   collections.OrderedDict(), point(1, 'b'), type('_TestList', (list,), {})([1])]
+        for value in values:
+            self.assertEqual(formatter.format(value), str(value))
+
+    def test_derived_containers_are_bounded(self):
+        formatter = _ArgumentFormatter(max_items=3)
+        big = collections.OrderedDict((i, i) for i in range(200000))
+        expected = ('OrderedDict([(0, 0), (1, 1), (2, 2), ...])' if sys.version_info < (3, 12)
+                    else 'OrderedDict({0: 0, 1: 1, 2: 2, ...})')
+        self.assertEqual(formatter.format(big), expected)
+        self.assertEqual(formatter.format(collections.deque(range(100000))),
+                         'deque([0, 1, 2, ...])')
+        self.assertEqual(formatter.format(type('_TestDict', (dict,), {})(big)),
+                         '{0: 0, 1: 1, 2: 2, ...}')
+
+        class _TestOwnRepr(list):
+            def __repr__(self):
+                return 'own'
+        self.assertEqual(formatter.format(_TestOwnRepr(range(100))), 'own')
+
+    def test_max_length(self):
+        formatter = _ArgumentFormatter(max_length=10)
+        self.assertEqual(formatter.format('a' * 100), 'aaaaaaa...')
+        self.assertEqual(formatter.format(b'a' * (50 * 1024 * 1024)), "b'aaaaa...")
+        self.assertEqual(formatter.format(list(range(1000000))), '[0, 1, ...')
+        self.assertEqual(formatter.format(10 ** 1000), '<int of 3322 bits>')
+
+        class _LongStr(object):
+            def __str__(self):
+                return 'x' * 100
+        self.assertEqual(formatter.format(_LongStr()), 'xxxxxxx...')
+
+    def test_max_items(self):
+        formatter = _ArgumentFormatter(max_items=3)
+        self.assertEqual(formatter.format(list(range(10))), '[0, 1, 2, ...]')
+        self.assertEqual(formatter.format(tuple(range(10))), '(0, 1, 2, ...)')
+        self.assertEqual(formatter.format(dict.fromkeys(range(10), 1)), '{0: 1, 1: 1, 2: 1, ...}')
+
+    def test_max_depth(self):
+        formatter = _ArgumentFormatter(max_depth=2)
+        self.assertEqual(formatter.format([[[1]], {'a': {'b': 1}}]), "[[[...]], {'a': {...}}]")
+
+        recursive = []
+        recursive.append(recursive)
+        self.assertEqual(formatter.format(recursive), '[[[...]]]')
+
+    def test_numpy_like(self):
+        class ndarray(object):
+            ndim = 2
+            shape = (1000, 3)
+            dtype = 'float64'
+
+        class float64(float):
+            ndim = 0
+            shape = ()
+            dtype = 'float64'
+        ndarray.__module__ = float64.__module__ = 'numpy'
+        formatter = _ArgumentFormatter()
+        self.assertEqual(formatter.format(ndarray()), 'ndarray(shape=(1000, 3), dtype=float64)')
+        self.assertEqual(formatter.format(float64(1.5)), '1.5')
+
+    def test_unprintable(self):
+        class _TestBroken(object):
+            def __str__(self):
+                raise ValueError('no text')
+
+            __repr__ = __str__
+
+        broken = _TestBroken()
+        self.assertEqual(_safe_str(broken),
+                         '<unprintable _TestBroken at 0x{:x}>'.format(id(broken)))
+        self.assertEqual(_safe_str(broken, limited=False), _safe_str(broken))
+        self.assertTrue(_safe_str([broken]).startswith('<unprintable list at 0x'))
+
+    def test_custom_formatter(self):
+        class _Base(object):
+            pass
+
+        class _Derived(_Base):
+            pass
+
+        formatter = _ArgumentFormatter(max_length=20)
+        formatter.register(_Base, lambda obj: 'custom' * 10)
+        self.assertEqual(formatter.format(_Derived()), 'customcustomcusto...')
+        self.assertEqual(formatter.format([_Base()]), '[customcustomcust...')
+
+        formatter.register(_Base, None)
+        self.assertEqual(formatter.format(_Base()), str(_Base())[:17] + '...')
+
+    def test_limits_used_for_traces(self):
+        @trace
+        def _test_func(a):
+            pass
+
+        ring = RingBufferSink()
+        set_sink(ring)
+        set_format_limits(max_items=2)
+        try:
+            _test_func(list(range(10)))
+            self.assertTrue(ring.lines()[0].endswith('_test_func(a=[0, 1, ...])'))
+        finally:
+            set_format_limits(max_items=20)
+            set_sink(None)
+
+
+class _TestThreadState(_OutputMockTestCase):
+    def test_state_cached_per_thread(self):
+        states = []
+
+        def _collect():
+            states.append(_thread_state())
+            states.append(_thread_state())
+
+        threads = [threading.Thread(target=_collect) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertIs(states[0], states[1])
+        self.assertEqual(len(set(id(state) for state in states)), 4)
+        self.assertIsNot(_thread_state(), states[0])
+
+    def test_many_threads(self):
+        @trace
+        class _TestClass(object):
+            def name(self):
+                return 'name'
+
+            def __str__(self):
+                # Traced call while formatting, suppressed only in the formatting thread
+                return self.name()
+
+            def method(self, a):
+                return a
+
+        tc = _TestClass()
+        barrier = threading.Barrier(64) if hasattr(threading, 'Barrier') else None
+
+        def _worker(i):
+            if barrier is not None:
+                barrier.wait()
+            for _ in range(10):
+                tc.method(i)
+
+        threads = [threading.Thread(target=_worker, args=(i,)) for i in range(64)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        messages = [call[1][0] for call in _output.mock_calls]
+        self.assertEqual(len(messages), 64 * 10 * 2)
+        thread_ids = set(re.match(r'Thread{(\d+)}', msg).group(1) for msg in messages)
+        self.assertEqual(len(thread_ids), 64)
+        self.assertEqual(len([msg for msg in messages if '.name' in msg]), 0)
+
+
+@unittest.skipIf(sys.version_info < (3, 7), 'Requires asyncio.run()')
+class _TestAsyncio(_OutputMockTestCase):
+    def _messages(self):
+        return [call[1][0] for call in _output.mock_calls]
+
+    def test_coroutine(self):
+        import asyncio
+
+        # Defined in a string to keep the module importable in Python 2
+        namespace = {'asyncio': asyncio}
+        exec('async def _test_coroutine(a):\n'
+             '    await asyncio.sleep(0.01)\n'
+             '    return a * 2\n', namespace)
+        traced = trace(namespace['_test_coroutine'])
+        self.assertTrue(inspect.iscoroutinefunction(traced))
+
+        async def _main():
+            task = asyncio.ensure_future(traced(21))
+            return await task, id(task)
+
+        ret, task_id = asyncio.run(_main())
+        self.assertEqual(ret, 42)
+
+        thread_id = id(threading.current_thread())
+        messages = self._messages()
+        self.assertEqual(len(messages), 2)
+        self.assertEqual(messages[0], 'Thread{{{}}}:Task{{{}}}:_test_coroutine(a=21)'
+                                      .format(thread_id, task_id))
+        prefix = re.escape('Thread{{{}}}:Task{{{}}}:'.format(thread_id, task_id))
+        self.assertRegex(messages[1],
+                         '^' + prefix + r'_test_coroutine returned 42 after \d+\.\dms$')
+
+        entry, = [entry for entry in stats() if entry['name'] == '_test_coroutine']
+        self.assertGreaterEqual(entry['min'], 10 * 1000 * 1000)
+
+    def test_coroutine_exception(self):
+        import asyncio
+
+        namespace = {'asyncio': asyncio}
+        exec('async def _test_coroutine():\n'
+             '    await asyncio.sleep(0)\n'
+             '    raise TypeError("badaboom")\n', namespace)
+        traced = trace(namespace['_test_coroutine'])
+
+        with self.assertRaises(TypeError):
+            asyncio.run(traced())
+
+        messages = self._messages()
+        self.assertEqual(len(messages), 3)
+        self.assertIn('_test_coroutine raised an exception after', messages[1])
+        self.assertIn('TypeError: badaboom', messages[2])
+
+    def test_generator(self):
+        @trace
+        def _test_generator(n):
+            for i in range(n):
+                yield i
+            return 'done'
+
+        generator = _test_generator(3)
+        self.assertListEqual(_output.mock_calls, [])
+        self.assertListEqual(list(generator), [0, 1, 2])
+
+        thread_id = id(threading.current_thread())
+        self.assertListEqual(self._messages(),
+                             ['Thread{{{}}}:_test_generator(n=3)'.format(thread_id),
+                              'Thread{{{}}}:_test_generator returned done'.format(thread_id)])
+
+    def test_generator_send_and_close(self):
+        @trace
+        def _test_generator():
+            total = 0
+            while True:
+                total += yield total
+
+        generator = _test_generator()
+        next(generator)
+        self.assertEqual(generator.send(5), 5)
+        self.assertEqual(generator.send(3), 8)
+        generator.close()
+
+        thread_id = id(threading.current_thread())
+        self.assertListEqual(self._messages(),
+                             ['Thread{{{}}}:_test_generator()'.format(thread_id),
+                              'Thread{{{}}}:_test_generator returned None'.format(thread_id)])
+
+    def test_async_generator(self):
+        import asyncio
+
+        namespace = {'asyncio': asyncio}
+        exec('async def _test_async_generator(n):\n'
+             '    for i in range(n):\n'
+             '        await asyncio.sleep(0)\n'
+             '        yield i\n', namespace)
+        traced = trace(namespace['_test_async_generator'])
+
+        async def _main():
+            return [i async for i in traced(3)]
+
+        self.assertListEqual(asyncio.run(_main()), [0, 1, 2])
+
+        messages = self._messages()
+        self.assertEqual(len(messages), 2)
+        self.assertTrue(messages[0].endswith(':_test_async_generator(n=3)'))
+        self.assertIn(':_test_async_generator returned None after', messages[1])
+
+    def test_async_generator_athrow(self):
+        import asyncio
+
+        namespace = {}
+        exec('async def _test_async_generator():\n'
+             '    try:\n'
+             '        yield 1\n'
+             '    except ValueError:\n'
+             '        yield 2\n', namespace)
+        traced = trace(namespace['_test_async_generator'])
+
+        async def _main():
+            generator = traced()
+            first = await generator.asend(None)
+            second = await generator.athrow(ValueError())
+            await generator.aclose()
+            return first, second
+
+        self.assertEqual(asyncio.run(_main()), (1, 2))
+        self.assertIn('returned None', self._messages()[1])
+
+    def test_disabled_generators(self):
+        import asyncio
+
+        namespace = {}
+        exec('async def _test_async_generator(n):\n'
+             '    for i in range(n):\n'
+             '        yield i\n', namespace)
+        traced_async = trace(namespace['_test_async_generator'])
+
+        @trace
+        def _test_generator(n):
+            return (yield from range(n))
+
+        # Disabled tracers hand out the generators of the traced functions themselves
+        disable(traced_async)
+        disable(_test_generator)
+        async_generator = traced_async(2)
+        self.assertIs(async_generator.ag_code, namespace['_test_async_generator'].__code__)
+        generator = _test_generator(2)
+        self.assertIs(generator.gi_code, _test_generator.__wrapped__.__code__)
+
+        async def _main():
+            return [i async for i in async_generator]
+
+        self.assertListEqual(asyncio.run(_main()), [0, 1])
+        self.assertListEqual(list(generator), [0, 1])
+        self.assertListEqual(_output.mock_calls, [])
+
+        enable(traced_async)
+        enable(_test_generator)
+        self.assertListEqual(list(_test_generator(2)), [0, 1])
+        self.assertEqual(len(self._messages()), 2)
+
+
+class _TestAsyncOutput(_OutputMockTestCase):
+    def tearDown(self):
+        stop_async_output()
+        super(_TestAsyncOutput, self).tearDown()
+
+    def test_traces_written_by_writer_thread(self):
+        @trace
+        def _test_func(a):
+            return a
+
+        writer_threads = []
+        _output.side_effect = lambda msg: writer_threads.append(threading.current_thread())
+
+        start_async_output()
+        self.assertEqual(_test_func(1), 1)
+        flush()
+
+        thread_id = id(threading.current_thread())
+        expected = [self._mock.call('Thread{{{}}}:_test_func(a=1)'.format(thread_id)),
+                    self._mock.call('Thread{{{}}}:_test_func returned 1'.format(thread_id))]
+        self.assertListEqual(_output.mock_calls, expected)
+        self.assertNotIn(threading.current_thread(), writer_threads)
+
+    def test_stop_writes_pending_traces(self):
+        @trace
+        def _test_func(a):
+            return a
+
+        start_async_output()
+        for i in range(100):
+            _test_func(i)
+        stop_async_output()
+
+        thread_id = id(threading.current_thread())
+        expected = []
+        for i in range(100):
+            expected.append(self._mock.call('Thread{{{}}}:_test_func(a={})'.format(thread_id, i)))
+            expected.append(self._mock.call('Thread{{{}}}:_test_func returned {}'
+                                            .format(thread_id, i)))
+        self.assertListEqual(_output.mock_calls, expected)
+
+    def test_drop_newest(self):
+        writer = _AsyncWriter(3, DROP_NEWEST, 10)
+        for i in range(5):
+            writer.put(i)
+        self.assertEqual(writer.dropped, 2)
+        self.assertListEqual(list(writer._queue), [0, 1, 2])
+
+    def test_drop_oldest(self):
+        writer = _AsyncWriter(3, DROP_OLDEST, 10)
+        for i in range(5):
+            writer.put(i)
+        self.assertEqual(writer.dropped, 2)
+        self.assertListEqual(list(writer._queue), [2, 3, 4])
+
+    def test_block(self):
+        @trace
+        def _test_func(a):
+            return a
+
+        start_async_output(queue_size=2, overflow=BLOCK, batch_size=1)
+        for i in range(50):
+            _test_func(i)
+        flush()
+        self.assertEqual(dropped_count(), 0)
+        self.assertEqual(len(_output.mock_calls), 100)
+
+    def test_formatting_deferred_to_writer_thread(self):
+        formatting_threads = []
+
+        class _Argument(object):
+            def __str__(self):
+                formatting_threads.append(threading.current_thread())
+                return 'argument'
+
+        @trace
+        def _test_func(a):
+            return a
+
+        start_async_output()
+        _test_func(_Argument())
+        flush()
+
+        self.assertTrue(formatting_threads)
+        self.assertNotIn(threading.current_thread(), formatting_threads)
+
+    def test_arguments_by_reference(self):
+        global _writer
+
+        @trace
+        def _test_func(a):
+            pass
+
+        # Do not start the writer thread yet, so the argument changes before it is written
+        _writer = _AsyncWriter(10, BLOCK, 10)
+        arg = [1]
+        _test_func(arg)
+        arg.append(2)
+        _writer.start()
+        stop_async_output()
+
+        thread_id = id(threading.current_thread())
+        self.assertEqual(_output.mock_calls[0],
+                         self._mock.call('Thread{{{}}}:_test_func(a=[1, 2])'.format(thread_id)))
+
+    def test_arguments_snapshot(self):
+        @trace
+        def _test_func(a, b):
+            pass
+
+        start_async_output(snapshot=True)
+        arg = [1]
+        kwarg = {'x': 1}
+        _test_func(arg, b=kwarg)
+        arg.append(2)
+        kwarg['y'] = 2
+        flush()
+
+        thread_id = id(threading.current_thread())
+        self.assertEqual(_output.mock_calls[0],
+                         self._mock.call("Thread{{{}}}:_test_func(a=[1], b={{'x': 1}})"
+                                         .format(thread_id)))
+
+    def test_unknown_overflow_policy(self):
+        with self.assertRaises(ValueError):
+            start_async_output(overflow='explode')
+
+
+class _TestBinarySink(_OutputMockTestCase):
+    def setUp(self):
+        super(_TestBinarySink, self).setUp()
+        import tempfile
+        self._directory = tempfile.mkdtemp()
+
+        @trace
+        class _TestClass(object):
+            def method(self, a, b=2):
+                return a+b
+
+            @staticmethod
+            def boom():
+                raise TypeError('badaboom')
+
+        self._test_instance = _TestClass()
+
+    def tearDown(self):
+        import shutil
+        set_sink(None)
+        super(_TestBinarySink, self).tearDown()
+        shutil.rmtree(self._directory)
+
+    def _trace_calls(self):
+        tc = self._test_instance
+        tc.method(1, b=3)
+        tc.method(4)
+        with self.assertRaises(TypeError):
+            tc.boom()
+
+    def test_decode_gives_text_output(self):
+        import os
+        self._trace_calls()
+        text_output = list(_output.mock_calls)
+        _output.reset_mock()
+
+        path = os.path.join(self._directory, 'trace.bin')
+        set_sink(BinarySink(path))
+        self._trace_calls()
+        set_sink(None)[0].close()
+        self.assertListEqual(_output.mock_calls, [])
+
+        decoded = list(decode(path))
+        self.assertListEqual([self._mock.call(msg) for _, msg in decoded], text_output)
+        timestamps = [timestamp for timestamp, _ in decoded]
+        self.assertListEqual(timestamps, sorted(timestamps))
+
+    def test_sites_and_threads_written_once(self):
+        import os
+        path = os.path.join(self._directory, 'trace.bin')
+
+        @trace
+        def _test_func():
+            pass
+
+        set_sink(BinarySink(path, payload=False))
+        for _ in range(10):
+            _test_func()
+        set_sink(None)[0].close()
+
+        # magic + site + thread + 20 traces without payload
+        expected_size = (len(_BINARY_MAGIC) + len(_test_func.tracer.name_format) +
+                         22 * _binary_header.size)
+        self.assertEqual(os.path.getsize(path), expected_size)
+
+        thread_id = id(threading.current_thread())
+        decoded = [msg for _, msg in decode(path)]
+        self.assertEqual(decoded[0], 'Thread{{{}}}:_test_func(...)'.format(thread_id))
+        self.assertEqual(decoded[1], 'Thread{{{}}}:_test_func returned ...'.format(thread_id))
+
+    def test_decode_command(self):
+        import os
+        path = os.path.join(self._directory, 'trace.bin')
+        set_sink(BinarySink(path))
+        self._trace_calls()
+        set_sink(None)[0].close()
+
+        self.assertEqual(_main(['decode', path]), 0)
+        self.assertEqual(len(_output.mock_calls), 7)
+
+    def test_not_a_trace_file(self):
+        import os
+        path = os.path.join(self._directory, 'trace.bin')
+        with open(path, 'wb') as f:
+            f.write(b'garbage garbage')
+        with self.assertRaises(ValueError):
+            list(decode(path))
+
+
+class _TestShardSink(_OutputMockTestCase):
+    def setUp(self):
+        super(_TestShardSink, self).setUp()
+        import tempfile
+        self._directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        import shutil
+        set_sink(None)
+        super(_TestShardSink, self).tearDown()
+        shutil.rmtree(self._directory)
+
+    @unittest.skipIf(not hasattr(os, 'register_at_fork'), 'Needs os.register_at_fork')
+    def test_forked_child_writes_own_shard(self):
+        @trace
+        def _test_func(a):
+            return a
+
+        set_sink(ShardSink(self._directory))
+        _test_func(1)
+        pid = os.fork()
+        if pid == 0:
+            try:
+                _test_func(2)
+                flush()
+            finally:
+                os._exit(0)
+        os.waitpid(pid, 0)
+        _test_func(3)
+        set_sink(None)[0].close()
+
+        self.assertListEqual(sorted(os.listdir(self._directory)),
+                             sorted(['calltrace.{}.bin'.format(os.getpid()),
+                                     'calltrace.{}.bin'.format(pid)]))
+
+        # The child drops the traces its parent had buffered before the fork
+        thread_id = id(threading.current_thread())
+        merged = [msg for _, msg in merge([self._directory])]
+        parent = 'Process{{{}}}:Thread{{{}}}:'.format(os.getpid(), thread_id)
+        child = 'Process{{{}}}:Thread{{{}}}:'.format(pid, thread_id)
+        expected = [parent + '_test_func(a=1)', parent + '_test_func returned 1',
+                    child + '_test_func(a=2)', child + '_test_func returned 2',
+                    parent + '_test_func(a=3)', parent + '_test_func returned 3']
+        self.assertListEqual(merged, expected)
+
+        self.assertEqual(_main(['merge', self._directory]), 0)
+        self.assertListEqual(_output.mock_calls, [self._mock.call(msg) for msg in expected])
+
+    @unittest.skipIf(not hasattr(os, 'register_at_fork'), 'Needs os.register_at_fork')
+    def test_locks_held_at_fork(self):
+        @trace
+        class _TestClass(object):
+            def boom(self):
+                raise ValueError()
+
+        tree = CallTreeSink()
+        recorder = FlightRecorder(output=lambda line: None)
+        set_sink(tree)
+        add_sink(recorder)
+        set_instance_registry(True)
+        # As if other threads held the locks while forking
+        locks = [tree._lock, recorder._lock, _traceback_limiter._lock, _instances._lock]
+        for lock in locks:
+            lock.acquire()
+        try:
+            pid = os.fork()
+            if pid == 0:
+                try:
+                    import signal
+                    signal.alarm(5)
+                    try:
+                        _TestClass().boom()
+                    except ValueError:
+                        pass
+                    recorder.dump()
+                finally:
+                    os._exit(0)
+        finally:
+            for lock in locks:
+                lock.release()
+            set_instance_registry(False)
+            set_sink(None)
+        _, status = os.waitpid(pid, 0)
+        self.assertTrue(os.WIFEXITED(status))
+
+    def test_merge_orders_by_timestamp(self):
+        @trace
+        def _test_func(a):
+            return a
+
+        first = os.path.join(self._directory, 'first.bin')
+        second = os.path.join(self._directory, 'second.bin')
+        set_sink(BinarySink(first))
+        _test_func(1)
+        add_sink(BinarySink(second))
+        _test_func(2)
+        for sink in set_sink(None):
+            sink.close()
+
+        timestamps = [timestamp for timestamp, _ in merge([second, first])]
+        self.assertEqual(len(timestamps), 6)
+        self.assertListEqual(timestamps, sorted(timestamps))
+
+
+class _TestSinks(_OutputMockTestCase):
+    def setUp(self):
+        super(_TestSinks, self).setUp()
+        import tempfile
+        self._directory = tempfile.mkdtemp()
+
+        @trace(timing=True)
+        class _TestClass(object):
+            def method(self, a, b=2):
+                return a+b
+
+            def boom(self):
+                raise TypeError('badaboom')
+
+        self._test_instance = _TestClass()
+
+    def tearDown(self):
+        import shutil
+        set_sink(None)
+        super(_TestSinks, self).tearDown()
+        shutil.rmtree(self._directory)
+
+    def test_structured_fields(self):
+        events = []
+
+        class _ListSink(Sink):
+            def emit(self, event):
+                events.append(event)
+
+        set_sink(_ListSink())
+        tc = self._test_instance
+        tc.method(1, b=3)
+        with self.assertRaises(TypeError):
+            tc.boom()
+        self.assertListEqual(_output.mock_calls, [])
+
+        call, ret, call_boom, exception = events
+        self.assertEqual(call['event'], 'call')
+        self.assertEqual(call['function'], 'method')
+        self.assertEqual(call['class'], '_TestClass')
+        self.assertEqual(call['instance'], id(tc))
+        self.assertEqual(call['thread'], id(threading.current_thread()))
+        self.assertIsNone(call['task'])
+        self.assertListEqual(list(call['args'].items()), [('self', tc), ('a', 1), ('b', 3)])
+
+        self.assertEqual(ret['event'], 'return')
+        self.assertEqual(ret['return_value'], 4)
+        self.assertGreater(ret['duration'], 0)
+        self.assertGreaterEqual(ret['timestamp'], call['timestamp'])
+
+        self.assertEqual(exception['event'], 'exception')
+        self.assertIsInstance(exception['exception'], TypeError)
+        self.assertIn('TypeError: badaboom', exception['traceback'])
+
+    def test_logging_sink(self):
+        records = []
+
+        class _Handler(logging.Handler):
+            def emit(self, record):
+                records.append(record)
+
+        logger = logging.getLogger('calltrace.test')
+        logger.propagate = False
+        logger.setLevel(logging.DEBUG)
+        handler = _Handler()
+        logger.addHandler(handler)
+        try:
+            set_sink(LoggingSink(logger, logging.INFO))
+            self._test_instance.method(5)
+        finally:
+            logger.removeHandler(handler)
+
+        self.assertEqual(len(records), 2)
+        self.assertEqual(records[0].levelno, logging.INFO)
+        self.assertTrue(records[0].getMessage().endswith('.method(self={}, a=5)'
+                                                         .format(self._test_instance)))
+        self.assertEqual(records[1].calltrace['return_value'], 7)
+
+    def test_logging_sink_disabled_level(self):
+        logger = self._mock.MagicMock()
+        logger.isEnabledFor.return_value = False
+        set_sink(LoggingSink(logger))
+        self._test_instance.method(5)
+        logger.log.assert_not_called()
+
+    def test_json_lines_sink(self):
+        import os
+        path = os.path.join(self._directory, 'trace.jsonl')
+        set_sink(JsonLinesSink(path))
+        self._test_instance.method(1)
+        with self.assertRaises(TypeError):
+            self._test_instance.boom()
+        set_sink(None)[0].close()
+
+        with open(path) as f:
+            events = [json.loads(line) for line in f]
+        self.assertListEqual([event['event'] for event in events],
+                             ['call', 'return', 'call', 'exception'])
+        self.assertEqual(events[0]['args']['a'], 1)
+        self.assertEqual(events[0]['args']['self'], str(self._test_instance))
+        self.assertEqual(events[1]['return_value'], 3)
+        self.assertEqual(events[3]['exception'], 'badaboom')
+
+    def test_json_lines_sink_unsupported_values(self):
+        path = os.path.join(self._directory, 'trace.jsonl')
+        set_sink(JsonLinesSink(path))
+        loop = []
+        loop.append(loop)
+        self.assertEqual(self._test_instance.method([{(1, 2): 'x'}], b=[]), [{(1, 2): 'x'}])
+        self.assertEqual(self._test_instance.method(loop, b=[]), [loop])
+        set_sink(None)[0].close()
+
+        with open(path) as f:
+            events = [json.loads(line) for line in f]
+        self.assertListEqual([event['event'] for event in events], ['call', 'return'] * 2)
+        self.assertEqual(events[0]['args']['a'], "[{(1, 2): 'x'}]")
+        self.assertEqual(events[1]['return_value'], "[{(1, 2): 'x'}]")
+        self.assertTrue(events[2]['args']['a'].startswith('[['))
+
+    def test_failing_sink(self):
+        class _FailingSink(Sink):
+            def emit(self, event):
+                raise ValueError('broken sink')
+
+        ring = RingBufferSink()
+        set_sink(_FailingSink())
+        add_sink(ring)
+        with self._mock.patch('sys.stderr', new_callable=io.StringIO) as stderr:
+            self.assertEqual(self._test_instance.method(1), 3)
+            with self.assertRaises(TypeError):
+                self._test_instance.boom()
+
+        # Reported once, the other sinks still get all traces
+        self.assertEqual(stderr.getvalue().count('ValueError: broken sink'), 1)
+        self.assertEqual(len(ring.events()), 4)
+
+    @unittest.skipIf(not hasattr(os, 'register_at_fork'), 'Needs os.register_at_fork')
+    def test_json_lines_sink_after_fork(self):
+        path = os.path.join(self._directory, 'trace.jsonl')
+        set_sink(JsonLinesSink(path))
+        self._test_instance.method(1)
+        pid = os.fork()
+        if pid == 0:
+            try:
+                self._test_instance.method(2)
+                flush()
+                set_sink(None)[0].close()
+            finally:
+                os._exit(0)
+        os.waitpid(pid, 0)
+        self._test_instance.method(3)
+        set_sink(None)[0].close()
+
+        # The child neither writes the lines buffered by its parent nor its own
+        with open(path) as f:
+            events = [json.loads(line) for line in f]
+        self.assertListEqual([event['event'] for event in events], ['call', 'return'] * 2)
+        self.assertListEqual([event['args']['a'] for event in events[::2]], [1, 3])
+
+    def test_ring_buffer_sink(self):
+        ring = RingBufferSink(capacity=3)
+        set_sink(ring)
+        for i in range(3):
+            self._test_instance.method(i)
+
+        events = ring.events()
+        self.assertListEqual([event['event'] for event in events], ['return', 'call', 'return'])
+        self.assertEqual(events[1]['args']['a'], 2)
+        self.assertEqual(len(ring.lines()), 3)
+        ring.clear()
+        self.assertListEqual(ring.events(), [])
+
+    def test_add_and_remove_sink(self):
+        ring = RingBufferSink()
+        add_sink(ring)
+        self._test_instance.method(1)
+        self.assertEqual(len(_output.mock_calls), 2)
+        self.assertEqual(len(ring.events()), 2)
+
+        remove_sink(ring)
+        self._test_instance.method(1)
+        self.assertEqual(len(_output.mock_calls), 4)
+        self.assertEqual(len(ring.events()), 2)
+
+
+class _TestStreamSink(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+        self._directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        import shutil
+        set_sink(None)
+        shutil.rmtree(self._directory)
+
+    def _wait_for_subscribers(self, sink, count):
+        deadline = time.time() + 5
+        while sum(subscriber._subscribed for subscriber in sink._subscribers) < count:
+            self.assertLess(time.time(), deadline)
+            time.sleep(0.01)
+
+    def test_overflow_after_partial_send(self):
+        class _Socket(object):
+            def __init__(self):
+                self.limit = 3
+                self.received = b''
+
+            def send(self, data):
+                self.received += data[:self.limit]
+                return min(len(data), self.limit)
+
+        connection = _Socket()
+        subscriber = _Subscriber(connection, 2)
+        subscriber.pending.extend([b'first\n', b'second\n'])
+        self.assertTrue(subscriber.send())
+        # The queue overflows while the rest of the lines waits to be sent
+        subscriber.pending.extend([b'third\n', b'fourth\n', b'fifth\n'])
+        connection.limit = 1 << 16
+        while subscriber.waiting():
+            subscriber.send()
+        self.assertEqual(connection.received, b'first\nsecond\nfourth\nfifth\n')
+
+    def test_filters_before_formatting(self):
+        formatted = []
+
+        class _Argument(object):
+            def __str__(self):
+                formatted.append(self)
+                return 'argument'
+
+        @trace
+        class _Watched(object):
+            def method(self, a):
+                return a
+
+        @trace
+        def _test_unwatched(a):
+            return a
+
+        sink = StreamSink(os.path.join(self._directory, 'trace.sock'))
+        set_sink(sink)
+        watched = subscribe(sink.address, functions='_Watched.*')
+        slow = subscribe(sink.address, min_duration=3600)
+        self._wait_for_subscribers(sink, 2)
+
+        instance = _Watched()
+        instance.method(1)
+        _test_unwatched(_Argument())
+        self.assertListEqual(formatted, [])
+
+        set_sink(None)
+        sink.close()
+        lines = list(watched)
+        self.assertEqual(len(lines), 2)
+        self.assertTrue(lines[0].endswith('_Watched[{}].method(self={}, a=1)'.format(
+            id(instance), instance)))
+        self.assertTrue(lines[1].endswith('_Watched[{}].method returned 1'.format(id(instance))))
+        self.assertListEqual(list(slow), [])
+        self.assertFalse(os.path.exists(sink.address))
+
+    def test_only_replaces_sockets(self):
+        path = os.path.join(self._directory, 'trace.sock')
+        StreamSink(path).close()
+        self.assertFalse(os.path.exists(path))
+
+        # A socket left behind by a crashed process is replaced
+        import socket
+        stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        stale.bind(path)
+        stale.close()
+        StreamSink(path).close()
+
+        path = os.path.join(self._directory, 'data.txt')
+        with open(path, 'w') as f:
+            f.write('data')
+        with self.assertRaises(OSError):
+            StreamSink(path)
+        with open(path) as f:
+            self.assertEqual(f.read(), 'data')
+
+    def test_tcp_only_on_loopback(self):
+        for host in ('', '0.0.0.0'):
+            with self.assertRaises(ValueError):
+                StreamSink((host, 0))
+        StreamSink(('localhost', 0)).close()
+        StreamSink(('0.0.0.0', 0), allow_remote=True).close()
+
+    def test_tcp_and_invalid_filter(self):
+        import socket
+
+        @trace
+        def _test_func(a):
+            return a
+
+        sink = StreamSink(('127.0.0.1', 0))
+        set_sink(sink)
+        connection = socket.create_connection(sink.address)
+        connection.sendall(b'not json\n{"thread": %d}\n' % id(threading.current_thread()))
+        self._wait_for_subscribers(sink, 1)
+
+        _test_func(1)
+        thread = threading.Thread(target=_test_func, args=(2,))
+        thread.start()
+        thread.join()
+        set_sink(None)
+        sink.close()
+        lines = list(_receive_lines(connection))
+        self.assertTrue(lines[0].startswith('calltrace: invalid filter'))
+        self.assertEqual(len(lines), 3)
+        self.assertTrue(lines[1].endswith('_test_func(a=1)'))
+
+
+class _TestFlightRecorder(_OutputMockTestCase):
+    def tearDown(self):
+        set_sink(None)
+        super(_TestFlightRecorder, self).tearDown()
+
+    def test_dump_on_escaping_exception(self):
+        @trace
+        class _TestClass(object):
+            def outer(self, a):
+                self.ok()
+                return self.inner(a)
+
+            def inner(self, a):
+                raise ValueError(a)
+
+            def ok(self):
+                return 'ok'
+
+        set_sink(FlightRecorder(capacity=4))
+        tc = _TestClass()
+        tc.ok()
+        self.assertListEqual(_output.mock_calls, [])
+
+        with self.assertRaises(ValueError):
+            tc.outer(1)
+
+        thread_id = id(threading.current_thread())
+        messages = [call[1][0] for call in _output.mock_calls]
+        self.assertEqual(messages[0], 'Flight recorder dump of Thread{{{}}} (exception), last 4 '
+                                      'traces:'.format(thread_id))
+        self.assertTrue(messages[1].endswith('.ok returned ok'))
+        self.assertTrue(messages[2].endswith('.inner(self={}, a=1)'.format(tc)))
+        self.assertTrue(messages[3].endswith('.inner raised an exception'))
+        self.assertTrue(messages[4].endswith('.outer raised an exception'))
+        self.assertTrue(messages[5].startswith('Traceback'))
+        self.assertEqual(len(messages), 6)
+
+    @unittest.skipIf(sys.version_info < (3, 7), 'Requires asyncio.run()')
+    def test_dump_on_escaping_coroutine_exception(self):
+        import asyncio
+
+        namespace = {'asyncio': asyncio}
+        exec('async def _test_inner(a):\n'
+             '    await asyncio.sleep(0)\n'
+             '    raise ValueError(a)\n'
+             'async def _test_outer(a):\n'
+             '    return await _test_inner(a)\n'
+             'async def _test_handled():\n'
+             '    try:\n'
+             '        await _test_inner(0)\n'
+             '    except ValueError:\n'
+             '        return "handled"\n', namespace)
+        for name in ('_test_inner', '_test_outer', '_test_handled'):
+            namespace[name] = trace(namespace[name])
+
+        set_sink(FlightRecorder())
+        self.assertEqual(asyncio.run(namespace['_test_handled']()), 'handled')
+        self.assertListEqual(_output.mock_calls, [])
+
+        with self.assertRaises(ValueError):
+            asyncio.run(namespace['_test_outer'](1))
+        messages = [call[1][0] for call in _output.mock_calls]
+        self.assertEqual(len([message for message in messages
+                              if message.startswith('Flight recorder dump')]), 1)
+        self.assertEqual(len([message for message in messages
+                              if message.startswith('Traceback')]), 1)
+        self.assertIn('_test_inner raised an exception', messages[-3])
+        self.assertIn('_test_outer raised an exception', messages[-2])
+
+    def test_dump_on_request(self):
+        @trace
+        def _test_func(a):
+            return a
+
+        output = self._mock.MagicMock()
+        recorder = FlightRecorder(capacity=10, output=output)
+        set_sink(recorder)
+        for i in range(3):
+            _test_func(i)
+
+        worker = threading.Thread(target=_test_func, args=(10,))
+        worker.start()
+        worker.join()
+
+        recorder.dump(thread_id=id(worker))
+        self.assertEqual(len(output.mock_calls), 3)
+        recorder.dump()
+        self.assertEqual(len(output.mock_calls), 3 + 7)
+
+        # Dumped traces are forgotten
+        recorder.dump()
+        self.assertEqual(len(output.mock_calls), 10)
+        self.assertListEqual(_output.mock_calls, [])
+
+    def test_rings_of_ended_threads_are_dropped(self):
+        @trace
+        def _test_func(a):
+            return a
+
+        output = self._mock.MagicMock()
+        recorder = FlightRecorder(capacity=10, output=output)
+        set_sink(recorder)
+        worker = threading.Thread(target=_test_func, args=(1,))
+        worker.start()
+        worker.join()
+        self.assertIn(id(worker), recorder._rings)
+
+        worker = None
+        gc.collect()
+        self.assertDictEqual(recorder._rings, {})
+        self.assertDictEqual(recorder._threads, {})
+        recorder.dump()
+        self.assertListEqual(output.mock_calls, [])
+
+    def test_ring(self):
+        ring = _Ring(3)
+        self.assertListEqual(ring.take(), [])
+        for i in range(5):
+            ring.append(i)
+        self.assertListEqual(ring.take(), [2, 3, 4])
+        ring.append(5)
+        self.assertListEqual(ring.take(), [5])
+
+    @unittest.skipIf(not hasattr(os, 'kill') or sys.platform == 'win32', 'Requires signals')
+    def test_dump_on_signal(self):
+        import signal
+
+        @trace
+        def _test_func():
+            pass
+
+        recorder = FlightRecorder()
+        set_sink(recorder)
+        previous = recorder.install_signal(signal.SIGUSR1)
+        try:
+            _test_func()
+            os.kill(os.getpid(), signal.SIGUSR1)
+            # Give the interpreter a chance to run the handler
+            time.sleep(0.01)
+        finally:
+            signal.signal(signal.SIGUSR1, previous)
+        self.assertEqual(len(_output.mock_calls), 3)
+        self.assertIn('(signal)', _output.mock_calls[0][1][0])
+
+
+class _TestTiming(_OutputMockTestCase):
+    def setUp(self):
+        super(_TestTiming, self).setUp()
+        reset_stats()
+
+    def tearDown(self):
+        set_timing(False)
+        super(_TestTiming, self).tearDown()
+
+    def _stats_for(self, name):
+        return [entry for entry in stats() if entry['name'] == name]
+
+    def test_timing_option(self):
+        @trace(timing=True)
+        class _TimedClass(object):
+            def method(self):
+                pass
+
+            def boom(self):
+                raise TypeError('badaboom')
+
+        tc = _TimedClass()
+        for _ in range(10):
+            tc.method()
+        with self.assertRaises(TypeError):
+            tc.boom()
+
+        entry, = self._stats_for('_TimedClass.method')
+        self.assertEqual(entry['count'], 10)
+        self.assertEqual(entry['exceptions'], 0)
+        self.assertTrue(0 < entry['min'] <= entry['p50'] <= entry['p99'] <= entry['max'])
+        self.assertTrue(entry['min'] <= entry['mean'] <= entry['max'])
+
+        entry, = self._stats_for('_TimedClass.boom')
+        self.assertEqual(entry['count'], 1)
+        self.assertEqual(entry['exceptions'], 1)
+
+    def test_global_timing(self):
+        @trace
+        def _globally_timed():
+            pass
+
+        @trace(timing=False)
+        def _never_timed():
+            pass
+
+        _globally_timed()
+        _never_timed()
+        self.assertListEqual(self._stats_for('_globally_timed'), [])
+
+        set_timing(True)
+        _globally_timed()
+        _never_timed()
+        self.assertEqual(self._stats_for('_globally_timed')[0]['count'], 1)
+        self.assertListEqual(self._stats_for('_never_timed'), [])
+
+    def test_histogram_percentiles(self):
+        histogram = _Histogram()
+        for ns in range(1, 100001):
+            histogram.add(ns)
+        summary = histogram.summary()
+        self.assertEqual(summary['count'], 100000)
+        self.assertEqual(summary['min'], 1)
+        self.assertEqual(summary['max'], 100000)
+        for name, expected in (('p50', 50000), ('p95', 95000), ('p99', 99000)):
+            self.assertAlmostEqual(summary[name], expected, delta=expected * 0.125)
+
+    def test_report(self):
+        @trace(timing=True)
+        def _reported_function():
+            pass
+
+        _reported_function()
+        out = io.StringIO() if sys.version_info[0] >= 3 else io.BytesIO()
+        report(out)
+        lines = out.getvalue().splitlines()
+        self.assertTrue(lines[0].startswith('function'))
+        self.assertIn('_reported_function', [line.split()[0] for line in lines[1:]])
+
+
+class _TestMemoization(unittest.TestCase):
+    def setUp(self):
+        self._ring = RingBufferSink()
+        set_sink(self._ring)
+
+    def tearDown(self):
+        set_memoization_analysis(False)
+        set_sink(None)
+
+    def test_traced_and_failing_hash(self):
+        @trace(memoization=True)
+        class _TestKey(object):
+            def __init__(self, value):
+                self.value = value
+
+            def __hash__(self):
+                return hash(self.value)
+
+            def __eq__(self, other):
+                return self.value == other.value
+
+            def get(self):
+                return self.value
+
+        class _TestBrokenKey(object):
+            def __hash__(self):
+                raise ValueError('no hash')
+
+        @trace(memoization=True, aggregate_only=True)
+        def _test_lookup(key):
+            return key
+
+        key = _TestKey(1)
+        for _ in range(3):
+            self.assertEqual(key.get(), 1)
+        broken = _TestBrokenKey()
+        self.assertIs(_test_lookup(broken), broken)
+        self.assertIs(_test_lookup(key), key)
+
+        entries = dict((entry['name'], entry) for entry in memoization_stats())
+        self.assertEqual(entries['_TestKey.get']['calls'], 3)
+        self.assertEqual(entries['_TestKey.get']['repeated'], 2)
+        self.assertEqual(entries['_test_lookup']['calls'], 2)
+        self.assertEqual(entries['_test_lookup']['unhashable'], 1)
+
+    def test_repeated_arguments(self):
+        @trace(memoization=True)
+        def _test_repeated(a, b=None):
+            return a
+
+        @trace(memoization=True)
+        def _test_distinct(a):
+            return a
+
+        for i in range(100):
+            _test_repeated(i % 10, b=i % 2 * 0)
+            _test_distinct(i)
+        _test_repeated([1])
+
+        entries = dict((entry['name'], entry) for entry in memoization_stats())
+        repeated = entries['_test_repeated']
+        self.assertEqual(repeated['calls'], 101)
+        self.assertEqual(repeated['unhashable'], 1)
+        self.assertEqual(repeated['distinct'], 10)
+        self.assertEqual(repeated['repeated'], 90)
+        self.assertAlmostEqual(repeated['hit_ratio'], 90 / 101.0)
+        self.assertEqual(repeated['savings'], int(repeated['total'] * repeated['hit_ratio']))
+        self.assertEqual(entries['_test_distinct']['repeated'], 0)
+        self.assertEqual(entries['_test_distinct']['savings'], 0)
+        self.assertEqual(memoization_stats()[0]['name'], '_test_repeated')
+
+        output = io.StringIO() if sys.version_info >= (3,) else io.BytesIO()
+        memoization_report(file=output)
+        lines = output.getvalue().splitlines()
+        self.assertTrue(lines[0].startswith('function'))
+        self.assertTrue(lines[1].startswith('_test_repeated'))
+        self.assertIn('89.1%', lines[1])
+
+        reset_stats()
+        self.assertListEqual(memoization_stats(), [])
+
+    def test_global_switch(self):
+        @trace
+        def _test_func(a):
+            return a
+
+        @trace(memoization=False)
+        def _test_excluded(a):
+            return a
+
+        _test_func(1)
+        set_memoization_analysis(True)
+        for _ in range(3):
+            _test_func(1)
+            _test_excluded(1)
+
+        entries = memoization_stats()
+        self.assertEqual(len(entries), 1)
+        self.assertEqual((entries[0]['calls'], entries[0]['repeated']), (3, 2))
+
+    def test_distinct_estimate_is_bounded(self):
+        sketch = _ArgumentSketch()
+        for i in range(20000):
+            sketch.add((i, 'x'), {})
+        self.assertEqual(len(sketch.registers), 1024)
+        self.assertLess(abs(sketch.distinct() - 20000), 20000 * 0.1)
+
+
+class _TestEnableDisable(_OutputMockTestCase):
+    def tearDown(self):
+        enable()
+        super(_TestEnableDisable, self).tearDown()
+
+    def test_disable_globally(self):
+        @trace
+        def _test_func(a):
+            return a
+
+        disable()
+        self.assertFalse(is_enabled())
+        self.assertEqual(_test_func(1), 1)
+        self.assertListEqual(_output.mock_calls, [])
+
+        enable()
+        self.assertEqual(_test_func(2), 2)
+        self.assertEqual(len(_output.mock_calls), 2)
+
+    def test_disable_class(self):
+        @trace
+        class _TestClass(object):
+            def method(self):
+                return 'method'
+
+            @staticmethod
+            def static_method():
+                return 'static'
+
+            @classmethod
+            def class_method(cls):
+                return 'class'
+
+        @trace
+        def _other_func():
+            pass
+
+        disable(_TestClass)
+        self.assertFalse(is_enabled(_TestClass))
+        tc = _TestClass()
+        self.assertEqual(tc.method(), 'method')
+        self.assertEqual(tc.static_method(), 'static')
+        self.assertEqual(tc.class_method(), 'class')
+        self.assertListEqual(_output.mock_calls, [])
+
+        _other_func()
+        self.assertEqual(len(_output.mock_calls), 2)
+
+        enable(tc.method)
+        self.assertTrue(is_enabled(tc.method))
+        self.assertFalse(is_enabled(_TestClass))
+        tc.method()
+        self.assertEqual(len(_output.mock_calls), 4)
+
+    def test_tracer_disabled_individually_stays_disabled(self):
+        @trace(enabled=False)
+        def _test_func():
+            pass
+
+        disable()
+        enable()
+        _test_func()
+        self.assertListEqual(_output.mock_calls, [])
+
+    def test_not_traced(self):
+        def _test_func():
+            pass
+
+        with self.assertRaises(TypeError):
+            disable(_test_func)
+
+    def test_sample_every(self):
+        @trace(sample_every=3)
+        def _test_func(a):
+            return a
+
+        for i in range(9):
+            self.assertEqual(_test_func(i), i)
+
+        thread_id = id(threading.current_thread())
+        expected = []
+        for i in (2, 5, 8):
+            expected.append(self._mock.call('Thread{{{}}}:_test_func(a={})'.format(thread_id, i)))
+            expected.append(self._mock.call('Thread{{{}}}:_test_func returned {}'
+                                            .format(thread_id, i)))
+        self.assertListEqual(_output.mock_calls, expected)
+
+        set_sampling(_test_func)
+        _test_func(9)
+        self.assertEqual(len(_output.mock_calls), 8)
+
+    def test_sample_rate(self):
+        @trace
+        def _test_func():
+            pass
+
+        set_sampling(_test_func, rate=0.0)
+        for _ in range(100):
+            _test_func()
+        self.assertListEqual(_output.mock_calls, [])
+
+        set_sampling(_test_func, rate=0.5)
+        for _ in range(1000):
+            _test_func()
+        self.assertTrue(600 < len(_output.mock_calls) < 1400)
+
+        with self.assertRaises(ValueError):
+            set_sampling(_test_func, every=2, rate=0.5)
+
+
+class _TestUntrace(_OutputMockTestCase):
+    def test_untrace_class(self):
+        class _TestClass(object):
+            def method(self, a):
+                return a
+
+            @staticmethod
+            def static_method(a):
+                return a
+
+            @classmethod
+            def class_method(cls, a):
+                return a
+
+        originals = dict(vars(_TestClass))
+        trace(_TestClass)
+        self.assertIsNot(vars(_TestClass)['method'], originals['method'])
+
+        self.assertIs(untrace(_TestClass), _TestClass)
+        for name in ('method', 'static_method', 'class_method'):
+            self.assertIs(vars(_TestClass)[name], originals[name])
+
+        tc = _TestClass()
+        self.assertEqual(tc.method(1), 1)
+        self.assertEqual(tc.static_method(2), 2)
+        self.assertEqual(tc.class_method(3), 3)
+        self.assertListEqual(_output.mock_calls, [])
+
+    def test_untrace_sub_class(self):
+        class _BaseClass(object):
+            def method_one(self, a, b):
+                return a+b
+
+            def method_two(self, c, d):
+                return c+d
+
+        base_originals = dict(vars(_BaseClass))
+        trace(_BaseClass)
+
+        class _SubClass(_BaseClass):
+            def method_two(self, c, d):
+                return c-d
+
+            def method_three(self, e, f):
+                return e+f
+
+        sub_originals = dict(vars(_SubClass))
+        trace(_SubClass)
+
+        untrace(_SubClass)
+        self.assertDictEqual(dict(vars(_SubClass)), sub_originals)
+        sc = _SubClass()
+        self.assertEqual(sc.method_two(4, 5), -1)
+        self.assertEqual(sc.method_three(3, 1), 4)
+        self.assertListEqual(_output.mock_calls, [])
+
+        # Inherited from the base class, which is still traced
+        self.assertEqual(sc.method_one(1, 2), 3)
+        self.assertEqual(len(_output.mock_calls), 2)
+
+        untrace(_BaseClass)
+        self.assertDictEqual(dict(vars(_BaseClass)), base_originals)
+
+    def test_untrace_inherited_from_untraced_base(self):
+        class _BaseClass(object):
+            def method(self):
+                return 'base'
+
+        @trace
+        class _SubClass(_BaseClass):
+            pass
+
+        self.assertIn('method', vars(_SubClass))
+        untrace(_SubClass)
+        self.assertNotIn('method', vars(_SubClass))
+        self.assertEqual(_SubClass().method(), 'base')
+        self.assertListEqual(_output.mock_calls, [])
+
+    def test_untrace_methods_traced_in_class_body(self):
+        class _TestClass(object):
+            @trace
+            def method(self):
+                return 'method'
+
+            @staticmethod
+            @trace
+            def static_method():
+                return 'static'
+
+        untrace(_TestClass)
+        self.assertFalse(hasattr(vars(_TestClass)['method'], 'tracer'))
+        self.assertEqual(_TestClass().method(), 'method')
+        self.assertEqual(_TestClass.static_method(), 'static')
+        self.assertListEqual(_output.mock_calls, [])
+
+    def test_untrace_function(self):
+        def _test_func(a):
+            return a
+
+        traced = trace(_test_func)
+        self.assertIs(untrace(traced), _test_func)
+
+        # Remaining references to the traced function no longer trace
+        self.assertEqual(traced(1), 1)
+        self.assertListEqual(_output.mock_calls, [])
+
+
+class _TestCapture(_OutputMockTestCase):
+    def tearDown(self):
+        global _perf_counter_ns
+        set_traceback_limit()
+        _perf_counter_ns = getattr(time, 'perf_counter_ns', None) or \
+            (lambda: int(time.time() * 1e9))
+        super(_TestCapture, self).tearDown()
+
+    def _messages(self):
+        return [call[1][0].split(':', 1)[1] for call in _output.mock_calls]
+
+    def test_return_policies(self):
+        value = list(range(1000))
+        for capture in _capture_policies:
+            trace(lambda: value, returns=capture)()
+        messages = self._messages()[1::2]
+        self.assertEqual(messages[0], '<lambda> returned ...')
+        self.assertEqual(messages[1], '<lambda> returned <list>')
+        self.assertTrue(messages[2].endswith(', ...]'))
+        self.assertEqual(messages[3], '<lambda> returned ' + str(value))
+        self.assertRaises(ValueError, trace, lambda: None, returns='everything')
+
+    def test_exception_policies(self):
+        def _test_raise():
+            raise ValueError('x' * 1000)
+
+        for capture in (CAPTURE_OFF, CAPTURE_TYPE, CAPTURE_TRUNCATED):
+            self.assertRaises(ValueError, trace(_test_raise, exceptions=capture))
+        thread = 'Thread{{{}}}:'.format(id(threading.current_thread()))
+        self.assertListEqual([call[1][0] for call in _output.mock_calls],
+                             [thread + '_test_raise()', thread + '_test_raise raised an exception',
+                              thread + '_test_raise()', thread + '_test_raise raised an exception',
+                              'ValueError',
+                              thread + '_test_raise()', thread + '_test_raise raised an exception',
+                              'ValueError: ' + 'x' * 497 + '...'])
+
+    def test_traceback_limit(self):
+        global _perf_counter_ns
+        now = [0]
+        _perf_counter_ns = lambda: now[0]
+        set_traceback_limit(2, interval=10)
+
+        @trace
+        def _test_raise(a):
+            raise ValueError(a)
+
+        for i in range(4):
+            self.assertRaises(ValueError, _test_raise, i)
+        details = [call[1][0] for call in _output.mock_calls[2::3]]
+        self.assertTrue(details[0].startswith('Traceback'))
+        self.assertTrue(details[1].startswith('Traceback'))
+        self.assertEqual(_output.mock_calls[8], self._mock.call(
+            'ValueError: 2 (traceback suppressed)'))
+        self.assertEqual(_output.mock_calls[11], self._mock.call(
+            'ValueError: 3 (traceback suppressed)'))
+
+        summary = suppressed_tracebacks()
+        self.assertEqual(len(summary), 1)
+        self.assertEqual((summary[0]['exception'], summary[0]['suppressed']), ('ValueError', 2))
+
+        # A new interval starts, telling how many were suppressed
+        now[0] = 10 ** 10
+        _output.reset_mock()
+        self.assertRaises(ValueError, _test_raise, 4)
+        self.assertTrue(_output.mock_calls[2][1][0].endswith(
+            'ValueError: 4\n2 similar tracebacks were suppressed before this one\n'))
+
+    def test_traceback_limit_nested_calls(self):
+        set_traceback_limit(3)
+
+        @trace
+        def _test_inner():
+            raise ValueError('inner')
+
+        @trace
+        def _test_middle():
+            _test_inner()
+
+        @trace
+        def _test_outer():
+            _test_middle()
+
+        # Each failure counts once, not once per traced call it passes through
+        for _ in range(4):
+            self.assertRaises(ValueError, _test_outer)
+        details = [call[1][0] for call in _output.mock_calls
+                   if not call[1][0].startswith('Thread')]
+        self.assertEqual(len(details), 12)
+        self.assertTrue(all(detail.startswith('Traceback') for detail in details[:9]))
+        self.assertListEqual(details[9:], ['ValueError: inner (traceback suppressed)'] * 3)
+        self.assertEqual(suppressed_tracebacks()[0]['suppressed'], 1)
+
+
+class _TestProperties(_OutputMockTestCase):
+    @staticmethod
+    def _make_class():
+        class _Constant(object):
+            def __get__(self, instance, owner=None):
+                return 42
+
+        class _Stored(object):
+            def __get__(self, instance, owner=None):
+                return self if instance is None else instance.__dict__['stored']
+
+            def __set__(self, instance, value):
+                instance.__dict__['stored'] = value
+
+            def __delete__(self, instance):
+                del instance.__dict__['stored']
+
+        class _TestClass(object):
+            constant = _Constant()
+            stored = _Stored()
+
+            def __init__(self):
+                self._value = 1
+
+            def __str__(self):
+                return 'tc'
+
+            @property
+            def value(self):
+                return self._value
+
+            @value.setter
+            def value(self, value):
+                self._value = value
+
+            @value.deleter
+            def value(self):
+                self._value = None
+
+        return _TestClass
+
+    def _messages(self):
+        return [call[1][0].split(':', 1)[1] for call in _output.mock_calls]
 
-            def __str__(self):
-                return self.my_name()
+    def test_properties_not_traced_by_default(self):
+        _TestClass = trace(self._make_class())
+        tc = _TestClass()
+        _output.reset_mock()
+        tc.value = tc.value + tc.constant
+        self.assertEqual(tc.value, 43)
+        self.assertListEqual(_output.mock_calls, [])
 
+    def test_property_accessors(self):
+        _TestClass = trace(self._make_class(), properties=True)
         tc = _TestClass()
+        _output.reset_mock()
+        tc.value = tc.value + 1
+        del tc.value
+        self.assertIsNone(tc._value)
+        self.assertEqual(_TestClass.value.__doc__, vars(self._make_class())['value'].__doc__)
 
-        self.assertEqual(str(tc), 'My Name')
+        instance = id(tc)
+        self.assertListEqual(self._messages(), [
+            '_TestClass[{}].value.__get__(self=tc)'.format(instance),
+            '_TestClass[{}].value.__get__ returned 1'.format(instance),
+            '_TestClass[{}].value.__set__(self=tc, value=2)'.format(instance),
+            '_TestClass[{}].value.__set__ returned None'.format(instance),
+            '_TestClass[{}].value.__delete__(self=tc)'.format(instance),
+            '_TestClass[{}].value.__delete__ returned None'.format(instance)])
 
-        ret = tc.method()
-        self.assertEqual(ret, 'Return')
+    def test_descriptors(self):
+        _TestClass = trace(self._make_class(), properties=True)
+        tc = _TestClass()
+        _output.reset_mock()
+        self.assertEqual(tc.constant, 42)
+        tc.stored = 'a'
+        self.assertEqual(tc.stored, 'a')
+        del tc.stored
+        self.assertNotIn('stored', vars(tc))
 
-        thread_id = id(threading.current_thread())
-        expected = [self._mock.call('Thread{{{}}}:_TestClass[{}].__str__(self=My Name)'
-                                    .format(thread_id, id(tc))),
-                    self._mock.call('Thread{{{}}}:_TestClass[{}].my_name(self=My Name)'
-                                    .format(thread_id, id(tc))),
-                    self._mock.call('Thread{{{}}}:_TestClass[{}].my_name returned My Name'
-                                    .format(thread_id, id(tc))),
-                    self._mock.call('Thread{{{}}}:_TestClass[{}].__str__ returned My Name'
-                                    .format(thread_id, id(tc))),
-                    # Here __str__ and calls from it are suppressed
-                    self._mock.call('Thread{{{}}}:_TestClass[{}].method(self=My Name)'
-                                    .format(thread_id, id(tc))),
-                    self._mock.call('Thread{{{}}}:_TestClass[{}].method returned Return'
-                                    .format(thread_id, id(tc)))]
-        self.assertListEqual(_output.mock_calls, expected)
+        # Access through the class is not traced
+        self.assertEqual(_TestClass.constant, 42)
+        self.assertIsInstance(_TestClass.stored, object)
 
-    def test_init_prevent_access_to_members(self):
-        """
-        When tracing __init__ we must prevent calling __str__ as it can try to access the instance
-        before it is ready to use.
-        """
-        @trace
-        class _TestClass(object):
-            def __init__(self, a):
-                self._a = a
+        instance = id(tc)
+        self.assertListEqual(self._messages(), [
+            '_TestClass[{}].constant.__get__(self=tc)'.format(instance),
+            '_TestClass[{}].constant.__get__ returned 42'.format(instance),
+            '_TestClass[{}].stored.__set__(self=tc, value=a)'.format(instance),
+            '_TestClass[{}].stored.__set__ returned None'.format(instance),
+            '_TestClass[{}].stored.__get__(self=tc)'.format(instance),
+            '_TestClass[{}].stored.__get__ returned a'.format(instance),
+            '_TestClass[{}].stored.__delete__(self=tc)'.format(instance),
+            '_TestClass[{}].stored.__delete__ returned None'.format(instance)])
 
-            def __str__(self):
-                return self._a
+    def test_aggregate_only(self):
+        _TestClass = trace(self._make_class(), properties={'aggregate_only': True})
+        tc = _TestClass()
+        _output.reset_mock()
+        for _ in range(10):
+            tc.value = tc.value + 1
+        self.assertEqual(tc.value, 11)
+        self.assertListEqual(_output.mock_calls, [])
 
-        tc = _TestClass('bla')
-        thread_id = id(threading.current_thread())
-        expected = [self._mock.call('Thread{{{}}}:_TestClass[{}].__init__(a=bla)'
-                                    .format(thread_id, id(tc))),
-                    self._mock.call('Thread{{{}}}:_TestClass[{}].__init__ returned None'
-                                    .format(thread_id, id(tc)))]
-        self.assertListEqual(_output.mock_calls, expected)
+        counts = dict((entry['name'], entry['count']) for entry in stats())
+        self.assertEqual(counts['_TestClass.value.__get__'], 11)
+        self.assertEqual(counts['_TestClass.value.__set__'], 10)
+
+    def test_builtin_base_classes(self):
+        @trace(properties=True)
+        class _TestDict(dict):
+            @property
+            def size(self):
+                return len(self)
 
-    def test_method_raises_exception(self):
         @trace
-        class _TestClass(object):
-            def boom(self):
-                raise TypeError('badaboom')
+        class _TestStr(str):
+            pass
 
+        self.assertListEqual(sorted(name for name in vars(_TestDict) if not name.startswith('__')),
+                             ['size'])
+        self.assertEqual(_TestStr.maketrans('a', 'b'), {97: 98})
+        td = _TestDict(a=1)
+        _output.reset_mock()
+        self.assertEqual(td.get('a'), 1)
+        self.assertListEqual(list(td.keys()), ['a'])
+        self.assertEqual(td.size, 1)
+        self.assertListEqual(self._messages(), [
+            '_TestDict[{}].size.__get__(self={})'.format(id(td), td),
+            '_TestDict[{}].size.__get__ returned 1'.format(id(td))])
+
+    def test_slots(self):
+        @trace(properties=True)
+        class _TestSlots(object):
+            __slots__ = ('size',)
+
+            def __init__(self, size):
+                self.size = size
+
+        self.assertIsInstance(vars(_TestSlots)['size'], types.MemberDescriptorType)
+        ts = _TestSlots(3)
+        _output.reset_mock()
+        ts.size += 1
+        self.assertEqual(ts.size, 4)
+        self.assertListEqual(_output.mock_calls, [])
+
+    def test_disable_and_untrace(self):
+        original = self._make_class()
+        originals = dict(vars(original))
+        _TestClass = trace(original, properties=True)
         tc = _TestClass()
-        with self.assertRaises(TypeError):
-            tc.boom()
+        disable(_TestClass)
+        _output.reset_mock()
+        tc.value = tc.constant
+        self.assertListEqual(_output.mock_calls, [])
+        enable(_TestClass)
 
-        thread_id = id(threading.current_thread())
+        untrace(_TestClass)
+        self.assertDictEqual(dict(vars(_TestClass)), originals)
+        tc.value = tc.constant
+        self.assertListEqual(_output.mock_calls, [])
 
-        class _RegexMatch(object):
-            def __init__(self, expected_regex):
-                self._expected = expected_regex
 
-            def __eq__(self, other):
-                import re
-                return re.match(self._expected, other) is not None
+class _TestCallTree(unittest.TestCase):
+    def setUp(self):
+        global _clock
+        self._original_clock = _clock
+        _clock = functools.partial(next, itertools.count(1))
+        self._tree = CallTreeSink()
+        set_sink(self._tree)
 
-            def __repr__(self):
-                return 'Regex: ' + repr(self._expected)
+    def tearDown(self):
+        global _clock
+        set_sink(None)
+        _clock = self._original_clock
 
-        expected_traceback = _RegexMatch('Traceback \\(most recent call last\\):\n'
-                                         '  File ".*calltrace\\.py", line \\d+, in _call\n'
-                                         '    ret = self\\._func\\(\\*pargs, \\*\\*kwargs\\)\n'
-                                         '  File ".*calltrace\\.py", line \\d+, in boom\n'
-                                         '    raise TypeError\\(\'badaboom\'\\)\n'
-                                         'TypeError: badaboom\n')
+    def test_call_and_parent_ids(self):
+        @trace
+        class _TestClass(object):
+            def outer(self):
+                return self.inner()
 
-        expected = [self._mock.call('Thread{{{}}}:_TestClass[{}].boom(self={})'
-                                    .format(thread_id, id(tc), str(tc))),
-                    self._mock.call('Thread{{{}}}:_TestClass[{}].boom raised an exception'
-                                    .format(thread_id, id(tc))),
-                    self._mock.call(expected_traceback)]
-        self.assertListEqual(_output.mock_calls, expected)
+            def inner(self):
+                return 1
 
-    def test_masquerade(self):
+        ring = RingBufferSink()
+        set_sink(ring)
+        _TestClass().outer()
+        events = ring.events()
+        self.assertListEqual([event['depth'] for event in events], [0, 1, 1, 0])
+        self.assertIsNone(events[0]['parent_id'])
+        self.assertEqual(events[1]['parent_id'], events[0]['call_id'])
+        self.assertEqual(events[2]['call_id'], events[1]['call_id'])
+        self.assertEqual(events[3]['call_id'], events[0]['call_id'])
+        self.assertNotEqual(events[1]['call_id'], events[0]['call_id'])
+
+    def test_inclusive_and_exclusive_time(self):
         @trace
         class _TestClass(object):
-            def test_method(self, a, b, c, d=34):
-                """First test method"""
-                return a+b+c+d
+            def outer(self):
+                return self.inner() + self.inner()
 
-            def test_method2(self, e, f):
-                """Second test method"""
-                return e+f
+            def inner(self):
+                return 1
 
-        tc = _TestClass()
+        _TestClass().outer()
+        self.assertListEqual(self._tree.format_tree(), [
+            '_TestClass.outer count=1 inclusive=5ns exclusive=3ns',
+            '  _TestClass.inner count=2 inclusive=2ns exclusive=2ns'])
+        self.assertListEqual(self._tree.collapsed_stacks(), [
+            '_TestClass.outer 3',
+            '_TestClass.outer;_TestClass.inner 2'])
+        self.assertListEqual(self._tree.totals(), [
+            {'name': '_TestClass.outer', 'count': 1, 'inclusive': 5, 'exclusive': 3},
+            {'name': '_TestClass.inner', 'count': 2, 'inclusive': 2, 'exclusive': 2}])
 
-        self.assertEqual(tc.test_method.__name__, 'test_method')
-        self.assertEqual(tc.test_method.__doc__, 'First test method')
+    def test_recursion(self):
+        @trace
+        def fact(n):
+            return n * fact(n - 1) if n else 1
 
-        self.assertEqual(tc.test_method2.__name__, 'test_method2')
-        self.assertEqual(tc.test_method2.__doc__, 'Second test method')
+        fact(2)
+        self.assertListEqual(self._tree.collapsed_stacks(), [
+            'fact 2',
+            'fact;fact 2',
+            'fact;fact;fact 1'])
+        self.assertListEqual(self._tree.totals(), [
+            {'name': 'fact', 'count': 3, 'inclusive': 5, 'exclusive': 5}])
 
-    def test_static_method(self):
+    def test_exception_and_calls_in_progress(self):
         @trace
-        class _TestClass(object):
-            @staticmethod
-            def test_method(a, b, c, d=34):
-                return a+b+c+d
+        def _test_raise():
+            raise ValueError()
 
-        ret = _TestClass.test_method(1, 2, c=3)
-        self.assertEqual(ret, 40)
+        @trace
+        def _test_gen():
+            yield _test_raise
 
-        thread_id = id(threading.current_thread())
-        expected = [self._mock.call('Thread{{{}}}:_TestClass.test_method(a=1, b=2, c=3)'
-                                    .format(thread_id)),
-                    self._mock.call('Thread{{{}}}:_TestClass.test_method returned 40'
-                                    .format(thread_id))]
-        self.assertListEqual(_output.mock_calls, expected)
+        gen = _test_gen()
+        self.assertRaises(ValueError, next(gen))
+        self.assertListEqual(self._tree.collapsed_stacks(), ['_test_raise 1'])
 
-    def test_class_method(self):
+        self._tree.clear()
+        self.assertListEqual(self._tree.format_tree(), [])
+        self.assertRaises(StopIteration, next, gen)
+        self.assertListEqual(self._tree.totals(), [])
+
+
+class _TestTraceModule(_OutputMockTestCase):
+    _source = (
+        'from os.path import join\n'
+        '\n'
+        'def visible(a):\n'
+        '    return helper(a) + 1\n'
+        '\n'
+        'def helper(a):\n'
+        '    return a\n'
+        '\n'
+        'def _private():\n'
+        '    return 0\n'
+        '\n'
+        'class Thing(object):\n'
+        '    def public(self):\n'
+        '        return 1\n'
+        '\n'
+        '    def _hidden(self):\n'
+        '        return 2\n')
+
+    def test_name_filter(self):
+        name_filter = _NameFilter(['Class.*', 'pkg.mod.func'], re.compile(r'\._'))
+        self.assertTrue(name_filter.selects('Class.method'))
+        self.assertTrue(name_filter.selects('pkg.mod.func'))
+        self.assertFalse(name_filter.selects('MyClass.method'))
+        self.assertFalse(name_filter.selects('otherpkg.mod.func'))
+        self.assertFalse(name_filter.selects('Class._private'))
+
+        # Compiled regular expressions keep their flags
+        name_filter = _NameFilter([re.compile(r'^class\.', re.IGNORECASE), 'func'], None)
+        self.assertTrue(name_filter.selects('Class.method'))
+        self.assertTrue(name_filter.selects('func'))
+        self.assertFalse(name_filter.selects('Func'))
+
+    def test_trace_module(self):
+        import types
+        module = types.ModuleType('_calltrace_test_module')
+        exec(self._source, vars(module))
+        visible, public = module.visible, module.Thing.public
+
+        trace_module(module, exclude=['*._*', re.compile(r'\.helper$')])
+        self.assertEqual(module.visible(1), 2)
+        self.assertEqual(len(_output.mock_calls), 2)
+        self.assertTrue(_output.mock_calls[0][1][0].endswith('visible(a=1)'))
+        self.assertEqual(module.Thing().public(), 1)
+        self.assertEqual(module.Thing()._hidden(), 2)
+        self.assertEqual(module._private(), 0)
+        self.assertEqual(len(_output.mock_calls), 4)
+        self.assertIs(module.join, os.path.join)
+
+        untrace(module)
+        self.assertIs(module.visible, visible)
+        self.assertIs(module.Thing.public, public)
+        module.visible(1)
+        self.assertEqual(len(_output.mock_calls), 4)
+
+    def test_include(self):
+        import types
+        module = types.ModuleType('_calltrace_test_module')
+        exec(self._source, vars(module))
+
+        trace_module(module, include='_calltrace_test_module.Thing')
+        self.assertIsNone(_attribute_tracer(module.visible))
+        self.assertIsNotNone(_attribute_tracer(module.Thing.public))
+        self.assertIsNotNone(_attribute_tracer(module.Thing._hidden))
+
+    @unittest.skipIf(sys.version_info < (3, 4), 'Import hooks need find_spec')
+    def test_trace_package(self):
+        import importlib
+        import shutil
+        import tempfile
+        directory = tempfile.mkdtemp()
+        package = os.path.join(directory, '_calltrace_test_package')
+        os.mkdir(package)
+        with open(os.path.join(package, '__init__.py'), 'w') as f:
+            f.write('def start():\n    return 0\n')
+        with open(os.path.join(package, 'sub.py'), 'w') as f:
+            f.write('def work(a):\n    return a\n')
+        sys.path.insert(0, directory)
+        try:
+            import _calltrace_test_package
+            trace_package('_calltrace_test_package', include=['*.work', '*.start'])
+            self.assertIsNotNone(_attribute_tracer(_calltrace_test_package.start))
+
+            sub = importlib.import_module('_calltrace_test_package.sub')
+            self.assertEqual(sub.work(3), 3)
+            self.assertEqual(len(_output.mock_calls), 2)
+
+            untrace_package('_calltrace_test_package')
+            self.assertIsNone(_attribute_tracer(sub.work))
+            self.assertIsNone(_attribute_tracer(_calltrace_test_package.start))
+            self.assertFalse(any(isinstance(hook, _TracingImportHook) for hook in sys.meta_path))
+        finally:
+            untrace_package('_calltrace_test_package')
+            sys.path.remove(directory)
+            for name in list(sys.modules):
+                if name.startswith('_calltrace_test_package'):
+                    del sys.modules[name]
+            shutil.rmtree(directory)
+
+
+class _TestSlowThreshold(unittest.TestCase):
+    def setUp(self):
+        global _perf_counter_ns
+        self._now = [0]
+        _perf_counter_ns = lambda: self._now[0]
+        self._ring = RingBufferSink()
+        set_sink(self._ring)
+
+    def tearDown(self):
+        global _perf_counter_ns
+        _perf_counter_ns = getattr(time, 'perf_counter_ns', None) or \
+            (lambda: int(time.time() * 1e9))
+        set_slow_threshold(None)
+        set_sink(None)
+
+    def _sleep(self, seconds):
+        self._now[0] += int(seconds * 1e9)
+
+    def _events(self):
+        return [(event['event'], event['function'], event['depth'])
+                for event in self._ring.events()]
+
+    def test_only_slow_calls(self):
+        @trace(slow_threshold=0.1)
+        def _test_call(seconds):
+            self._sleep(seconds)
+            return seconds
+
+        _test_call(0.05)
+        self.assertListEqual(self._ring.events(), [])
+        _test_call(0.2)
+        events = self._ring.events()
+        self.assertListEqual([event['event'] for event in events], ['call', 'return'])
+        self.assertEqual(events[0]['args'], {'seconds': 0.2})
+        self.assertEqual(events[1]['duration'], 2 * 10 ** 8)
+        self.assertEqual(_test_call.tracer.histogram.count, 2)
+
+    def test_exceptions(self):
+        @trace(slow_threshold=0.1)
+        def _test_raise():
+            raise ValueError()
+
+        self.assertRaises(ValueError, _test_raise)
+        self.assertListEqual(self._events(), [('call', '_test_raise', 0),
+                                              ('exception', '_test_raise', 0)])
+
+    def test_nested_calls(self):
         @trace
-        class _TestClass(object):
-            @classmethod
-            def test_method(cls, a, b, c, d=34):
-                return a+b+c+d
+        def _test_inner(seconds):
+            self._sleep(seconds)
 
-        ret = _TestClass.test_method(1, 2, c=3)
-        self.assertEqual(ret, 40)
+        @trace
+        def _test_outer():
+            _test_inner(0.01)
+            _test_inner(0.2)
+            _test_inner(0.01)
 
-        thread_id = id(threading.current_thread())
-        expected = [self._mock.call('Thread{{{}}}:_TestClass.test_method(cls={}, a=1, b=2, c=3)'
-                                    .format(thread_id, str(_TestClass))),
-                    self._mock.call('Thread{{{}}}:_TestClass.test_method returned 40'
-                                    .format(thread_id))]
-        self.assertListEqual(_output.mock_calls, expected)
+        set_slow_threshold(0.1)
+        _test_outer()
+        self.assertListEqual(self._events(), [('call', '_test_outer', 0),
+                                              ('call', '_test_inner', 1),
+                                              ('return', '_test_inner', 1),
+                                              ('return', '_test_outer', 0)])
 
-    def test_sub_class(self):
+        # The outer call is written along with the slow inner call, even if below its threshold
+        self._ring.clear()
+        _test_outer.tracer.slow_threshold = 10
+        _test_outer()
+        self.assertListEqual([event[0] for event in self._events()],
+                             ['call', 'call', 'return', 'return'])
+
+        # Calls traced without threshold are always written, with the calls around them
+        self._ring.clear()
+        _test_inner.tracer.slow_threshold = 0
+        _test_outer()
+        self.assertListEqual(self._events(), [('call', '_test_outer', 0),
+                                              ('call', '_test_inner', 1),
+                                              ('return', '_test_inner', 1),
+                                              ('call', '_test_inner', 1),
+                                              ('return', '_test_inner', 1),
+                                              ('call', '_test_inner', 1),
+                                              ('return', '_test_inner', 1),
+                                              ('return', '_test_outer', 0)])
+        self.assertListEqual(_thread_state().pending, [])
+
+    def test_generators(self):
+        @trace(slow_threshold=0.1)
+        def _test_generator(seconds):
+            self._sleep(seconds)
+            yield seconds
+
+        self.assertListEqual(list(_test_generator(0.01)), [0.01])
+        self.assertListEqual(self._ring.events(), [])
+        self.assertListEqual(list(_test_generator(0.2)), [0.2])
+        self.assertEqual(len(self._ring.events()), 2)
+
+
+class _TestInstanceRegistry(unittest.TestCase):
+    def setUp(self):
+        self._ring = RingBufferSink()
+        set_sink(self._ring)
+        set_instance_registry(True)
+
+        @trace(timing=True)
+        class _TestPool(object):
+            def __init__(self, size):
+                self.size = size
+
+            def acquire(self, fail=False):
+                if fail:
+                    raise ValueError()
+                return self.size
+
+        self._pool_class = _TestPool
+
+    def tearDown(self):
+        set_instance_registry(False)
+        set_sink(None)
+
+    def test_sequence_numbers(self):
+        first = self._pool_class(1)
+        second = self._pool_class(2)
+        first_number = instance_number(first)
+        self.assertEqual(instance_number(second), first_number + 1)
+        first.acquire()
+        second.acquire()
+        self.assertListEqual([event['instance'] for event in self._ring.events()],
+                             [first_number, first_number, first_number + 1, first_number + 1,
+                              first_number, first_number, first_number + 1, first_number + 1])
+        self.assertIn('_TestPool[{}].acquire'.format(first_number), self._ring.lines()[4])
+
+        # Numbers are never reused, even if the id is. The sink holds the arguments, including self
+        self._ring.clear()
+        del first
+        gc.collect()
+        third = self._pool_class(3)
+        self.assertEqual(instance_number(third), first_number + 2)
+        self.assertEqual(instance_number(second), first_number + 1)
+        self.assertNotIn(first_number, _instances._by_number)
+        self.assertEqual(len(_instances._by_id), 2)
+
+        # Without weak reference support the id is used, without registering the instance
+        self.assertEqual(instance_number(third.size), id(third.size))
+        self.assertIn(int, _instances._unreferenceable)
+        self.assertEqual(instance_number(third.size), id(third.size))
+        self.assertEqual(len(_instances._by_id), 2)
+
+        set_instance_registry(False)
+        self.assertIsNone(instance_number(third))
+        third.acquire()
+        self.assertEqual(self._ring.events()[-1]['instance'], id(third))
+
+    def test_instance_stats(self):
+        pools = [self._pool_class(i) for i in range(3)]
+        for i in range(5):
+            pools[1].acquire()
+        pools[2].acquire()
+        self.assertRaises(ValueError, pools[2].acquire, fail=True)
+
+        entries = instance_stats()
+        self.assertListEqual([(entry['instance'], entry['calls'], entry['exceptions'])
+                              for entry in sorted(entries, key=lambda entry: entry['instance'])],
+                             [(instance_number(pools[0]), 1, 0),
+                              (instance_number(pools[1]), 6, 0),
+                              (instance_number(pools[2]), 3, 1)])
+        self.assertEqual(entries[0]['class'], '_TestPool')
+        self.assertTrue(all(entry['total'] > 0 for entry in entries))
+
+        reset_stats()
+        self.assertListEqual(instance_stats(), [])
+        self._ring.clear()
+        del pools
+        gc.collect()
+        self.assertListEqual(_instances.entries(), [])
+
+    def test_aggregate_only(self):
+        @trace(aggregate_only=True)
+        class _TestCache(object):
+            def get(self, key):
+                return key
+
+        cache = _TestCache()
+        cache.get(1)
+        cache.get(2)
+        self.assertListEqual([(entry['instance'], entry['calls']) for entry in instance_stats()],
+                             [(instance_number(cache), 2)])
+
+    def test_filter(self):
+        first = self._pool_class(1)
+        second = self._pool_class(2)
+        set_instance_filter(second)
+        first.acquire()
+        second.acquire()
+        trace(lambda: None)()
+        set_instance_filter(None)
+        first.acquire()
+        self.assertListEqual([(event['function'], event['instance'])
+                              for event in self._ring.events()[4::2]],
+                             [('acquire', instance_number(second)), ('<lambda>', None),
+                              ('acquire', instance_number(first))])
+
+        set_instance_filter(instance_number(first))
+        second.acquire()
+        self.assertEqual(len(self._ring.events()), 10)
+        set_instance_registry(False)
+        second.acquire()
+        self.assertEqual(len(self._ring.events()), 12)
+
+
+def _corpus_test_sum(values, scale=1):
+    return sum(values) * scale
+
+
+class _CorpusTestAccount(object):
+    def __init__(self):
+        self.balance = 0
+
+    def deposit(self, amount):
+        self.balance += amount
+        return self.balance
+
+
+_corpus_test_release = threading.Event()
+
+
+def _corpus_test_wait(key):
+    _corpus_test_release.wait()
+    return key
+
+
+# The sink and traced function of test_size_limit_of_pending_calls, and the pending sizes seen
+_corpus_test_nesting = {}
+
+
+def _corpus_test_nest(depth, data):
+    _corpus_test_nesting['sizes'].append(_corpus_test_nesting['sink']._pending_size)
+    if depth:
+        _corpus_test_nesting['nest'](depth - 1, data)
+
+
+class _TestCaptureReplay(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+        self._directory = tempfile.mkdtemp()
+        self._path = os.path.join(self._directory, 'calls.corpus')
+
+    def tearDown(self):
+        import shutil
+        set_sink(None)
+        untrace(_CorpusTestAccount)
+        shutil.rmtree(self._directory)
+
+    def _record(self, **options):
+        sink = CaptureSink(self._path, **options)
+        set_sink(sink)
+        traced = trace(_corpus_test_sum)
+        traced([1, 2, 3])
+        traced([4, 5], scale=2)
+        # Generators cannot be pickled
+        traced(value for value in range(3))
+        self.assertRaises(TypeError, traced, None)
+        trace(lambda values: values)([1])
+        set_sink(None)
+        sink.close()
+        return sink
+
+    def test_record_and_replay(self):
+        sink = self._record()
+        self.assertEqual(sink.recorded, 3)
+        self.assertEqual(sink.skipped, 1)
+
+        result, = replay(self._path, number=2)
+        self.assertEqual(result['name'], '_corpus_test_sum')
+        self.assertEqual(result['calls'], 3)
+        self.assertEqual(result['errors'], 0)
+        self.assertEqual(result['mismatches'], 0)
+        self.assertGreater(result['total'], 0)
+        self.assertEqual(result['mean'], result['total'] // 3)
+        self.assertListEqual(replay(self._path, include='other*'), [])
+
+    def test_mismatches_and_errors(self):
+        self._record()
+        global _corpus_test_sum
+        original = _corpus_test_sum
+        try:
+            _corpus_test_sum = lambda values, scale=1: sum(values) * scale + 1
+            result, = replay(self._path, number=1)
+            self.assertEqual(result['mismatches'], 2)
+            del _corpus_test_sum
+            result, = replay(self._path, number=1)
+            self.assertEqual(result['errors'], 3)
+            self.assertIsNone(result['mean'])
+        finally:
+            _corpus_test_sum = original
+
+    def test_methods(self):
+        trace(_CorpusTestAccount)
+        sink = CaptureSink(self._path, include='*.deposit', max_calls=2)
+        set_sink(sink)
+        account = _CorpusTestAccount()
+        for amount in range(1, 5):
+            account.deposit(amount)
+        set_sink(None)
+        sink.close()
+        self.assertEqual(sink.recorded, 2)
+
+        # Every repetition starts from the recorded state of the instance
+        result, = replay(self._path, number=3)
+        self.assertEqual(result['name'], '_CorpusTestAccount.deposit')
+        self.assertEqual((result['calls'], result['errors'], result['mismatches']), (2, 0, 0))
+
+    def test_calls_that_do_not_return(self):
+        sink = CaptureSink(self._path, max_pending=2)
+        set_sink(sink)
+        traced = trace(_corpus_test_wait)
+        threads = [threading.Thread(target=traced, args=(key,)) for key in range(3)]
+        for thread in threads:
+            thread.start()
+        try:
+            # The oldest call waiting for its return is dropped
+            deadline = time.time() + 5
+            while sink.skipped < 1:
+                self.assertLess(time.time(), deadline)
+                time.sleep(0.01)
+        finally:
+            _corpus_test_release.set()
+            for thread in threads:
+                thread.join()
+            _corpus_test_release.clear()
+        set_sink(None)
+        sink.close()
+        self.assertEqual((sink.recorded, sink.skipped), (2, 1))
+        self.assertEqual(len(sink._pending), 0)
+
+    def test_size_limit(self):
+        sink = self._record(max_bytes=200)
+        self.assertLessEqual(os.path.getsize(self._path), 200)
+        self.assertLess(sink.recorded, 3)
+
+    def test_size_limit_of_pending_calls(self):
+        sink = CaptureSink(self._path, max_bytes=2000)
+        set_sink(sink)
+        traced = trace(_corpus_test_nest)
+        _corpus_test_nesting.update(sink=sink, nest=traced, sizes=[])
+        traced(10, 'x' * 500)
+        set_sink(None)
+        sink.close()
+        # Outer calls wait for their return while the inner ones run
+        sizes = _corpus_test_nesting['sizes']
+        _corpus_test_nesting.clear()
+        self.assertLessEqual(max(sizes), 2000)
+        self.assertGreater(sink.skipped, 0)
+        self.assertLessEqual(os.path.getsize(self._path), 2000)
+
+    def test_command_line(self):
+        self._record()
+        path = os.path.join(self._directory, 'replay.json')
+        output = io.StringIO() if sys.version_info >= (3,) else io.BytesIO()
+        original_stdout, sys.stdout = sys.stdout, output
+        try:
+            arguments = ['replay', self._path, '--number', '1']
+            self.assertEqual(_main(arguments + ['--json', path]), 0)
+            self.assertEqual(_main(arguments + ['--compare', path]), 0)
+        finally:
+            sys.stdout = original_stdout
+        lines = output.getvalue().splitlines()
+        self.assertEqual(len(lines), 4)
+        self.assertTrue(lines[3].startswith('_corpus_test_sum'))
+        self.assertTrue(lines[2].endswith('change'))
+
+
+class _TestArgumentBinding(unittest.TestCase):
+    def setUp(self):
+        self._ring = RingBufferSink()
+        set_sink(self._ring)
+
+    def tearDown(self):
+        set_sink(None)
+
+    def _calls(self):
+        return [line.split(':', 1)[1] for line in self._ring.lines()[::2]]
+
+    def test_varargs(self):
         @trace
-        class _BaseClass(object):
-            def method_one(self, a, b):
-                return a+b
+        def _test_varargs(a, b=2, *args, **kwargs):
+            return args
 
-            def method_two(self, c, d):
-                return c+d
+        self.assertEqual(_test_varargs(1, 2, 3, 4, x=5), (3, 4))
+        _test_varargs(1)
+        self.assertListEqual(self._calls(), ['_test_varargs(a=1, b=2, args=(3, 4), x=5)',
+                                             '_test_varargs(a=1)'])
+        self.assertListEqual(list(self._ring.events()[0]['args']), ['a', 'b', 'args', 'x'])
 
+    def test_explicit_defaults(self):
         @trace
-        class _SubClass(_BaseClass):
-            def method_two(self, c, d):
-                return c-d
+        def _test_explicit(a, d=None, e=34):
+            return a, d, e
 
-            def method_three(self, e, f):
-                return e+f
+        self.assertEqual(_test_explicit(1, None, 34), (1, None, 34))
+        self.assertEqual(_test_explicit(1), (1, None, 34))
+        self.assertEqual(_test_explicit(1, e=34), (1, None, 34))
+        self.assertListEqual(self._calls(), ['_test_explicit(a=1, d=None, e=34)',
+                                             '_test_explicit(a=1)',
+                                             '_test_explicit(a=1, e=34)'])
+        self.assertEqual(str(inspect.signature(_test_explicit)), '(a, d=None, e=34)')
+        self.assertEqual(_test_explicit.tracer.received_arguments((1, _OMITTED, 34), {}),
+                         ((1, None, 34), {}))
 
-        bc = _BaseClass()
-        sc = _SubClass()
+    def test_keyword_only(self):
+        # Keyword-only parameters are a syntax error in Python 2
+        namespace = {}
+        exec('def _test_keyword_only(a, *, b, c=3, **kwargs):\n'
+             '    return a + b + c\n', namespace)
+        original = namespace['_test_keyword_only']
 
-        ret = bc.method_one(1, 2)
-        self.assertEqual(ret, 3)
+        traced = trace(original)
+        self.assertTrue(traced.__code__.co_filename.startswith('<calltrace'))
+        self.assertEqual(inspect.signature(traced), inspect.signature(original))
+        self.assertEqual(traced(1, b=2), 6)
+        self.assertEqual(traced(1, c=4, b=2, d=5), 7)
+        self.assertRaises(TypeError, traced, 1, 2)
+        self.assertListEqual(self._calls(), ['_test_keyword_only(a=1, b=2)',
+                                             '_test_keyword_only(a=1, b=2, c=4, d=5)'])
 
-        ret = bc.method_two(4, 5)
-        self.assertEqual(ret, 9)
+    def test_show_defaults(self):
+        namespace = {}
+        exec('def _test_defaults(a, b=2, *args, c=3, **kwargs):\n'
+             '    return a\n', namespace)
+        _test_defaults = trace(namespace['_test_defaults'], show_defaults=True)
 
-        ret = sc.method_one(1, 2)
-        self.assertEqual(ret, 3)
+        _test_defaults(1)
+        _test_defaults(1, 5, 6, d=7)
+        self.assertListEqual(self._calls(), ['_test_defaults(a=1, b=2, c=3)',
+                                             '_test_defaults(a=1, b=5, args=(6,), c=3, d=7)'])
 
-        ret = sc.method_two(4, 5)
-        self.assertEqual(ret, -1)
+        # The generic wrapper only records the arguments passed
+        self.assertListEqual(_test_defaults.tracer.bound_arguments((1,), {'d': 7}),
+                             [('a', 1), ('b', 2), ('c', 3), ('d', 7)])
 
-        ret = sc.method_three(3, 1)
-        self.assertEqual(ret, 4)
+    def test_methods(self):
+        @trace(show_defaults=True)
+        class _TestBinding(object):
+            def __init__(self, a, *args):
+                self.a = a
 
-        thread_id = id(threading.current_thread())
-        expected = [self._mock.call('Thread{{{}}}:_BaseClass[{}].method_one(self={}, a=1, b=2)'
-                                    .format(thread_id, id(bc), str(bc))),
-                    self._mock.call('Thread{{{}}}:_BaseClass[{}].method_one returned 3'
-                                    .format(thread_id, id(bc))),
-                    self._mock.call('Thread{{{}}}:_BaseClass[{}].method_two(self={}, c=4, d=5)'
-                                    .format(thread_id, id(bc), str(bc))),
-                    self._mock.call('Thread{{{}}}:_BaseClass[{}].method_two returned 9'
-                                    .format(thread_id, id(bc))),
-                    self._mock.call('Thread{{{}}}:_BaseClass[{}].method_one(self={}, a=1, b=2)'
-                                    .format(thread_id, id(sc), str(sc))),
-                    self._mock.call('Thread{{{}}}:_BaseClass[{}].method_one returned 3'
-                                    .format(thread_id, id(sc))),
-                    self._mock.call('Thread{{{}}}:_SubClass[{}].method_two(self={}, c=4, d=5)'
-                                    .format(thread_id, id(sc), str(sc))),
-                    self._mock.call('Thread{{{}}}:_SubClass[{}].method_two returned -1'
-                                    .format(thread_id, id(sc))),
-                    self._mock.call('Thread{{{}}}:_SubClass[{}].method_three(self={}, e=3, f=1)'
-                                    .format(thread_id, id(sc), str(sc))),
-                    self._mock.call('Thread{{{}}}:_SubClass[{}].method_three returned 4'
-                                    .format(thread_id, id(sc)))]
-        self.assertListEqual(_output.mock_calls, expected)
+            def method(self, *args, **kwargs):
+                return args
 
+        instance = _TestBinding(1, 2)
+        self.assertEqual(instance.method(3, key=4), (3,))
+        self.assertListEqual([line.split('.', 1)[1] for line in self._calls()],
+                             ['__init__(a=1, args=(2,))', 'method(self={}, args=(3,), key=4)'
+                              .format(_safe_str(instance))])
 
-class _TestTraceOverhead(unittest.TestCase):
-    number_of_cycles = 10000
 
-    def test_overhead_no_arguments_no_return(self):
-        def _test_function():
-            # Some small function with 10 statements
-            for _ in range(10):
-                pass
+class _TestBenchmark(unittest.TestCase):
+    def test_benchmark(self):
+        results = benchmark(number=100, repeat=1, scenarios=['no args', 'exception', 'threads'],
+                            modes=['disabled', 'binary', 'async text'])
+        self.assertEqual(len(results), 9)
+        self.assertListEqual(sorted(results[0]),
+                             ['baseline', 'mode', 'overhead', 'ratio', 'scenario', 'traced'])
+        self.assertEqual((results[-1]['scenario'], results[-1]['mode']), ('threads', 'async text'))
+        self.assertIsNone(_writer)
+        self.assertIsInstance(_sinks[0], _TextSink)
 
-        import timeit
-        no_trace = timeit.timeit(stmt=_test_function, number=self.number_of_cycles)
-        with_trace = timeit.timeit(stmt=trace(_test_function), number=self.number_of_cycles)
+        self.assertRaises(ValueError, benchmark, scenarios=['unknown'])
 
-        print('no trace: ', no_trace)
-        print('with trace: ', with_trace)
-        print('overhead: ', with_trace*100/no_trace)
+    def test_all_modes(self):
+        results = benchmark(number=20, repeat=1, scenarios=['method', 'exception'])
+        self.assertListEqual([result['mode'] for result in results[::2]], list(_benchmark_modes))
+        self.assertIsInstance(_sinks[0], _TextSink)
+
+    def test_save_and_compare(self):
+        import shutil
+        import tempfile
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'bench.json')
+            arguments = ['bench', '--number', '100', '--repeat', '1', '--scenario', 'method',
+                         '--mode', 'null sink']
+            output = io.StringIO()
+            original_stdout, sys.stdout = sys.stdout, output
+            try:
+                self.assertEqual(_main(arguments + ['--json', path]), 0)
+                self.assertEqual(_main(arguments + ['--compare', path]), 0)
+            finally:
+                sys.stdout = original_stdout
+
+            with io.open(path, encoding='utf-8') as f:
+                saved = json.load(f)
+            self.assertEqual(saved['results'][0]['mode'], 'null sink')
+            lines = output.getvalue().splitlines()
+            self.assertEqual(len(lines), 4)
+            self.assertTrue(lines[2].strip().startswith('scenario'))
+            self.assertTrue(lines[2].strip().endswith('change'))
+        finally:
+            shutil.rmtree(directory)
 
-    def test_profile_no_arguments_no_return(self):
-        def _test_function():
-            # Some small function with 10 statements
-            for _ in range(10):
-                pass
 
-        import cProfile
-        import timeit
-        pr = cProfile.Profile()
-        pr.enable()
-        timeit.timeit(stmt=trace(_test_function), number=self.number_of_cycles)
-        pr.create_stats()
-        pr.print_stats()
+if __name__ == '__main__':
+    sys.exit(_main())